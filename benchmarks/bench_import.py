@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Import time, throughput and peak memory of COMPREF files.
+
+Synthetic files (see `pysteps_importer_cwb.testing`) are written to a temporary
+directory, then imported through the pysteps importer, through
+`read_cwb_compref` with several options, and as a time series. The throughput
+is the size of the int16 payloads decoded per second.
+
+Usage: python benchmarks/bench_import.py [--nx 921] [--ny 881] [--frames 24]
+       [--repeat 5] [--workers 4] [--stages] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from functools import partial
+
+from pysteps_importer_cwb import instrument
+from pysteps_importer_cwb.importer_cwb_compref import (
+    importer_cwb_compref_cwb,
+    read_cwb_compref,
+    read_timeseries_cwb_compref,
+)
+from pysteps_importer_cwb.testing import synthetic_archive
+
+
+def measure(func, repeat):
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def cases(filenames, filenames_raw, ny, nx, workers):
+    gz = filenames[0]
+    raw = filenames_raw[0]
+    # Central quarter of the grid.
+    roi = (slice(ny // 4, 3 * ny // 4), slice(nx // 4, 3 * nx // 4))
+    read_gz = partial(read_cwb_compref, gz, gzipped=True)
+    single = [
+        ("importer gz", partial(importer_cwb_compref_cwb, gz, gzipped=True)),
+        ("importer raw", partial(importer_cwb_compref_cwb, raw)),
+        ("read gz float32", partial(read_gz, dtype="float32")),
+        ("read gz int16", partial(read_gz, dtype="int16")),
+        ("read raw float32", partial(read_cwb_compref, raw, dtype="float32")),
+        ("read gz rainrate", partial(read_gz, rainrate=True)),
+        ("read gz roi", partial(read_gz, roi=roi)),
+        ("read gz regrid 2 km", partial(read_gz, regrid=2000.0)),
+    ]
+    batch = [
+        (
+            "timeseries gz x1",
+            partial(
+                read_timeseries_cwb_compref, filenames, gzipped=True,
+                dtype="float32", num_workers=1,
+            ),
+        ),
+        (
+            "timeseries gz x%d" % workers,
+            partial(
+                read_timeseries_cwb_compref, filenames, gzipped=True,
+                dtype="float32", num_workers=workers,
+            ),
+        ),
+        (
+            "timeseries raw x%d" % workers,
+            partial(
+                read_timeseries_cwb_compref, filenames_raw, dtype="float32",
+                num_workers=workers,
+            ),
+        ),
+    ]
+    return [(name, func, 1) for name, func in single] + [
+        (name, func, len(filenames)) for name, func in batch
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nx", type=int, default=921)
+    parser.add_argument("--ny", type=int, default=881)
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--stages", action="store_true",
+        help="print the time of each stage of a gzipped import",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = datetime(2022, 12, 6, 0, 0)
+        filenames, _ = synthetic_archive(
+            tmp, start, args.frames, ny=args.ny, nx=args.nx
+        )
+        filenames_raw, _ = synthetic_archive(
+            tmp, start, args.frames, ny=args.ny, nx=args.nx, fn_ext="raw"
+        )
+        size = sum(os.path.getsize(fn) for fn in filenames) / len(filenames)
+        print(
+            "frames: %d x %d, %d frames, %.0f kB gzipped"
+            % (args.nx, args.ny, args.frames, size / 1e3)
+        )
+
+        results = []
+        payload = 2 * args.nx * args.ny
+        for name, func, nframes in cases(
+            filenames, filenames_raw, args.ny, args.nx, args.workers
+        ):
+            best, peak = measure(func, args.repeat)
+            results.append(
+                dict(
+                    name=name, seconds=best, peak_bytes=peak,
+                    throughput=nframes * payload / best,
+                )
+            )
+            print(
+                "%-22s %9.2f ms %8.1f MB/s %8.1f MB peak"
+                % (name, best * 1e3, nframes * payload / best / 1e6, peak / 1e6)
+            )
+
+        if args.stages:
+            with instrument.collect() as stats:
+                for _ in range(args.repeat):
+                    read_cwb_compref(filenames[0], gzipped=True)
+            print()
+            print(stats)
+
+    if args.json:
+        with open(args.json, "w") as fid:
+            json.dump(
+                dict(nx=args.nx, ny=args.ny, frames=args.frames, results=results),
+                fid, indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
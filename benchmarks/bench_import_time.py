@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Import time of the plugin, in fresh interpreters.
+
+pysteps imports the importer module whenever it discovers its importers, so
+every process importing pysteps pays for it. The benchmark times the imports
+of the plugin modules, lists the heavy dependencies they load, and measures
+the cost of the plugin in the discovery: the import of the importer module once
+pysteps is imported.
+
+Usage: python benchmarks/bench_import_time.py [--repeat 5]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+STATEMENTS = [
+    "import numpy",
+    "import pysteps_importer_cwb",
+    "import pysteps_importer_cwb.importer_cwb_compref",
+    "import pysteps_importer_cwb.validate",
+    "import pysteps_importer_cwb.opendata",
+    "import pysteps",
+]
+
+# Dependencies that the discovery of the importer should not load.
+HEAVY = ["pysteps", "pyproj", "xml.etree.ElementTree", "http.client"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+%s
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [m for m in %r if m in sys.modules]]))
+"""
+
+
+def time_import(statement, repeat):
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE % (statement, HEAVY)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        seconds, loaded = json.loads(output.strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best, loaded
+
+
+_DISCOVERY_PROBE = """
+import sys, time
+import pysteps
+for name in [m for m in sys.modules if m.startswith("pysteps_importer_cwb")]:
+    del sys.modules[name]
+start = time.perf_counter()
+import pysteps_importer_cwb.importer_cwb_compref
+print(time.perf_counter() - start)
+"""
+
+
+def discovery_time(repeat):
+    """
+    Time of the import of the importer module by an interpreter that already
+    imported pysteps and its dependencies: the cost of the plugin in the
+    discovery of the pysteps importers.
+    """
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _DISCOVERY_PROBE],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        seconds = float(output.strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for statement in STATEMENTS:
+        seconds, loaded = time_import(statement, args.repeat)
+        print(
+            "%-50s %8.1f ms   %s"
+            % (statement, seconds * 1e3, ", ".join(loaded) or "-")
+        )
+    print(
+        "\nimporter module, after pysteps: %.1f ms"
+        % (discovery_time(args.repeat) * 1e3)
+    )
+
+
+if __name__ == "__main__":
+    main()
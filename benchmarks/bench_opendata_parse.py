@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Parse time and peak memory of an OpenData frame (O-A0059-001).
+
+Compares the streaming parser and chunked int16 decoder of
+`pysteps_importer_cwb.opendata.parse_opendata_frame` with the previous
+implementation (xmltodict tree and ``np.fromstring``, requires xmltodict).
+
+Usage: python benchmarks/bench_opendata_parse.py [--nx 921] [--ny 881] [--repeat 5]
+"""
+
+import argparse
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+from pysteps_importer_cwb.opendata import parse_opendata_frame
+
+
+def synthetic_frame(nx, ny, seed=0):
+    """OpenData frame XML with a plausible mix of no-value, clear sky and echoes."""
+    rng = np.random.default_rng(seed)
+    dbz = np.round(rng.normal(20, 15, size=ny * nx), 2)
+    dbz[rng.random(dbz.size) < 0.5] = -99.0
+    dbz[: dbz.size // 10] = -999.0
+    content = ",".join("%.2f" % v for v in dbz)
+    parameters = [
+        "<radarName>五分山雷達、花蓮雷達、七股雷達</radarName>",
+        "<parameterValue>115.0,18.0</parameterValue>",
+        "<parameterValue>0.0125</parameterValue>",
+        "<parameterValue>2022-12-06T10:30:00+08:00</parameterValue>",
+        "<parameterValue>%d*%d</parameterValue>" % (nx, ny),
+        "<parameterValue>dBZ</parameterValue>",
+    ]
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<cwbopendata xmlns="urn:cwb:gov:tw:cwbcommon:0.1"><dataset>'
+        "<datasetInfo><parameterSet>%s</parameterSet></datasetInfo>"
+        "<contents><content>%s</content></contents></dataset></cwbopendata>"
+        % ("".join("<parameter>%s</parameter>" % p for p in parameters), content)
+    ).encode("utf-8")
+
+
+def parse_xmltodict(xml):
+    """Previous implementation of the frame parsing."""
+    import xmltodict
+
+    raw = xmltodict.parse(xml.decode("utf-8"))
+    parameters = raw["cwbopendata"]["dataset"]["datasetInfo"]["parameterSet"]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        dbz = np.fromstring(
+            raw["cwbopendata"]["dataset"]["contents"]["content"],
+            dtype=np.float32,
+            count=-1,
+            sep=",",
+        ).astype(np.int16)
+    return parameters, np.array(dbz * 10, dtype="i2")
+
+
+def measure(func, xml, repeat):
+    func(xml)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(xml)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(xml)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nx", type=int, default=921)
+    parser.add_argument("--ny", type=int, default=881)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    xml = synthetic_frame(args.nx, args.ny)
+    print("frame: %d x %d, %.1f MB of XML" % (args.nx, args.ny, len(xml) / 1e6))
+
+    candidates = [("streaming + chunked", parse_opendata_frame)]
+    try:
+        import xmltodict  # noqa: F401
+
+        candidates.insert(0, ("xmltodict + fromstring", parse_xmltodict))
+    except ImportError:
+        print("xmltodict is not installed, skipping the previous implementation")
+
+    for name, func in candidates:
+        best, peak = measure(func, xml, args.repeat)
+        print("%-24s %8.1f ms %8.1f MB peak" % (name, best * 1e3, peak / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Parse, download and synchronization throughput of the OpenData frames.
+
+A local stand-in of the OpenData history API (see
+`pysteps_importer_cwb.testing.OpenDataStandIn`) publishes synthetic frames,
+optionally with a latency per request to imitate the remote server. The
+benchmark measures the conversion of a frame to a COMPREF file, the download of
+all the frames, and the incremental synchronization of an archive: the first
+synchronization, a synchronization with one new frame, and one without any.
+
+Usage: python benchmarks/bench_sync.py [--nx 921] [--ny 881] [--frames 12]
+       [--workers 4] [--latency 0.05] [--json results.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from pysteps_importer_cwb import instrument
+from pysteps_importer_cwb.opendata import (
+    _frame_to_compref,
+    download_cwb_opendata,
+    parse_opendata_frame,
+    sync_cwb_opendata,
+)
+from pysteps_importer_cwb.testing import OpenDataStandIn, synthetic_dbz
+
+FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def timed(func, *args, **kwargs):
+    # The downloads print every file.
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        return time.perf_counter() - start, result
+
+
+def best_of(func, xml, repeat):
+    return min(timed(func, xml)[0] for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nx", type=int, default=921)
+    parser.add_argument("--ny", type=int, default=881)
+    parser.add_argument("--frames", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="delay in seconds of the responses of the server",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    start = datetime(2022, 12, 6, 10, 0)
+    times = [
+        (start + timedelta(minutes=10 * i)).strftime(FMT)
+        for i in range(args.frames + 1)
+    ]
+    results = {}
+
+    with OpenDataStandIn(latency=args.latency) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        for i, data_time in enumerate(times[:-1]):
+            server.add_frame(
+                data_time, synthetic_dbz(args.ny, args.nx, shift=(i, 2 * i))
+            )
+        xml = server.frames[times[0]]
+        xml_bytes = sum(len(x) for x in server.frames.values())
+        print(
+            "frames: %d x %d, %d frames, %.1f MB of XML each"
+            % (args.nx, args.ny, args.frames, len(xml) / 1e6)
+        )
+
+        for name, func in [
+            ("parse", parse_opendata_frame), ("convert", _frame_to_compref)
+        ]:
+            seconds = best_of(func, xml, args.repeat)
+            results[name] = dict(seconds=seconds, throughput=len(xml) / seconds)
+            print(
+                "%-22s %9.1f ms %8.1f MB/s of XML"
+                % (name, seconds * 1e3, len(xml) / seconds / 1e6)
+            )
+
+        options = dict(num_workers=args.workers, base_url=server.base_url)
+        with instrument.collect() as stats:
+            seconds, written = timed(
+                download_cwb_opendata, path=tmp + "/download",
+                timeFrom=times[0], timeTo=times[-1], **options
+            )
+        results["download"] = dict(
+            seconds=seconds, frames=len(written), stages=stats.as_dict()
+        )
+        print(
+            "%-22s %9.1f ms %8.1f frames/s %6.1f MB/s of XML"
+            % ("download", seconds * 1e3, len(written) / seconds,
+               xml_bytes / seconds / 1e6)
+        )
+        print()
+        print(stats)
+        print()
+
+        path = tmp + "/sync"
+        for name in ("sync first", "sync new frame", "sync unchanged"):
+            if name == "sync new frame":
+                server.add_frame(
+                    times[-1],
+                    synthetic_dbz(args.ny, args.nx, shift=(args.frames,) * 2),
+                )
+            seconds, written = timed(
+                sync_cwb_opendata, path=path, timeFrom=times[0], **options
+            )
+            results[name] = dict(seconds=seconds, frames=len(written))
+            print(
+                "%-22s %9.1f ms %8d frames" % (name, seconds * 1e3, len(written))
+            )
+
+    if args.json:
+        with open(args.json, "w") as fid:
+            json.dump(
+                dict(nx=args.nx, ny=args.ny, frames=args.frames,
+                     latency=args.latency, results=results),
+                fid, indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+pysteps plugin for the radar composites of the Central Weather Bureau.
 
+The sub-modules are imported on first use, e.g. ``pysteps_importer_cwb.compref``
+or ``from pysteps_importer_cwb import opendata``: importing the package, or a
+tool such as the downloads, does not import pysteps. The importer module does
+not import pysteps either, so that it can be imported by the discovery of the
+pysteps importers (see `pysteps_importer_cwb.importer_cwb_compref`).
+"""
 
-from pysteps_importer_cwb import importer_cwb_compref
\ No newline at end of file
+# Import the needed libraries
+import importlib
+
+_SUBMODULES = (
+    "cache",
+    "catalog",
+    "compref",
+    "coverage",
+    "dataset",
+    "geometry",
+    "importer_cwb_compref",
+    "instrument",
+    "opendata",
+    "pack",
+    "prefetch",
+    "pyramid",
+    "regrid",
+    "shm",
+    "testing",
+    "utils",
+    "validate",
+)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
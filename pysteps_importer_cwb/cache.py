@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the decoded COMPREF frames.
+
+Hindcast and verification jobs import the same files many times. The
+`FrameCache` stores every decoded field as an uncompressed .npy file, next to
+a small JSON file with its metadata, so that later imports of the same file
+with the same options only memory-map the .npy file instead of decompressing
+and decoding the source again.
+
+The cache entries are keyed by the absolute path, the modification time and
+the size of the source file, and by the import options: a modified source file
+is decoded again. The entries are written atomically, so the cache can be
+shared by concurrent processes, and the least recently used entries are evicted
+when the cache grows beyond its size budget.
+"""
+
+# Import the needed libraries
+import hashlib
+import inspect
+import json
+import os
+import time
+
+import numpy as np
+
+from pysteps_importer_cwb import instrument
+from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+from pysteps_importer_cwb.utils import default_cache_dir, json_default, write_atomic
+
+# Version of the layout of the cache entries, part of their keys.
+_CACHE_VERSION = 1
+
+# Default size budget of a cache, in bytes.
+MAX_BYTES = 2 << 30
+
+
+def source_key(filename, kwargs, version=0):
+    """
+    Key of a field derived from a source file and import options.
+
+    The key changes with the absolute path, the modification time and the size
+    of the file, and with the options of `read_cwb_compref`. The same options
+    given explicitly or by default give the same key. The masked arrays and
+    quality fields of `read_cwb_compref` are not cached.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the COMPREF file.
+    kwargs : dict
+        Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`,
+        except ``out``.
+    version : int
+        Version of the layout of the cached data.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal digest.
+    """
+    stat = os.stat(filename)
+    options = inspect.signature(read_cwb_compref).bind(filename, **kwargs)
+    options.apply_defaults()
+    options = options.arguments
+    del options["filename"]
+    if options.pop("out") is not None:
+        raise ValueError("The cached fields cannot be decoded into out")
+    masked = options.pop("masked")
+    if options.pop("quality") or masked:
+        raise ValueError("Masked arrays and quality fields are not cached")
+    key = (
+        version,
+        os.path.abspath(filename),
+        stat.st_mtime_ns,
+        stat.st_size,
+        sorted(options.items()),
+    )
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+class FrameCache(object):
+    """
+    Least recently used cache of decoded COMPREF frames.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory of the cache, by default the "frames" sub-directory of
+        `pysteps_importer_cwb.utils.default_cache_dir`.
+    max_bytes : int
+        Size budget of the cache. When it is exceeded, the least recently used
+        entries are removed.
+
+    Examples
+    --------
+    >>> cache = FrameCache(max_bytes=10 << 30)
+    >>> precip, quality, metadata = cache.read(filename, gzipped=True)
+
+    or, through the pysteps importer:
+
+    >>> importer_cwb_compref_cwb(filename, gzipped=True, cache=cache)
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=MAX_BYTES):
+        if cache_dir is None:
+            cache_dir = os.path.join(default_cache_dir(), "frames")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, filename, kwargs):
+        return source_key(filename, kwargs, version=_CACHE_VERSION)
+
+    def read(self, filename, **kwargs):
+        """
+        Read a COMPREF file through the cache.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to import.
+        **kwargs
+            Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`
+            (gzipped, roi, dtype, rainrate, ...), except ``out``.
+
+        Returns
+        -------
+        precipitation : array
+            The decoded field. On a cache hit it is a read-only memory map of
+            the cached file.
+        quality : None
+        metadata : dict
+        """
+        timer = instrument.timer()
+        key = self._key(filename, kwargs)
+        npy_name = os.path.join(self.cache_dir, key + ".npy")
+        json_name = os.path.join(self.cache_dir, key + ".json")
+
+        try:
+            precip = np.load(npy_name, mmap_mode="r")
+            with open(json_name) as fid:
+                metadata = json.load(fid)
+        except (FileNotFoundError, ValueError):
+            # Missing, or being evicted by another process.
+            pass
+        else:
+            self.hits += 1
+            if timer is not None:
+                timer.lap("cache")
+            # The modification time orders the entries for the eviction.
+            try:
+                os.utime(npy_name)
+            except FileNotFoundError:
+                pass
+            return precip, None, metadata
+
+        self.misses += 1
+        precip, quality, metadata = read_cwb_compref(filename, **kwargs)
+        # The metadata are written first: a complete .npy file marks a
+        # complete entry.
+        write_atomic(
+            json_name, json.dumps(metadata, default=json_default).encode()
+        )
+        write_atomic(npy_name, lambda fid: np.save(fid, precip))
+        self.evict()
+        return precip, quality, metadata
+
+    def _entries(self):
+        """(mtime, size, name) of the cached .npy files, oldest first."""
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".npy") and not entry.name.startswith("."):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        entries.sort()
+        return entries
+
+    def size(self):
+        """Total size in bytes of the cached fields."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used entries beyond a size budget.
+
+        Fields still memory-mapped by a reader remain valid after their
+        removal.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Size budget, by default the one of the cache.
+
+        Returns
+        -------
+        count : int
+            Number of entries removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        count = 0
+        for _, size, npy_name in entries:
+            if total <= max_bytes:
+                break
+            for name in (npy_name, npy_name[:-4] + ".json"):
+                try:
+                    os.unlink(name)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            count += 1
+        self._remove_stale_temporaries()
+        return count
+
+    def _remove_stale_temporaries(self, age=3600):
+        # Temporary files left by interrupted writers.
+        now = time.time()
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.startswith(".") and entry.name.endswith(".tmp"):
+                        try:
+                            if now - entry.stat().st_mtime > age:
+                                os.unlink(entry.path)
+                        except FileNotFoundError:
+                            pass
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Remove all the entries."""
+        self.evict(max_bytes=0)
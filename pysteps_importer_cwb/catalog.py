@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk catalog of a COMPREF archive.
+
+Listing an archive of several years of 10-minute frames means walking hundreds
+of thousands of files, which is slow on network storage. The catalog keeps one
+row per file (time, path, size and the main header fields) in a SQLite
+database, so that the time-based lookups ("frames in [t0, t1]", "nearest frame
+to t", "gaps in the coverage") are answered by an index search without touching
+the archive.
+
+The catalog is updated incrementally: the modification time of every directory
+is recorded, and the directories that did not change since the last update are
+not listed again. The files of the archive are written atomically (renamed into
+place), which always updates the modification time of their directory.
+
+Files whose header cannot be read (e.g. an empty or truncated download) are
+left out of the catalog and listed in `Catalog.unreadable`. Their directories
+are listed again by the next update, so that they are indexed once repaired.
+"""
+
+# Import the needed libraries
+import os
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from pysteps_importer_cwb.compref import read_compref_header
+
+CatalogEntry = namedtuple(
+    "CatalogEntry", ["time", "path", "size", "nx", "ny", "nz", "nradar", "mosradar"]
+)
+CatalogEntry.__doc__ = """\
+A file of the catalog.
+
+Attributes
+----------
+time : datetime
+    Time of the frame, from the file header (UTC).
+path : str
+    Name of the file.
+size : int
+    Size of the file in bytes.
+nx, ny, nz : int
+    Grid size.
+nradar : int
+    Number of contributing radars.
+mosradar : tuple of str
+    Names of the contributing radars.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT PRIMARY KEY,
+    time INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    nx INTEGER NOT NULL,
+    ny INTEGER NOT NULL,
+    nz INTEGER NOT NULL,
+    nradar INTEGER NOT NULL,
+    mosradar TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_time ON frames (time);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+_COLUMNS = "time, path, size, nx, ny, nz, nradar, mosradar"
+
+
+def _to_seconds(time):
+    return int(time.replace(tzinfo=timezone.utc).timestamp())
+
+
+def _from_seconds(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+def _entry(row):
+    time, path, size, nx, ny, nz, nradar, mosradar = row
+    return CatalogEntry(
+        _from_seconds(time), path, size, nx, ny, nz, nradar,
+        tuple(mosradar.split()),
+    )
+
+
+class Catalog(object):
+    """
+    SQLite catalog of the COMPREF files of an archive.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the database, created if it does not exist.
+    root_path : str, optional
+        Root directory of the archive, scanned by `update`.
+    fn_ext : str
+        Extension of the COMPREF files. Files ending with "gz" are read as
+        gzip compressed.
+
+    Examples
+    --------
+    >>> catalog = Catalog("./radar/cwb_opendata/catalog.sqlite",
+    ...                   root_path="./radar/cwb_opendata")
+    >>> catalog.update()
+    >>> fns = catalog.find(datetime(2022, 12, 6, 2, 0), datetime(2022, 12, 6, 3, 0))
+
+    Attributes
+    ----------
+    unreadable : dict
+        Files of the last `add` or `update` whose header could not be read,
+        with the error.
+    """
+
+    def __init__(self, filename, root_path=None, fn_ext="gz"):
+        self.filename = filename
+        self.root_path = root_path
+        self.fn_ext = fn_ext
+        self.unreadable = {}
+        self._conn = sqlite3.connect(filename)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    # Updates
+    # ~~~~~~~
+
+    def add(self, filenames, num_workers=4):
+        """
+        Add or refresh files in the catalog.
+
+        Only the files whose size or modification time changed since they were
+        cataloged have their header read again. The files that cannot be read
+        are skipped and listed in `unreadable`.
+
+        Parameters
+        ----------
+        filenames : list of str
+            Files to add, e.g. the files returned by `download_cwb_opendata`.
+        num_workers : int
+            Number of headers read concurrently.
+
+        Returns
+        -------
+        count : int
+            Number of files added or refreshed.
+        """
+        self.unreadable = {}
+        stale = []
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError as error:
+                self.unreadable[filename] = error
+                continue
+            record = self._conn.execute(
+                "SELECT size, mtime_ns FROM frames WHERE path = ?", (filename,)
+            ).fetchone()
+            if record is None or record != (stat.st_size, stat.st_mtime_ns):
+                stale.append((filename, stat))
+
+        def read(item):
+            filename, stat = item
+            try:
+                header = read_compref_header(
+                    filename, gzipped=filename.endswith("gz")
+                )
+            except (ValueError, OSError, EOFError) as error:
+                self.unreadable[filename] = error
+                return None
+            return (
+                filename, _to_seconds(header.time), stat.st_size, stat.st_mtime_ns,
+                header.nx, header.ny, header.nz, header.nradar,
+                " ".join(header.mosradar),
+            )
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            rows = [row for row in executor.map(read, stale) if row is not None]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.executemany(
+                "DELETE FROM frames WHERE path = ?", [(fn,) for fn in self.unreadable]
+            )
+        return len(rows)
+
+    def remove(self, filenames):
+        """
+        Remove files from the catalog.
+
+        Parameters
+        ----------
+        filenames : list of str
+        """
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM frames WHERE path = ?", [(fn,) for fn in filenames]
+            )
+
+    def update(self, root_path=None, num_workers=4):
+        """
+        Scan the archive and bring the catalog up to date.
+
+        The directories whose modification time did not change since the last
+        update are not listed again, so an update after a few new downloads
+        only lists the directories that received them.
+
+        Parameters
+        ----------
+        root_path : str, optional
+            Root directory of the archive, by default the one of the catalog.
+        num_workers : int
+            Number of headers read concurrently.
+
+        Returns
+        -------
+        added, removed : int
+            Number of files added (or refreshed) and removed.
+        """
+        if root_path is None:
+            root_path = self.root_path
+        if root_path is None:
+            raise ValueError("No root_path to scan")
+        root_path = os.path.normpath(root_path)
+
+        directories = {
+            path: (parent, mtime_ns)
+            for path, parent, mtime_ns in self._conn.execute(
+                "SELECT path, parent, mtime_ns FROM directories"
+            )
+        }
+        children = {}
+        for path, (parent, _) in directories.items():
+            children.setdefault(parent, []).append(path)
+
+        seen_dirs = {}
+        changed = []  # (directory, files found in it)
+        stack = [(root_path, None)]
+        while stack:
+            directory, parent = stack.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen_dirs[directory] = (parent, mtime_ns)
+            record = directories.get(directory)
+            if record is not None and record[1] == mtime_ns:
+                stack.extend((sub, directory) for sub in children.get(directory, ()))
+                continue
+            files = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append((entry.path, directory))
+                    elif entry.name.endswith("." + self.fn_ext):
+                        files.append(entry.path)
+            changed.append((directory, files))
+
+        removed = []
+        found = []
+        for directory, files in changed:
+            files_set = set(files)
+            removed.extend(
+                path for (path,) in self._conn.execute(
+                    "SELECT path FROM frames WHERE path > ? AND path < ?",
+                    (directory + os.sep, directory + chr(ord(os.sep) + 1)),
+                )
+                if os.path.dirname(path) == directory and path not in files_set
+            )
+            found.extend(files)
+        for directory in set(directories) - set(seen_dirs):
+            removed.extend(
+                path for (path,) in self._conn.execute(
+                    "SELECT path FROM frames WHERE path > ? AND path < ?",
+                    (directory + os.sep, directory + chr(ord(os.sep) + 1)),
+                )
+                if os.path.dirname(path) == directory
+            )
+
+        self.remove(removed)
+        added = self.add(found, num_workers=num_workers)
+        # The directories with unreadable files are listed again next time.
+        for path in self.unreadable:
+            directory = os.path.dirname(path)
+            if directory in seen_dirs:
+                seen_dirs[directory] = (seen_dirs[directory][0], -1)
+        with self._conn:
+            self._conn.execute("DELETE FROM directories")
+            self._conn.executemany(
+                "INSERT INTO directories VALUES (?, ?, ?)",
+                [(path, parent, mtime) for path, (parent, mtime) in seen_dirs.items()],
+            )
+        return added, len(removed)
+
+    # Queries
+    # ~~~~~~~
+
+    def frames(self, start, end):
+        """
+        Files of the frames between two times.
+
+        Parameters
+        ----------
+        start, end : datetime
+            First and last time of the period, both included (UTC).
+
+        Returns
+        -------
+        entries : list of CatalogEntry
+            Sorted by time.
+        """
+        return [
+            _entry(row)
+            for row in self._conn.execute(
+                "SELECT %s FROM frames WHERE time BETWEEN ? AND ? ORDER BY time, path"
+                % _COLUMNS,
+                (_to_seconds(start), _to_seconds(end)),
+            )
+        ]
+
+    def nearest(self, time, tolerance=None):
+        """
+        File of the frame closest to a time.
+
+        Parameters
+        ----------
+        time : datetime
+            Time of the frame (UTC).
+        tolerance : timedelta, optional
+            Maximum time difference.
+
+        Returns
+        -------
+        entry : CatalogEntry or None
+            None if the catalog has no frame within the tolerance.
+        """
+        seconds = _to_seconds(time)
+        candidates = []
+        for query in (
+            "SELECT %s FROM frames WHERE time <= ? ORDER BY time DESC LIMIT 1",
+            "SELECT %s FROM frames WHERE time > ? ORDER BY time ASC LIMIT 1",
+        ):
+            row = self._conn.execute(query % _COLUMNS, (seconds,)).fetchone()
+            if row is not None:
+                candidates.append(row)
+        if not candidates:
+            return None
+        row = min(candidates, key=lambda row: abs(row[0] - seconds))
+        if tolerance is not None and abs(row[0] - seconds) > tolerance.total_seconds():
+            return None
+        return _entry(row)
+
+    def gaps(self, start, end, timestep=10):
+        """
+        Periods without frames.
+
+        Parameters
+        ----------
+        start, end : datetime
+            First and last time of the period, both included (UTC).
+        timestep : int
+            Expected time step between the frames, in minutes.
+
+        Returns
+        -------
+        gaps : list of tuple
+            (first, last) missing times of every gap, both included.
+        """
+        step = timestep * 60
+        t0 = _to_seconds(start)
+        t1 = _to_seconds(end)
+        times = [t0 - step]
+        times.extend(
+            time for (time,) in self._conn.execute(
+                "SELECT DISTINCT time FROM frames WHERE time BETWEEN ? AND ? "
+                "ORDER BY time",
+                (t0, t1),
+            )
+        )
+        times.append(t1 + step)
+        return [
+            (_from_seconds(previous + step), _from_seconds(time - step))
+            for previous, time in zip(times[:-1], times[1:])
+            if time - previous > step
+        ]
+
+    def find(self, start, end, timestep=10):
+        """
+        List the files between two dates, like `find_cwb_compref`.
+
+        Parameters
+        ----------
+        start, end : datetime
+            First and last time of the period, both included (UTC).
+        timestep : int
+            Time step between the files, in minutes.
+
+        Returns
+        -------
+        out : tuple
+            Two lists (filenames, timestamps), as returned by
+            `pysteps.io.archive.find_by_date`. Missing files are set to None.
+        """
+        paths = {}
+        for entry in self.frames(start, end):
+            paths.setdefault(entry.time, entry.path)
+        filenames = []
+        timestamps = []
+        t = start
+        while t <= end:
+            filenames.append(paths.get(t))
+            timestamps.append(t)
+            t += timedelta(minutes=timestep)
+        return filenames, timestamps
@@ -0,0 +1,738 @@
+# -*- coding: utf-8 -*-
+"""
+Low-level access to the CWB COMPREF binary format.
+
+A COMPREF file is a variable length header followed by the int16 payload of
+``nz * ny * nx`` scaled values. The header layout is described by a single
+structured dtype (see :func:`compref_header_dtype`), whose size depends only on
+the number of levels ``nz`` and on the number of contributing radars ``nradar``.
+
+The functions in this module only read the bytes they need: the header can be
+parsed without decompressing the payload, and the payload of uncompressed files
+can be memory-mapped as a zero-copy int16 view. The inverse operations,
+`encode_compref` and `compress_compref`, write a file into a single buffer and
+compress it, optionally as a multi-member gzip stream compressed in parallel.
+"""
+
+# Import the needed libraries
+import contextlib
+import gzip
+import io
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+from pysteps_importer_cwb import instrument
+from pysteps_importer_cwb.utils import write_atomic
+
+# Values below this threshold, in dBZ, have no value (-999).
+NO_VALUE_DBZ = -990
+# Value of the clear sky pixels, in dBZ.
+CLEAR_SKY_DBZ = -99.0
+
+# Default size in bytes of the chunks used when decoding the payload.
+CHUNK_SIZE = 1 << 18
+
+# Fixed part of the header, up to the level heights ``zht``.
+_HEAD_FIELDS = [
+    ("yyyy", "<i4"),
+    ("mm", "<i4"),
+    ("dd", "<i4"),
+    ("hh", "<i4"),
+    ("mn", "<i4"),
+    ("ss", "<i4"),
+    ("nx", "<i4"),
+    ("ny", "<i4"),
+    ("nz", "<i4"),
+    ("proj", "S4"),
+    ("map_scale", "<i4"),
+    ("projlat0", "<i4"),
+    ("projlat1", "<i4"),
+    ("projlon", "<i4"),
+    ("alon", "<i4"),
+    ("alat", "<i4"),
+    ("xy_scale", "<i4"),
+    ("dx", "<i4"),
+    ("dy", "<i4"),
+    ("dxy_scale", "<i4"),
+]
+
+# Fixed part of the header between ``zht`` and the radar list ``mosradar``.
+_MID_FIELDS = [
+    ("z_scale", "<i4"),
+    ("i_bb_mode", "<i4"),
+    ("unkn01", "<i4", (9,)),
+    ("varname1", "S4"),
+    ("varname2", "<i4", (4,)),
+    ("varunit", "S3"),
+    ("unkn02", "S3"),
+    ("var_scale", "<i4"),
+    ("missing", "<i4"),
+    ("nradar", "<i4"),
+]
+
+_HEAD_DTYPE = np.dtype(_HEAD_FIELDS)
+_MID_DTYPE = np.dtype(_MID_FIELDS)
+
+CompRefHeader = namedtuple(
+    "CompRefHeader",
+    [
+        "time",
+        "nx",
+        "ny",
+        "nz",
+        "proj",
+        "map_scale",
+        "projlat0",
+        "projlat1",
+        "projlon",
+        "alon",
+        "alat",
+        "xy_scale",
+        "dx",
+        "dy",
+        "dxy_scale",
+        "zht",
+        "z_scale",
+        "i_bb_mode",
+        "unkn01",
+        "varname1",
+        "varname2",
+        "varunit",
+        "unkn02",
+        "var_scale",
+        "missing",
+        "nradar",
+        "mosradar",
+        "data_offset",
+    ],
+)
+CompRefHeader.__doc__ = """\
+Parsed COMPREF header.
+
+Integer fields keep the scaled values stored in the file (e.g. ``alon`` must be
+divided by ``xy_scale``). String fields are decoded to ``str``, ``zht``,
+``unkn01``, ``varname2`` and ``mosradar`` are tuples, and ``data_offset`` is the
+byte offset of the int16 payload in the uncompressed stream.
+"""
+
+
+@lru_cache(maxsize=None)
+def compref_header_dtype(nz, nradar):
+    """
+    Structured dtype of a complete COMPREF header.
+
+    Parameters
+    ----------
+    nz : int
+        Number of vertical levels.
+    nradar : int
+        Number of radars contributing to the mosaic.
+
+    Returns
+    -------
+    dtype : numpy.dtype
+        Packed dtype whose ``itemsize`` is the offset of the data payload.
+    """
+    return np.dtype(
+        _HEAD_FIELDS
+        + [("zht", "<i4", (nz,))]
+        + _MID_FIELDS
+        + [("mosradar", "S4", (nradar,))]
+    )
+
+
+def _decode(value):
+    return value.decode("latin-1").strip("\x00 ")
+
+
+def parse_compref_header(buf):
+    """
+    Parse a COMPREF header from the beginning of a bytes-like object.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer starting with the header. Any trailing payload bytes are ignored.
+
+    Returns
+    -------
+    header : CompRefHeader
+    """
+    nz = int(np.frombuffer(buf, dtype=_HEAD_DTYPE, count=1)[0]["nz"])
+    mid_offset = _HEAD_DTYPE.itemsize + 4 * nz
+    nradar = int(
+        np.frombuffer(buf, dtype=_MID_DTYPE, count=1, offset=mid_offset)[0]["nradar"]
+    )
+    header_dtype = compref_header_dtype(nz, nradar)
+    rec = np.frombuffer(buf, dtype=header_dtype, count=1)[0]
+
+    return CompRefHeader(
+        time=datetime(
+            int(rec["yyyy"]),
+            int(rec["mm"]),
+            int(rec["dd"]),
+            int(rec["hh"]),
+            int(rec["mn"]),
+            int(rec["ss"]),
+        ),
+        nx=int(rec["nx"]),
+        ny=int(rec["ny"]),
+        nz=nz,
+        proj=_decode(rec["proj"]),
+        map_scale=int(rec["map_scale"]),
+        projlat0=int(rec["projlat0"]),
+        projlat1=int(rec["projlat1"]),
+        projlon=int(rec["projlon"]),
+        alon=int(rec["alon"]),
+        alat=int(rec["alat"]),
+        xy_scale=int(rec["xy_scale"]),
+        dx=int(rec["dx"]),
+        dy=int(rec["dy"]),
+        dxy_scale=int(rec["dxy_scale"]),
+        zht=tuple(int(z) for z in rec["zht"]),
+        z_scale=int(rec["z_scale"]),
+        i_bb_mode=int(rec["i_bb_mode"]),
+        unkn01=tuple(int(v) for v in rec["unkn01"]),
+        varname1=_decode(rec["varname1"]),
+        varname2=tuple(int(v) for v in rec["varname2"]),
+        varunit=_decode(rec["varunit"]),
+        unkn02=_decode(rec["unkn02"]),
+        var_scale=int(rec["var_scale"]),
+        missing=int(rec["missing"]),
+        nradar=nradar,
+        mosradar=tuple(_decode(r) for r in rec["mosradar"]),
+        data_offset=header_dtype.itemsize,
+    )
+
+
+def _read_exactly(fid, size):
+    buf = fid.read(size)
+    if len(buf) != size:
+        raise ValueError("Truncated COMPREF header in %s" % getattr(fid, "name", fid))
+    return buf
+
+
+def _read_header(fid):
+    """Read the header from an open file object, leaving it at the payload."""
+    buf = _read_exactly(fid, _HEAD_DTYPE.itemsize)
+    nz = int(np.frombuffer(buf, dtype=_HEAD_DTYPE, count=1)[0]["nz"])
+    buf += _read_exactly(fid, 4 * nz + _MID_DTYPE.itemsize)
+    mid_offset = _HEAD_DTYPE.itemsize + 4 * nz
+    nradar = int(
+        np.frombuffer(buf, dtype=_MID_DTYPE, count=1, offset=mid_offset)[0]["nradar"]
+    )
+    buf += _read_exactly(fid, 4 * nradar)
+    return parse_compref_header(buf)
+
+
+def _is_buffer(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+def _open(filename, gzipped):
+    if _is_buffer(filename):
+        if gzipped:
+            return gzip.GzipFile(fileobj=io.BytesIO(filename), mode="rb")
+        # Parsed in place.
+        return contextlib.nullcontext()
+    if gzipped:
+        return gzip.open(filename, "rb")
+    return open(filename, mode="rb")
+
+
+def _payload_array(source, header):
+    """(nz, ny, nx) int16 payload of an uncompressed file or buffer."""
+    if _is_buffer(source):
+        return np.frombuffer(
+            source,
+            dtype="<i2",
+            count=header.nz * header.ny * header.nx,
+            offset=header.data_offset,
+        ).reshape(header.nz, header.ny, header.nx)
+    return memmap_compref(source, header)
+
+
+def read_compref_header(filename, gzipped=False):
+    """
+    Read only the header of a COMPREF file.
+
+    For gzipped files only the first few hundred bytes are decompressed, which
+    makes this function suitable for scanning large archives for timestamps and
+    grid geometry.
+
+    Parameters
+    ----------
+    filename : str or bytes-like
+        Name of the file to read, or content of the file.
+    gzipped : bool
+        Whether the file is gzip compressed.
+
+    Returns
+    -------
+    header : CompRefHeader
+    """
+    with _open(filename, gzipped) as fid:
+        if fid is None:
+            return parse_compref_header(filename)
+        return _read_header(fid)
+
+
+def memmap_compref(filename, header=None):
+    """
+    Memory-map the int16 payload of an uncompressed COMPREF file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the uncompressed file.
+    header : CompRefHeader, optional
+        Header of the file, if already known.
+
+    Returns
+    -------
+    payload : numpy.memmap
+        Read-only int16 view of shape (nz, ny, nx). No data is read from disk
+        until the view is accessed.
+    """
+    if header is None:
+        header = read_compref_header(filename)
+    return np.memmap(
+        filename,
+        dtype="<i2",
+        mode="r",
+        offset=header.data_offset,
+        shape=(header.nz, header.ny, header.nx),
+    )
+
+
+def level_indices(header, levels=None):
+    """
+    Indices of the selected levels of a COMPREF file.
+
+    Parameters
+    ----------
+    header : CompRefHeader
+        Header of the file.
+    levels : int, slice or sequence of int, optional
+        Selected levels, indices into ``header.zht``. Negative indices count
+        from the top level. By default all the levels are selected.
+
+    Returns
+    -------
+    indices : list of int
+        Non-negative indices of the selected levels, in the requested order.
+    squeeze : bool
+        Whether the level axis is dropped from the decoded field: for a single
+        integer level, or by default for single level files.
+    """
+    if levels is None:
+        return list(range(header.nz)), header.nz == 1
+    if isinstance(levels, slice):
+        return list(range(*levels.indices(header.nz))), False
+    squeeze = np.ndim(levels) == 0
+    indices = []
+    for k in np.atleast_1d(levels):
+        k = int(k)
+        if not -header.nz <= k < header.nz:
+            raise IndexError(
+                "Level %d is out of range for a file with %d levels" % (k, header.nz)
+            )
+        indices.append(k % header.nz)
+    return indices, squeeze
+
+
+def _payload_shape(header, window=None, levels=None, colmax=False):
+    ny, nx = header.ny, header.nx
+    if window is not None:
+        rows, cols = window
+        ny = len(range(*rows.indices(header.ny)))
+        nx = len(range(*cols.indices(header.nx)))
+    indices, squeeze = level_indices(header, levels)
+    if colmax:
+        if not indices:
+            raise ValueError("The column maximum needs at least one level")
+        return (ny, nx)
+    if squeeze:
+        return (ny, nx)
+    return (len(indices), ny, nx)
+
+
+def _readinto(fid, buf):
+    """Fill ``buf`` from ``fid``, without an intermediate bytes object."""
+    view = memoryview(buf).cast("B")
+    pos = 0
+    while pos < len(view):
+        nbytes = fid.readinto(view[pos:])
+        if not nbytes:
+            raise ValueError(
+                "Truncated COMPREF payload in %s" % getattr(fid, "name", fid)
+            )
+        pos += nbytes
+
+
+@lru_cache(maxsize=16)
+def rainrate_lut(zr_a, zr_b, var_scale, threshold=0.0, dtype="double"):
+    """
+    Lookup table from the raw int16 values to rain rates.
+
+    The table has one entry for each of the 65536 int16 values, indexed by the
+    raw values viewed as uint16 (``lut[raw.view("<u2")]``). Each entry follows
+    the conversion of `pysteps.utils.conversion.to_rainrate`: the reflectivity
+    Z = 10 ** (dBZ / 10) is set to zero below ``threshold`` (which includes
+    the clear sky pixels), then converted with Z = zr_a * R ** zr_b. The
+    pixels without value (below NO_VALUE_DBZ) are set to NaN.
+
+    Parameters
+    ----------
+    zr_a, zr_b : float
+        Coefficients of the Z-R relationship.
+    var_scale : int
+        Scale of the raw values (dBZ = raw / var_scale).
+    threshold : float
+        Reflectivity threshold in dBZ.
+    dtype : str
+        Floating point data type of the table.
+
+    Returns
+    -------
+    lut : 1D array
+        Read-only table of 65536 rain rates in mm/h, shared by all the callers.
+    """
+    raw = np.arange(65536, dtype="<u2").view("<i2")
+    dbz = raw / float(var_scale)
+    # The largest raw values are not physical and overflow to inf.
+    with np.errstate(over="ignore", under="ignore"):
+        zeta = 10.0 ** (dbz / 10.0)
+        zeta[zeta < 10.0 ** (threshold / 10.0)] = 0.0
+        lut = (zeta / zr_a) ** (1.0 / zr_b)
+        lut[dbz < NO_VALUE_DBZ] = np.nan
+        lut = lut.astype(dtype)
+    lut.flags.writeable = False
+    return lut
+
+
+def decode_compref(filename, gzipped=False, out=None, dtype="double",
+                   window=None, chunk_size=CHUNK_SIZE, lut=None, levels=None,
+                   colmax=False):
+    """
+    Decode a COMPREF file into a reflectivity field.
+
+    The payload is decompressed in chunks of rows and each chunk is scaled
+    directly into the output array, so the peak memory is the output array plus
+    one chunk, with no full-size temporaries.
+
+    With a floating point output the values are in dBZ, values below
+    NO_VALUE_DBZ (-999 = No Value) are set to NaN and clear sky pixels keep the
+    value CLEAR_SKY_DBZ (-99). With an integer output the raw scaled values are
+    copied unchanged (dBZ = raw / header.var_scale).
+
+    Parameters
+    ----------
+    filename : str or bytes-like
+        Name of the file to read, or content of the file (e.g. a frame of a
+        packed archive). Uncompressed contents are decoded in place.
+    gzipped : bool
+        Whether the file is gzip compressed.
+    out : ndarray, optional
+        Array of shape (ny, nx), or (nlevels, ny, nx) for multi-level files,
+        where the field (or the window) is written. It can be a view into a
+        larger array, e.g. one time step of a preallocated stack.
+    dtype : str
+        Data type of the array allocated when ``out`` is not given, e.g.
+        "double", "float32" or "int16".
+    window : tuple of slices, optional
+        (rows, cols) ranges of the grid to decode. Decompression stops after
+        the last row of the window, and uncompressed files are only read within
+        the rows of the window.
+    chunk_size : int
+        Approximate size in bytes of the decompressed chunks.
+    lut : 1D array, optional
+        Table of 65536 values, indexed by the raw values viewed as uint16 (see
+        `rainrate_lut`). The field is then ``lut[raw]``, computed by a single
+        gather instead of the scaling and masking.
+    levels : int, slice or sequence of int, optional
+        Levels of a multi-level file to decode, see `level_indices`. The other
+        levels are skipped: uncompressed files are not read outside of the
+        selected levels, and the decompression of gzipped files stops after
+        the last one. A single integer level gives a (ny, nx) field.
+    colmax : bool
+        If True, return the (ny, nx) column maximum of the selected levels,
+        computed in a single pass over the payload. The pixels without value
+        in all the levels keep no value.
+
+    Returns
+    -------
+    out : ndarray
+        The decoded field.
+    header : CompRefHeader
+        Header of the file.
+    """
+    timer = instrument.timer()
+    with _open(filename, gzipped) as fid:
+        header = parse_compref_header(filename) if fid is None else _read_header(fid)
+        if timer is not None:
+            timer.lap("header", header.data_offset)
+        if window is None:
+            window = (slice(None), slice(None))
+        rows, cols = window
+        r0, r1, rstep = rows.indices(header.ny)
+        if rstep != 1 or cols.indices(header.nx)[2] != 1:
+            raise ValueError("Only windows with unit steps are supported")
+
+        shape = _payload_shape(header, window, levels, colmax)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(
+                "Output array has shape %s, but %s has shape %s"
+                % (out.shape, "buffer" if _is_buffer(filename) else filename, shape)
+            )
+        if lut is not None and lut.dtype != out.dtype:
+            lut = lut.astype(out.dtype)
+
+        indices, _ = level_indices(header, levels)
+        if colmax:
+            # The raw values are ordered as the dBZ and the rain rates, and
+            # the pixels without value have the smallest ones: the maximum is
+            # computed on the raw values, and scaled once.
+            in_place = out.dtype == np.dtype("<i2") and lut is None
+            if in_place:
+                planes = out[None]
+            else:
+                planes = np.empty((1,) + shape, dtype="<i2")
+            planes[0] = np.iinfo("<i2").min
+        else:
+            planes = out.reshape((len(indices),) + shape[-2:])
+            if not np.may_share_memory(planes, out):
+                raise ValueError("The output array must be C-contiguous by rows")
+
+        nrows = r1 - r0
+        row_bytes = 2 * header.nx
+        chunk_rows = max(1, min(nrows, chunk_size // row_bytes))
+
+        if gzipped:
+            chunk = np.empty((chunk_rows, header.nx), dtype="<i2")
+        else:
+            payload = _payload_array(filename, header)
+
+        # Gzipped streams are read forward: the levels are decoded in order.
+        order = sorted(range(len(indices)), key=indices.__getitem__)
+        previous = None
+        for j in order:
+            k = indices[j]
+            dest = planes[0 if colmax else j]
+            if previous is not None and indices[previous] == k:
+                # Level requested twice.
+                if not colmax:
+                    dest[...] = planes[previous]
+                continue
+            previous = j
+            if gzipped:
+                # Seeking forward decompresses and discards the skipped rows.
+                position = header.data_offset + (k * header.ny + r0) * row_bytes
+                if timer is not None:
+                    skipped = position - fid.tell()
+                fid.seek(position)
+                if timer is not None:
+                    timer.lap("gunzip", skipped)
+            for start in range(0, nrows, chunk_rows):
+                stop = min(nrows, start + chunk_rows)
+                if gzipped:
+                    raw = chunk[: stop - start]
+                    _readinto(fid, raw)
+                    if timer is not None:
+                        timer.lap("gunzip", raw.nbytes)
+                else:
+                    raw = payload[k, r0 + start : r0 + stop]
+                if colmax:
+                    np.maximum(dest[start:stop], raw[:, cols], out=dest[start:stop])
+                    if timer is not None:
+                        timer.lap("colmax")
+                elif lut is not None:
+                    # All the uint16 indices are valid, so "clip" only skips
+                    # the bounds check and the buffering of "raise".
+                    np.take(
+                        lut, raw[:, cols].view("<u2"), out=dest[start:stop],
+                        mode="clip",
+                    )
+                    if timer is not None:
+                        timer.lap("lut")
+                else:
+                    _scale_rows(
+                        raw[:, cols], dest[start:stop], header.var_scale, timer
+                    )
+
+    if colmax and not in_place:
+        if timer is not None:
+            timer.skip()
+        if lut is not None:
+            np.take(lut, planes[0].view("<u2"), out=out, mode="clip")
+            if timer is not None:
+                timer.lap("lut")
+        else:
+            _scale_rows(planes[0], out, header.var_scale, timer)
+    return out, header
+
+
+def _scale_rows(raw, out, var_scale, timer=None):
+    if out.dtype.kind in "iu":
+        np.copyto(out, raw, casting="unsafe")
+        if timer is not None:
+            timer.lap("scale")
+        return
+    np.divide(raw, out.dtype.type(var_scale), out=out, dtype=out.dtype)
+    if timer is not None:
+        timer.lap("scale")
+    out[out < NO_VALUE_DBZ] = np.nan
+    if timer is not None:
+        timer.lap("mask")
+
+
+def _encode_header(rec, header, nz, nradar):
+    """Fill the structured record ``rec`` with the fields of ``header``."""
+    t = header.time
+    for name, value in zip(
+        ("yyyy", "mm", "dd", "hh", "mn", "ss"),
+        (t.year, t.month, t.day, t.hour, t.minute, t.second),
+    ):
+        rec[name] = value
+    rec["nx"] = header.nx
+    rec["ny"] = header.ny
+    rec["nz"] = nz
+    for name in ("proj", "varname1", "varunit", "unkn02"):
+        rec[name] = getattr(header, name).encode("latin-1")
+    for name in (
+        "map_scale", "projlat0", "projlat1", "projlon", "alon", "alat", "xy_scale",
+        "dx", "dy", "dxy_scale", "z_scale", "i_bb_mode", "var_scale", "missing",
+    ):
+        rec[name] = getattr(header, name)
+    rec["zht"] = header.zht
+    rec["unkn01"] = header.unkn01
+    rec["varname2"] = header.varname2
+    rec["nradar"] = nradar
+    rec["mosradar"] = [r.encode("latin-1") for r in header.mosradar]
+
+
+def encode_compref(header, data, out=None):
+    """
+    Encode a COMPREF file, the inverse of `parse_compref_header` and the decoding.
+
+    The header and the payload are written directly into a single buffer,
+    without intermediate bytes objects.
+
+    Parameters
+    ----------
+    header : CompRefHeader
+        Header of the file. ``nz`` and ``nradar`` are taken from ``zht`` and
+        ``mosradar``, and ``data_offset`` is ignored.
+    data : array
+        Raw scaled values (dBZ * var_scale) of shape (ny, nx) or (nz, ny, nx),
+        converted to little-endian int16.
+    out : writable buffer, optional
+        Buffer of at least the size of the file where it is encoded, e.g. a
+        bytearray reused between frames.
+
+    Returns
+    -------
+    buf : memoryview
+        The bytes of the file (a view of ``out`` when it is given).
+    """
+    nz = len(header.zht)
+    nradar = len(header.mosradar)
+    shape = (nz, header.ny, header.nx)
+    if np.size(data) != nz * header.ny * header.nx:
+        raise ValueError(
+            "Data of shape %s for a %d*%d*%d grid"
+            % (np.shape(data), nz, header.ny, header.nx)
+        )
+    header_dtype = compref_header_dtype(nz, nradar)
+    size = header_dtype.itemsize + 2 * nz * header.ny * header.nx
+    if out is None:
+        out = bytearray(size)
+    buf = memoryview(out).cast("B")[:size]
+    if len(buf) < size:
+        raise ValueError("Output buffer of %d bytes, %d needed" % (len(buf), size))
+
+    rec = np.frombuffer(buf, dtype=header_dtype, count=1)
+    rec[...] = 0
+    _encode_header(rec[0], header, nz, nradar)
+    payload = np.frombuffer(buf, dtype="<i2", offset=header_dtype.itemsize)
+    np.copyto(payload.reshape(shape), np.reshape(data, shape), casting="unsafe")
+    return buf
+
+
+def compress_compref(buf, compresslevel=6, num_workers=1, block_size=1 << 18):
+    """
+    Gzip compress an encoded COMPREF file.
+
+    With several workers the buffer is split into blocks compressed in
+    parallel (zlib releases the GIL), each one as a gzip member. The
+    concatenated members form a standard multi-member gzip file, read
+    transparently by `gzip`, gunzip and the importers of this module.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Encoded file, e.g. from `encode_compref`.
+    compresslevel : int
+        Compression level, from 1 (fastest) to 9 (smallest).
+    num_workers : int
+        Number of compression threads.
+    block_size : int
+        Size of the uncompressed blocks of the parallel compression.
+
+    Returns
+    -------
+    data : bytes
+    """
+    buf = memoryview(buf).cast("B")
+    if num_workers <= 1 or len(buf) <= block_size:
+        return gzip.compress(buf, compresslevel=compresslevel)
+    blocks = [buf[i : i + block_size] for i in range(0, len(buf), block_size)]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        members = executor.map(
+            lambda block: gzip.compress(block, compresslevel=compresslevel), blocks
+        )
+        return b"".join(members)
+
+
+def write_compref(filename, header, data, gzipped=None, compresslevel=6,
+                  num_workers=1):
+    """
+    Write a COMPREF file.
+
+    The file is written through a temporary file renamed in place, so readers
+    never see a partial file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file.
+    header : CompRefHeader
+        Header of the file, see `encode_compref`.
+    data : array
+        Raw scaled values of shape (ny, nx) or (nz, ny, nx).
+    gzipped : bool, optional
+        Whether to gzip compress the file, by default if the file name ends
+        with ".gz".
+    compresslevel, num_workers
+        Compression options, see `compress_compref`.
+
+    Returns
+    -------
+    filename : str
+    """
+    if gzipped is None:
+        gzipped = filename.endswith(".gz")
+    buf = encode_compref(header, data)
+    if gzipped:
+        buf = compress_compref(
+            buf, compresslevel=compresslevel, num_workers=num_workers
+        )
+    write_atomic(filename, buf)
+    return filename
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Coverage of the COMPREF mosaics by their contributing radars.
+
+The header of a COMPREF file lists the radars contributing to the mosaic
+(``mosradar``), but the file has no quality field. The coverage field counts,
+for every pixel, the contributing radars within range of the pixel: 0 out of
+the coverage of the mosaic, 1 where a single radar sees the pixel, and more
+where the radars overlap. It is a compact (uint8) quality input for pysteps,
+e.g. to weight or mask the pixels far from the radars.
+
+The mosaics of consecutive frames are made by the same radars, so the field is
+computed once per grid and combination of radars, and cached.
+"""
+
+# Import the needed libraries
+from functools import lru_cache
+
+import numpy as np
+
+# Approximate position (longitude, latitude in degrees) and range (m) of the
+# radars of the CWB mosaics. The S-band radars of the CWB (RCWF, RCHL, RCCG,
+# RCKT) have a longer range than the C-band gap-filling radars.
+RADAR_SITES = {
+    "RCWF": (121.773, 25.073, 230e3),
+    "RCHL": (121.620, 23.991, 230e3),
+    "RCCG": (120.086, 23.147, 230e3),
+    "RCKT": (120.848, 21.900, 230e3),
+    "RCSL": (121.402, 24.999, 150e3),
+    "RCNT": (120.587, 24.143, 150e3),
+    "RCLY": (120.386, 22.527, 150e3),
+    "RCMK": (119.629, 23.565, 150e3),
+    "RCCK": (120.626, 24.262, 150e3),
+    "RCGI": (121.477, 22.651, 150e3),
+    "ISHI": (124.179, 24.426, 230e3),
+}
+
+_EARTH_RADIUS = 6371e3
+
+
+def _distance(lons, lats, lon0, lat0):
+    """Great circle distance in meters from (lon0, lat0), in degrees."""
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    lon0 = np.radians(lon0)
+    lat0 = np.radians(lat0)
+    a = (
+        np.sin((lats - lat0) / 2) ** 2
+        + np.cos(lat0) * np.cos(lats) * np.sin((lons - lon0) / 2) ** 2
+    )
+    return 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+@lru_cache(maxsize=16)
+def _coverage(lon_min, lat_min, dlon, dlat, nx, ny, mosradar, max_range):
+    lons = lon_min + dlon * np.arange(nx)
+    lats = lat_min + dlat * np.arange(ny)
+    counts = np.zeros((ny, nx), dtype="uint8")
+    for code in mosradar:
+        if code not in RADAR_SITES:
+            continue
+        lon0, lat0, radar_range = RADAR_SITES[code]
+        if max_range is not None:
+            radar_range = max_range
+        # Only the rows and columns within range of the radar are computed.
+        dlat_max = np.degrees(radar_range / _EARTH_RADIUS)
+        rows = slice(
+            *np.searchsorted(lats, [lat0 - dlat_max, lat0 + dlat_max], side="left")
+        )
+        lat_far = min(abs(lat0) + dlat_max, 89.0)
+        dlon_max = dlat_max / np.cos(np.radians(lat_far))
+        cols = slice(
+            *np.searchsorted(lons, [lon0 - dlon_max, lon0 + dlon_max], side="left")
+        )
+        if rows.start == rows.stop or cols.start == cols.stop:
+            continue
+        distance = _distance(lons[None, cols], lats[rows, None], lon0, lat0)
+        counts[rows, cols] += distance <= radar_range
+    counts.flags.writeable = False
+    return counts
+
+
+def coverage_field(geometry, mosradar, max_range=None):
+    """
+    Number of contributing radars within range of every pixel.
+
+    Parameters
+    ----------
+    geometry : GridGeometry
+        Geometry of the grid, see `pysteps_importer_cwb.geometry`.
+    mosradar : sequence of str
+        Codes of the contributing radars, as in the header of the files.
+        Radars missing from `RADAR_SITES` are ignored.
+    max_range : float, optional
+        Range of all the radars, in meters, instead of the ranges of
+        `RADAR_SITES`.
+
+    Returns
+    -------
+    coverage : 2D array
+        Read-only uint8 array of shape (ny, nx), shared by the calls with the
+        same grid, radars and range.
+    """
+    return _coverage(
+        geometry.lon_min, geometry.lat_min, geometry.dlon, geometry.dlat,
+        geometry.nx, geometry.ny, tuple(mosradar), max_range,
+    )
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy (t, y, x) view of a COMPREF archive.
+
+Climatologies and verifications over months of frames do not fit in memory.
+A `CompRefDataset` behaves like a read-only 3D array of the frames of an
+archive, but it only reads the geometry of the first frame when it is opened:
+the frames are decoded when they are sliced, and only within the requested
+rows. Reductions over the time axis (`CompRefDataset.mean`,
+`CompRefDataset.count_exceeding`) stream through the archive by chunks of
+frames, with a bounded memory.
+
+The frames are decoded by `read_cwb_compref`, with the options of the pysteps
+importer, so the values are the same as those of `importer_cwb_compref_cwb`.
+The dataset can also be wrapped in a dask array or an xarray DataArray, if
+these packages are installed. pysteps, dask, xarray and the resampling
+(pyproj) are imported on first use, as in the importer module.
+
+Examples
+--------
+>>> ds = open_archive_cwb_compref(start, end, root_path="./radar/cwb_opendata")
+>>> ds.shape
+(4320, 881, 921)
+>>> frame = ds[-1]                    # decodes one frame
+>>> north = ds[:, 600:, 300:500]      # decodes the rows 600 to 880 only
+>>> frequency = ds.count_exceeding(35.0) / len(ds)
+"""
+
+# Import the needed libraries
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pysteps_importer_cwb.compref import _payload_shape, read_compref_header
+from pysteps_importer_cwb.geometry import grid_geometry, roi_window
+from pysteps_importer_cwb.importer_cwb_compref import (
+    ZR_A,
+    ZR_B,
+    _compref_metadata,
+    find_cwb_compref,
+    read_cwb_compref,
+)
+
+# Default number of frames decoded at once by the reductions.
+CHUNK_SIZE = 16
+
+
+class CompRefDataset(object):
+    """
+    Lazy 3D array of COMPREF frames, with dimensions (t, y, x).
+
+    Indexing follows numpy for each axis (integers, slices, integer or
+    boolean arrays), but the index arrays of different axes select their
+    outer product, as in xarray. The result is a numpy array.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Names of the files of the frames. Missing files (None) give frames
+        filled with NaN, or with the raw missing value for integer data types.
+    timestamps : list of datetime, optional
+        Times of the frames. By default they are read from the headers of the
+        files when `times` is first needed.
+    gzipped : bool
+        Whether the files are gzip compressed.
+    roi : tuple, optional
+        Region of interest, see `importer_cwb_compref_cwb`. It is located with
+        the grid of the first available frame.
+    dtype : str
+        Data type of the frames, see `read_cwb_compref`.
+    rainrate : bool
+        Return the rain rate in mm/h, see `importer_cwb_compref_cwb`.
+    zr_a, zr_b : float
+        Coefficients of the Z-R relationship.
+    regrid : float, optional
+        Pixel size in meters of a TWD97 grid where the frames are resampled,
+        see `importer_cwb_compref_cwb`. The frames are then decoded entirely
+        before the spatial selection.
+    regrid_method : str
+        "nearest" or "bilinear" resampling.
+    levels : int, optional
+        Level of multi-level files, see `importer_cwb_compref_cwb`.
+    colmax : bool
+        Use the column maximum of the levels of multi-level files.
+    num_workers : int
+        Number of threads decoding the frames of a selection.
+
+    Attributes
+    ----------
+    shape : tuple
+        (t, ny, nx) shape.
+    dtype : numpy.dtype
+        Data type of the frames.
+    metadata : dict
+        Metadata of the frames, as returned by the importer.
+    """
+
+    def __init__(self, filenames, timestamps=None, gzipped=False, roi=None,
+                 dtype="double", rainrate=False, zr_a=ZR_A, zr_b=ZR_B,
+                 regrid=None, regrid_method="nearest", levels=None, colmax=False,
+                 num_workers=1):
+        self.filenames = list(filenames)
+        available = [fn for fn in self.filenames if fn is not None]
+        if not available:
+            raise IOError("no input files found")
+        self._timestamps = None if timestamps is None else list(timestamps)
+        self.num_workers = num_workers
+        self.options = dict(
+            gzipped=gzipped, dtype=dtype, rainrate=rainrate, zr_a=zr_a, zr_b=zr_b,
+            regrid=regrid, regrid_method=regrid_method, levels=levels, colmax=colmax,
+        )
+
+        header = read_compref_header(available[0], gzipped=gzipped)
+        self.dtype = np.dtype(dtype)
+        self.window = roi_window(header, roi) if roi is not None else None
+        # Origin of the region of interest in the grid of the files.
+        self._origin = (0, 0)
+        if self.window is not None:
+            self._origin = (
+                self.window[0].indices(header.ny)[0],
+                self.window[1].indices(header.nx)[0],
+            )
+        raw = self.dtype.kind in "iu"
+        self.metadata = _compref_metadata(
+            header, raw=raw, window=self.window, zr=(zr_a, zr_b) if rainrate else None,
+            levels=levels, colmax=colmax,
+        )
+        self.geometry = grid_geometry(header)
+        if self.window is not None:
+            self.geometry = self.geometry.window(*self.window)
+        self._table = None
+        frame_shape = _payload_shape(header, self.window, levels, colmax)
+        if len(frame_shape) != 2:
+            raise ValueError(
+                "The frames of multi-level files need a single level or colmax=True"
+            )
+        if regrid is not None:
+            from pysteps_importer_cwb.regrid import resampling_table
+
+            self._table = resampling_table(self.geometry, regrid, method=regrid_method)
+            self.metadata = self._table.update_metadata(self.metadata)
+            frame_shape = (self._table.ny, self._table.nx)
+        self.shape = (len(self.filenames),) + frame_shape
+        self.fill_value = self.metadata["missing"] if raw else np.nan
+
+    ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        """Size in bytes of the whole array once decoded."""
+        return self.size * self.dtype.itemsize
+
+    @property
+    def times(self):
+        """Times of the frames, None for the missing files."""
+        if self._timestamps is None:
+            gzipped = self.options["gzipped"]
+
+            def _time(filename):
+                if filename is None:
+                    return None
+                return read_compref_header(filename, gzipped=gzipped).time
+
+            with ThreadPoolExecutor(max_workers=max(1, self.num_workers)) as executor:
+                self._timestamps = list(executor.map(_time, self.filenames))
+        return self._timestamps
+
+    def __repr__(self):
+        return "<%s shape=%s dtype=%s>" % (
+            type(self).__name__, self.shape, self.dtype.name
+        )
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        t_key, y_key, x_key = _expand_key(key)
+        times = np.arange(self.shape[0])[t_key]
+        rows = np.arange(self.shape[1])[y_key]
+        cols = np.arange(self.shape[2])[x_key]
+
+        frames = np.atleast_1d(times)
+        block = np.empty(
+            (len(frames), np.size(rows), np.size(cols)), dtype=self.dtype
+        )
+        if block.size:
+            self._decode(frames, np.atleast_1d(rows), np.atleast_1d(cols), block)
+
+        # Integer indices drop their axis, as in numpy.
+        indices = (times, rows, cols)
+        squeeze = tuple(axis for axis in range(3) if np.ndim(indices[axis]) == 0)
+        return block.squeeze(axis=squeeze) if squeeze else block
+
+    def _decode(self, frames, rows, cols, block):
+        """Decode the selected rows and columns of frames into block."""
+        # Decode the bounding window, then select within it if needed.
+        r0, c0 = int(rows.min()), int(cols.min())
+        span = (slice(r0, int(rows.max()) + 1), slice(c0, int(cols.max()) + 1))
+        contiguous = (
+            np.array_equal(rows, np.arange(span[0].start, span[0].stop))
+            and np.array_equal(cols, np.arange(span[1].start, span[1].stop))
+        )
+        options = dict(self.options)
+        if self._table is None:
+            # The rows and columns are relative to the region of interest.
+            oy, ox = self._origin
+            options["roi"] = (
+                slice(oy + span[0].start, oy + span[0].stop),
+                slice(ox + span[1].start, ox + span[1].stop),
+            )
+            local = (rows - r0, cols - c0)
+        else:
+            if self.window is not None:
+                options["roi"] = self.window
+            local = (rows, cols)
+            contiguous = False
+
+        def _frame(j):
+            filename = self.filenames[frames[j]]
+            if filename is None:
+                block[j] = self.fill_value
+            elif contiguous:
+                read_cwb_compref(filename, out=block[j], **options)
+            else:
+                precip = read_cwb_compref(filename, **options)[0]
+                block[j] = precip[np.ix_(*local)]
+
+        if self.num_workers > 1 and len(frames) > 1:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                list(executor.map(_frame, range(len(frames))))
+        else:
+            for j in range(len(frames)):
+                _frame(j)
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE, rows=None, cols=None):
+        """
+        Iterate over the frames by chunks of consecutive frames.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of frames of each chunk.
+        rows, cols : slice, optional
+            Rows and columns of the frames to decode.
+
+        Yields
+        ------
+        start : int
+            Index of the first frame of the chunk.
+        block : 3D array
+            Decoded frames of the chunk.
+        """
+        rows = slice(None) if rows is None else rows
+        cols = slice(None) if cols is None else cols
+        for start in range(0, self.shape[0], chunk_size):
+            yield start, self[start : start + chunk_size, rows, cols]
+
+    def mean(self, chunk_size=CHUNK_SIZE):
+        """
+        Mean of the frames over time, ignoring the missing values.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of frames decoded at once.
+
+        Returns
+        -------
+        mean : 2D array
+            NaN where no frame has a valid value.
+        """
+        total = np.zeros(self.shape[1:], dtype="double")
+        count = np.zeros(self.shape[1:], dtype="int64")
+        for _, block in self.iter_chunks(chunk_size):
+            valid = self._valid(block)
+            total += np.where(valid, block, 0).sum(axis=0)
+            count += valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return total / count
+
+    def count_exceeding(self, threshold, chunk_size=CHUNK_SIZE):
+        """
+        Number of frames exceeding a threshold at every pixel.
+
+        Parameters
+        ----------
+        threshold : float
+            Threshold, in the units of the frames (dBZ, mm/h or raw values).
+        chunk_size : int
+            Number of frames decoded at once.
+
+        Returns
+        -------
+        count : 2D array
+            Number of frames with a value strictly above the threshold.
+        """
+        count = np.zeros(self.shape[1:], dtype="int64")
+        for _, block in self.iter_chunks(chunk_size):
+            count += (self._valid(block) & (block > threshold)).sum(axis=0)
+        return count
+
+    def count_valid(self, chunk_size=CHUNK_SIZE):
+        """Number of frames with a valid value at every pixel."""
+        count = np.zeros(self.shape[1:], dtype="int64")
+        for _, block in self.iter_chunks(chunk_size):
+            count += self._valid(block).sum(axis=0)
+        return count
+
+    def _valid(self, block):
+        if self.dtype.kind == "f":
+            return ~np.isnan(block)
+        return block != self.fill_value
+
+    def to_dask(self, chunk_size=1):
+        """
+        Dask array of the frames.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of frames of each dask chunk.
+
+        Returns
+        -------
+        array : dask.array.Array
+        """
+        try:
+            import dask.array
+        except ImportError:
+            from pysteps.exceptions import MissingOptionalDependency
+
+            raise MissingOptionalDependency(
+                "dask package is required for the dask arrays "
+                "but it is not installed"
+            )
+        return dask.array.from_array(
+            self, chunks=(chunk_size,) + self.shape[1:], asarray=True, fancy=False
+        )
+
+    def to_xarray(self, chunk_size=1):
+        """
+        xarray DataArray of the frames, backed by a dask array.
+
+        The coordinates are the times of the frames and, on the grid of the
+        files, the longitudes and latitudes of the pixels or, on a TWD97 grid,
+        the coordinates of the pixel centers in meters.
+
+        Parameters
+        ----------
+        chunk_size : int
+            Number of frames of each dask chunk.
+
+        Returns
+        -------
+        array : xarray.DataArray
+        """
+        try:
+            import xarray
+        except ImportError:
+            from pysteps.exceptions import MissingOptionalDependency
+
+            raise MissingOptionalDependency(
+                "xarray package is required for the xarray datasets "
+                "but it is not installed"
+            )
+        coords = {"t": ("t", np.array(self.times, dtype="datetime64[ns]"))}
+        if self._table is None:
+            geo = self.geometry
+            coords["lon"] = ("x", np.linspace(geo.lon_min, geo.lon_max, geo.nx))
+            coords["lat"] = ("y", np.linspace(geo.lat_min, geo.lat_max, geo.ny))
+        else:
+            table = self._table
+            centers = np.arange(max(table.nx, table.ny)) + 0.5
+            coords["x"] = ("x", table.x1 + centers[: table.nx] * table.pixelsize)
+            coords["y"] = ("y", table.y1 + centers[: table.ny] * table.pixelsize)
+        return xarray.DataArray(
+            self.to_dask(chunk_size), dims=("t", "y", "x"), coords=coords,
+            attrs={k: v for k, v in self.metadata.items() if v is not None},
+        )
+
+
+def _expand_key(key):
+    """(t, y, x) indices of a numpy index of a 3D array."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError("New axes are not supported")
+    if Ellipsis in [k for k in key if not isinstance(k, np.ndarray)]:
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        fill = (slice(None),) * (3 - len(key) + 1)
+        key = key[:i] + fill + key[i + 1 :]
+    if len(key) > 3:
+        raise IndexError("too many indices for a 3D dataset")
+    return key + (slice(None),) * (3 - len(key))
+
+
+def open_cwb_compref(inputfns, **kwargs):
+    """
+    Open a lazy dataset over a list of COMPREF files.
+
+    Parameters
+    ----------
+    inputfns : list of str or tuple
+        List of file names, or the (filenames, timestamps) tuple returned by
+        `find_cwb_compref`, `Catalog.find` or `pysteps.io.archive.find_by_date`.
+    **kwargs
+        Options of `CompRefDataset`.
+
+    Returns
+    -------
+    dataset : CompRefDataset
+    """
+    if isinstance(inputfns, tuple):
+        filenames, timestamps = inputfns
+        return CompRefDataset(filenames, timestamps=timestamps, **kwargs)
+    return CompRefDataset(inputfns, **kwargs)
+
+
+def open_archive_cwb_compref(
+        start,
+        end,
+        root_path="./radar/cwb_opendata",
+        path_fmt="%Y/%m/%d",
+        fn_pattern="COMPREF.OpenData.%Y%m%d.%H%M",
+        fn_ext="gz",
+        timestep=10,
+        **kwargs):
+    """
+    Open a lazy dataset over the frames of an archive between two dates.
+
+    The files are located with the layout of `find_cwb_compref`, and there is
+    one frame per time step: the missing files give missing frames.
+
+    Parameters
+    ----------
+    start, end : datetime
+        First and last time of the period, both included.
+    root_path, path_fmt, fn_pattern, fn_ext, timestep
+        Layout of the archive, see `find_cwb_compref`.
+    **kwargs
+        Options of `CompRefDataset`. ``gzipped`` defaults to ``fn_ext == "gz"``.
+
+    Returns
+    -------
+    dataset : CompRefDataset
+    """
+    kwargs.setdefault("gzipped", fn_ext == "gz")
+    filenames, timestamps = find_cwb_compref(
+        start, end, root_path=root_path, path_fmt=path_fmt, fn_pattern=fn_pattern,
+        fn_ext=fn_ext, timestep=timestep,
+    )
+    return CompRefDataset(filenames, timestamps=timestamps, **kwargs)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Grid geometry of the CWB COMPREF mosaics.
+
+Consecutive COMPREF frames almost always share the same grid, so the geometry
+derived from a header (corner coordinates, projected extents and, on request,
+the full longitude/latitude arrays) is computed once per distinct grid and
+cached for the lifetime of the process.
+"""
+
+# Import the needed libraries
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+# Projection used for the metadata of the imported fields.
+PROJECTION = "EPSG:3826"  # TWD97
+
+
+@lru_cache(maxsize=None)
+def _get_proj(projection):
+    # pyproj is slow to import and only needed for the projected coordinates.
+    import pyproj
+
+    return pyproj.Proj(projection)
+
+
+class GridGeometry(object):
+    """
+    Geometry of a regular longitude/latitude COMPREF grid.
+
+    Row 0 of the grid is the southernmost row, column 0 the westernmost column.
+
+    Attributes
+    ----------
+    nx, ny : int
+        Grid size.
+    lon_min, lon_max, lat_min, lat_max : float
+        Longitude and latitude of the outermost pixel centers, in degrees.
+    dlon, dlat : float
+        Pixel size in degrees.
+    x1, y1, x2, y2 : float
+        Projected (EPSG:3826) coordinates of the lower-left and upper-right
+        corners, in meters.
+    """
+
+    def __init__(self, lon_min, lat_min, dlon, dlat, nx, ny):
+        self.nx = nx
+        self.ny = ny
+        self.dlon = dlon
+        self.dlat = dlat
+        self.lon_min = lon_min
+        self.lat_min = lat_min
+        self.lon_max = lon_min + (nx - 1) * dlon
+        self.lat_max = lat_min + (ny - 1) * dlat
+
+        pr = _get_proj(PROJECTION)
+        self.x1, self.y1 = pr(self.lon_min, self.lat_min)
+        self.x2, self.y2 = pr(self.lon_max, self.lat_max)
+
+        self._coordinates = None
+        self._lock = threading.Lock()
+
+    def window(self, rows, cols):
+        """
+        Geometry of a sub-window of the grid.
+
+        Parameters
+        ----------
+        rows, cols : slice
+            Row and column ranges of the window, with unit step.
+
+        Returns
+        -------
+        geometry : GridGeometry
+        """
+        r0, r1, _ = rows.indices(self.ny)
+        c0, c1, _ = cols.indices(self.nx)
+        if (r0, r1, c0, c1) == (0, self.ny, 0, self.nx):
+            return self
+        if r1 <= r0 or c1 <= c0:
+            raise ValueError("empty window %s, %s" % (rows, cols))
+        return GridGeometry(
+            self.lon_min + c0 * self.dlon,
+            self.lat_min + r0 * self.dlat,
+            self.dlon,
+            self.dlat,
+            c1 - c0,
+            r1 - r0,
+        )
+
+    def coarsen(self, factor):
+        """
+        Geometry of the grid coarsened by averaging blocks of pixels.
+
+        The blocks start at the southwestern pixel. The grid is extended to
+        the north and east to a multiple of the factor, so the last blocks
+        may be partially outside of the original grid.
+
+        Parameters
+        ----------
+        factor : int
+            Number of pixels of the blocks along each axis.
+
+        Returns
+        -------
+        geometry : GridGeometry
+            Geometry of the centers of the blocks.
+        """
+        if factor == 1:
+            return self
+        offset = (factor - 1) / 2.0
+        return GridGeometry(
+            self.lon_min + offset * self.dlon,
+            self.lat_min + offset * self.dlat,
+            factor * self.dlon,
+            factor * self.dlat,
+            -(-self.nx // factor),
+            -(-self.ny // factor),
+        )
+
+    def index_window(self, lon_min, lon_max, lat_min, lat_max):
+        """
+        Smallest window containing all the pixel centers within the bounds.
+
+        Parameters
+        ----------
+        lon_min, lon_max, lat_min, lat_max : float
+            Bounds of the region of interest, in degrees.
+
+        Returns
+        -------
+        rows, cols : slice
+            Row and column ranges of the window.
+        """
+        eps = 1e-9
+        c0 = int(np.ceil((lon_min - self.lon_min) / self.dlon - eps))
+        c1 = int(np.floor((lon_max - self.lon_min) / self.dlon + eps)) + 1
+        r0 = int(np.ceil((lat_min - self.lat_min) / self.dlat - eps))
+        r1 = int(np.floor((lat_max - self.lat_min) / self.dlat + eps)) + 1
+        c0, c1 = max(0, c0), min(self.nx, c1)
+        r0, r1 = max(0, r0), min(self.ny, r1)
+        if r1 <= r0 or c1 <= c0:
+            raise ValueError(
+                "The region (%s, %s, %s, %s) does not intersect the grid"
+                % (lon_min, lon_max, lat_min, lat_max)
+            )
+        return slice(r0, r1), slice(c0, c1)
+
+    def coordinates(self):
+        """
+        Longitude and latitude of every pixel center.
+
+        The arrays are built on the first call and shared by all the later
+        callers, so they are returned read-only.
+
+        Returns
+        -------
+        lons, lats : 2D arrays
+            Arrays of shape (ny, nx), in degrees.
+        """
+        with self._lock:
+            if self._coordinates is None:
+                lons = np.linspace(self.lon_min, self.lon_max, self.nx)
+                lats = np.linspace(self.lat_min, self.lat_max, self.ny)
+                lons, lats = np.meshgrid(lons, lats)
+                lons.flags.writeable = False
+                lats.flags.writeable = False
+                self._coordinates = (lons, lats)
+        return self._coordinates
+
+
+@lru_cache(maxsize=32)
+def _grid_geometry(alon, alat, xy_scale, dx, dy, dxy_scale, nx, ny):
+    dlon = dx / dxy_scale
+    dlat = dy / dxy_scale
+    # alat is the latitude of the northernmost row.
+    lat_min = alat / xy_scale - (ny - 1) * dlat
+    return GridGeometry(alon / xy_scale, lat_min, dlon, dlat, nx, ny)
+
+
+def roi_window(header, roi):
+    """
+    Row and column ranges of a region of interest.
+
+    Parameters
+    ----------
+    header : CompRefHeader
+        Header of the COMPREF file.
+    roi : tuple
+        Either (lon_min, lon_max, lat_min, lat_max) bounds in degrees, or a
+        (rows, cols) tuple of slices.
+
+    Returns
+    -------
+    rows, cols : slice
+    """
+    if len(roi) == 2 and all(isinstance(r, slice) for r in roi):
+        return roi
+    return grid_geometry(header).index_window(*roi)
+
+
+def grid_geometry(header):
+    """
+    Cached geometry of the grid described by a COMPREF header.
+
+    Parameters
+    ----------
+    header : CompRefHeader
+        Header of the COMPREF file.
+
+    Returns
+    -------
+    geometry : GridGeometry
+        Shared instance for all the headers with the same
+        (alon, alat, xy_scale, dx, dy, dxy_scale, nx, ny) fields.
+    """
+    return _grid_geometry(
+        header.alon,
+        header.alat,
+        header.xy_scale,
+        header.dx,
+        header.dy,
+        header.dxy_scale,
+        header.nx,
+        header.ny,
+    )
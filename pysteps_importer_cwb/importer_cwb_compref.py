@@ -1,20 +1,36 @@
 # -*- coding: utf-8 -*-
 """
-One-line description of this module. E.g.
-
-This is a more extensive description (optional) that describes the readers implemented
-in this module and other relevant information.
+Importers for the reflectivity composites (COMPREF) of the Central Weather Bureau.
+
+The pysteps importer `importer_cwb_compref_cwb` reads a single file. The module
+also provides `read_cwb_compref`, an importer without the pysteps
+postprocessing, `read_timeseries_cwb_compref` to read a sequence of files into
+a single array, and `download_cwb_opendata` (see
+:mod:`pysteps_importer_cwb.opendata`).
+
+pysteps imports this module whenever it discovers its importers, including in
+processes that never read a CWB file, so the module only imports what the
+decoding needs. pysteps itself, the resampling (pyproj) and the download tools
+are imported on first use.
 """
 
 # Import the needed libraries
 import numpy as np
-import gzip
-import pyproj
 
-from datetime import datetime, timedelta
-from urllib import request
+from datetime import timedelta
+from functools import wraps
 import os
-import xmltodict
+
+from pysteps_importer_cwb.compref import (
+    CLEAR_SKY_DBZ,
+    _payload_shape,
+    decode_compref,
+    level_indices,
+    rainrate_lut,
+    read_compref_header,
+)
+from pysteps_importer_cwb import instrument
+from pysteps_importer_cwb.geometry import grid_geometry, roi_window
 
 ### Uncomment the next lines if pyproj is needed for the importer.
 # try:
@@ -24,7 +40,57 @@ import xmltodict
 # except ImportError:
 #     PYPROJ_IMPORTED = False
 
-from pysteps.decorators import postprocess_import
+# Default coefficients of the Z-R relationship (Z = zr_a * R ** zr_b).
+ZR_A = 223.04
+ZR_B = 1.51
+
+
+def __getattr__(name):
+    # The download tools are imported on first use.
+    if name == "download_cwb_opendata":
+        from pysteps_importer_cwb.opendata import download_cwb_opendata
+
+        return download_cwb_opendata
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def postprocess_import(**postprocess_kws):
+    """
+    Lazy `pysteps.decorators.postprocess_import`.
+
+    Importing pysteps runs the discovery of the importers, which imports this
+    module: the pysteps decorator is applied on the first call of the importer,
+    so that this module can be imported without pysteps, and by pysteps.
+    """
+
+    def _postprocess_import(importer):
+        postprocessed = []
+
+        @wraps(importer)
+        def _import_with_postprocessing(*args, **kwargs):
+            if not postprocessed:
+                from pysteps.decorators import postprocess_import
+
+                postprocessed.append(postprocess_import(**postprocess_kws)(importer))
+            return postprocessed[0](*args, **kwargs)
+
+        _import_with_postprocessing.__doc__ = importer.__doc__.replace(
+            "{extra_kwargs_doc}", _EXTRA_KWARGS_DOC
+        )
+        return _import_with_postprocessing
+
+    return _postprocess_import
+
+
+# Documentation of the keywords of the postprocessing, as added by pysteps.
+_EXTRA_KWARGS_DOC = """Other Parameters
+    ----------------
+    dtype : str
+        Data-type to which the array is cast.
+        Valid values: "float32", "float64", "single", and "double".
+    fillna : float or np.nan
+        Value used to represent the missing data ("No Coverage").
+        By default, np.nan is used."""
 
 
 # Function importer_cwb_compref_cwb to import cwb-format
@@ -88,339 +154,499 @@ from pysteps.decorators import postprocess_import
 #
 
 @postprocess_import()
-def importer_cwb_compref_cwb(filename, gzipped=False, **kwargs):
+def importer_cwb_compref_cwb(filename, gzipped=False, roi=None, rainrate=False,
+                             zr_a=ZR_A, zr_b=ZR_B, regrid=None,
+                             regrid_method="nearest", cache=None, levels=None,
+                             colmax=False, coarsen=None, quality=False, **kwargs):
     """
-    A detailed description of the importer. A minimal documentation is
-    strictly needed since the pysteps importers interface expect docstrings.
-
-    For example, a documentation may look like this:
-
-    Import a precipitation field from the Awesome Bureau of Composites stored in
-    Grib format.
+    Import a reflectivity composite (COMPREF) from the Central Weather Bureau.
 
     Parameters
     ----------
     filename : str
         Name of the file to import.
 
-    keyword1 : str
-        Some keyword used to fine control the importer behavior.
-
-    keyword2 : int
-        Another keyword used to fine control the importer behavior.
+    gzipped : bool
+        Whether the file is gzip compressed (e.g. COMPREF.20211127.1430.gz).
+
+    roi : tuple, optional
+        Region of interest to import, either as (lon_min, lon_max, lat_min,
+        lat_max) bounds in degrees or as a (rows, cols) tuple of slices. Only
+        the rows of the region are decoded, and the metadata describe the
+        cropped grid.
+
+    rainrate : bool
+        If True, return the rain rate in mm/h instead of the reflectivity,
+        converted with the Z-R relationship Z = zr_a * R ** zr_b through a
+        lookup table of the raw values.
+
+    zr_a, zr_b : float
+        Coefficients of the Z-R relationship.
+
+    regrid : float, optional
+        If given, resample the field to a uniform TWD97 (EPSG:3826) grid with
+        this pixel size in meters, instead of returning the longitude/latitude
+        grid of the file. The resampling tables are computed once per grid
+        and cached (see `pysteps_importer_cwb.regrid.resampling_table`).
+
+    regrid_method : str
+        "nearest" or "bilinear" resampling.
+
+    cache : FrameCache or bool, optional
+        Cache of the decoded fields (see `pysteps_importer_cwb.cache`). With
+        True, a cache in the default cache directory is used. Importing a file
+        already in the cache only memory-maps the cached field.
+
+    levels : int, slice or sequence of int, optional
+        Levels of a multi-level (3D) mosaic to import, as indices into the
+        level heights of the header. Only the selected levels are decoded. A
+        single integer level (e.g. ``levels=0`` for the lowest CAPPI) gives
+        a 2D field, and by default all the levels are imported.
+
+    colmax : bool
+        If True, import the column maximum of the selected levels, computed
+        in a single pass without holding the volume in memory.
+
+    coarsen : int, optional
+        If given, average the field over blocks of ``coarsen`` x ``coarsen``
+        pixels (see `pysteps_importer_cwb.pyramid`). With ``cache``, the 2x,
+        4x and 8x fields are cached next to the source file, and the later
+        imports of the file read the coarse fields only. The pyramids are
+        always cached next to the source: a `FrameCache` given as ``cache``
+        only enables this cache.
+
+    quality : bool
+        If True, return the number of contributing radars within range of
+        every pixel as a uint8 quality field (see
+        `pysteps_importer_cwb.coverage`), on the grid of the field.
 
     {extra_kwargs_doc}
 
-    ####################################################################################
-    # The {extra_kwargs_doc} above is needed to add default keywords added to this     #
-    # importer by the pysteps.decorator.postprocess_import decorator.                  #
-    # IMPORTANT: Remove these box in the final version of this function                #
-    ####################################################################################
+    Notes
+    -----
+    The pysteps postprocessing casts the fields to floating point, also for
+    the importers of `pysteps.io.get_method`. `read_cwb_compref` returns the
+    raw int16 values of the file, a quarter of the memory of a double
+    precision field.
 
     Returns
     -------
-    precipitation : 2D array, float32
-        Precipitation field in mm/h. The dimensions are [latitude, longitude].
+    precipitation : 2D array
+        Reflectivity field in dBZ, or rain rate in mm/h with ``rainrate=True``.
+        The dimensions are [latitude, longitude], preceded by the levels for
+        multi-level files.
     quality : 2D array or None
-        If no quality information is available, set to None.
+        Radar coverage with ``quality=True``, None otherwise.
     metadata : dict
         Associated metadata (pixel sizes, map projections, etc.).
     """
+    # Decode directly to the precision requested to the postprocessing decorator.
+    options = dict(
+        gzipped=gzipped, roi=roi, dtype=kwargs.get("dtype", "double"),
+        rainrate=rainrate, zr_a=zr_a, zr_b=zr_b, regrid=regrid,
+        regrid_method=regrid_method, levels=levels, colmax=colmax,
+    )
+    if coarsen is not None:
+        from pysteps_importer_cwb.pyramid import read_coarse_cwb_compref
+
+        precip, _, metadata = read_coarse_cwb_compref(
+            filename, coarsen, cache=bool(cache), **options
+        )
+    elif not cache:
+        precip, _, metadata = read_cwb_compref(filename, **options)
+    else:
+        if cache is True:
+            cache = _default_frame_cache()
+        precip, _, metadata = cache.read(filename, **options)
+    if cache and kwargs.get("fillna", np.nan) is not np.nan:
+        # The decorator fills the cached read-only fields in place.
+        precip = np.array(precip)
+    if quality:
+        header = read_compref_header(filename, gzipped=gzipped)
+        quality = _coverage_quality(header, roi, regrid, coarsen)
+    else:
+        quality = None
+    return precip, quality, metadata
+
+
+def _coverage_quality(header, roi, regrid, coarsen=None):
+    """Radar coverage on the grid of an imported field."""
+    from pysteps_importer_cwb.coverage import coverage_field
+
+    geometry = grid_geometry(header)
+    quality = coverage_field(geometry, header.mosradar)
+    if roi is not None:
+        window = roi_window(header, roi)
+        quality = quality[window]
+        geometry = geometry.window(*window)
+    if regrid is not None:
+        from pysteps_importer_cwb.regrid import resampling_table
+
+        table = resampling_table(geometry, regrid, method="nearest")
+        quality = table.resample(quality, fill_value=0)
+    if coarsen is not None:
+        # Best coverage of the blocks, padded as the coarse fields.
+        ny, nx = quality.shape
+        blocks = np.zeros(
+            (-(-ny // coarsen) * coarsen, -(-nx // coarsen) * coarsen),
+            dtype=quality.dtype,
+        )
+        blocks[:ny, :nx] = quality
+        quality = blocks.reshape(
+            blocks.shape[0] // coarsen, coarsen, blocks.shape[1] // coarsen, coarsen
+        ).max(axis=(1, 3))
+    return quality
 
-    ### Uncomment the next lines if pyproj is needed for the importer
-    # if not PYPROJ_IMPORTED:
-    #     raise MissingOptionalDependency(
-    #         "pyproj package is required by importer_cwb_compref_cwb
-    #         "but it is not installed"
-    #     )
 
-    ####################################################################################
-    # Add the code to read the precipitation data here. Note that only cartesian grid
-    # are supported by pysteps!
+_frame_cache = None
 
-    # In this example, we are going create a precipitation fields of only zeros.
-    #precip = np.zeros((100, 100), dtype="double")
-    # The "double" precision is used in this example to indicate that the imaginary
-    # grib file stores the data using double precision.
 
-    # Quality field, should have the same dimensions of the precipitation field.
-    # Use None is not information is available.
-    quality = None
+def _default_frame_cache():
+    global _frame_cache
+    if _frame_cache is None:
+        from pysteps_importer_cwb.cache import FrameCache
 
-    # Adjust the metadata fields according to the file format specifications.
-    # For additional information on the metadata fields, see:
-    # https://pysteps.readthedocs.io/en/latest/pysteps_reference/io.html#pysteps-io-importers
+        _frame_cache = FrameCache()
+    return _frame_cache
 
-    # The projection definition is an string with a PROJ.4-compatible projection
-    # definition of the cartographic projection used for the data
-    # More info at: https://proj.org/usage/projections.html
 
-    # For example:
+def read_cwb_compref(filename, gzipped=False, roi=None, out=None, dtype="double",
+                     rainrate=False, zr_a=ZR_A, zr_b=ZR_B, regrid=None,
+                     regrid_method="nearest", levels=None, colmax=False,
+                     masked=False, quality=False):
+    """
+    Read a COMPREF file without the pysteps postprocessing.
+
+    Unlike `importer_cwb_compref_cwb`, the field is returned in the requested
+    data type without any additional copy, and it can be decoded into an
+    existing array.
 
-    if gzipped is False:
-        fid = open(filename, mode='rb')
+    Parameters
+    ----------
+    filename : str
+        Name of the file to import.
+    gzipped : bool
+        Whether the file is gzip compressed.
+    roi : tuple, optional
+        Region of interest, see `importer_cwb_compref_cwb`.
+    out : array, optional
+        Array of shape (ny, nx), or the shape of the region of interest, where
+        the field is written. Multi-level fields have a leading level axis.
+    dtype : str
+        Data type of the field when ``out`` is not given. With an integer type
+        (e.g. "int16") the raw scaled values are returned, and the metadata
+        contain "var_scale" to convert them to dBZ.
+    rainrate : bool
+        Return the rain rate in mm/h, see `importer_cwb_compref_cwb`. Only
+        floating point types are supported.
+    zr_a, zr_b : float
+        Coefficients of the Z-R relationship.
+    regrid : float, optional
+        Pixel size in meters of the TWD97 grid where the field is resampled,
+        see `importer_cwb_compref_cwb`. ``out`` then has the shape of the
+        resampled grid.
+    regrid_method : str
+        "nearest" or "bilinear" resampling. The bilinear interpolation of the
+        raw values leaves out the pixels without value, and is rounded.
+    levels : int, slice or sequence of int, optional
+        Levels of a multi-level file, see `importer_cwb_compref_cwb`.
+    colmax : bool
+        Return the column maximum of the levels, see `importer_cwb_compref_cwb`.
+    masked : bool
+        If True, return a MaskedArray, masked at the pixels without value:
+        ``metadata["missing"]`` for integer types, NaN otherwise.
+    quality : bool
+        Return the radar coverage, see `importer_cwb_compref_cwb`.
+
+    Returns
+    -------
+    precipitation : array
+        Reflectivity field in dBZ, raw scaled values for integer types, or
+        rain rate in mm/h.
+    quality : 2D array or None
+        Radar coverage with ``quality=True``, None otherwise.
+    metadata : dict
+        Associated metadata (pixel sizes, map projections, etc.).
+    """
+    timer = instrument.timer()
+    header = None
+    if roi is not None or rainrate:
+        header = read_compref_header(filename, gzipped=gzipped)
+    window = roi_window(header, roi) if roi is not None else None
+    if timer is not None and header is not None:
+        timer.lap("header", header.data_offset)
+    if out is not None:
+        dtype = out.dtype
+    lut = None
+    if rainrate:
+        lut = _rainrate_lut(header, dtype, zr_a, zr_b)
+        if timer is not None:
+            timer.lap("lut")
+    precip, header = decode_compref(
+        filename,
+        gzipped=gzipped,
+        out=out if regrid is None else None,
+        dtype=dtype,
+        window=window,
+        lut=lut,
+        levels=levels,
+        colmax=colmax,
+    )
+    if timer is not None:
+        # decode_compref records its own stages.
+        timer.skip()
+    raw = precip.dtype.kind in "iu"
+    metadata = _compref_metadata(
+        header, raw=raw, window=window, zr=(zr_a, zr_b) if rainrate else None,
+        levels=levels, colmax=colmax,
+    )
+    if timer is not None:
+        timer.lap("metadata")
+    if regrid is not None:
+        from pysteps_importer_cwb.regrid import resampling_table
+
+        geometry = grid_geometry(header)
+        if window is not None:
+            geometry = geometry.window(*window)
+        table = resampling_table(geometry, regrid, method=regrid_method)
+        precip = table.resample(
+            precip, out=out, fill_value=metadata["missing"] if raw else np.nan,
+            missing=metadata["missing"] if raw else None,
+        )
+        metadata = table.update_metadata(metadata)
+        if timer is not None:
+            timer.lap("regrid", precip.nbytes)
+    if masked:
+        invalid = precip == metadata["missing"] if raw else np.isnan(precip)
+        precip = np.ma.MaskedArray(precip, mask=invalid)
+    if quality:
+        quality = _coverage_quality(header, roi, regrid)
     else:
-        import gzip
-        fid = gzip.open(filename, 'rb')
-
-    buf = fid.read()
-    yyyy,mm,dd,hh,mn,ss,nx,ny,nz = np.frombuffer(buf, dtype=np.int32, count=9)
-    proj = np.frombuffer(buf, dtype='S4', count=1, offset=36)
-    map_scale,projlat0,projlat1,projlon = np.frombuffer(buf, dtype=np.int32, count=4, offset=40)
-    alon,alat,xy_scale,dx,dy,dxy_scale = np.frombuffer(buf, dtype=np.int32, count=6, offset=56)
-    zht = np.frombuffer(buf, dtype=np.int32, count=nz, offset=80)
-    z_scale,i_bb_mode = np.frombuffer(buf, dtype=np.int32, count=2, offset=80+4*nz)
-    unkn01 = np.frombuffer(buf, dtype=np.int32, count=9, offset=88+4*nz)
-    varname1 = np.frombuffer(buf, dtype='S4', count=1, offset=124+4*nz)
-    varname2 = np.frombuffer(buf, dtype=np.int32, count=4, offset=128+4*nz)
-    varunit,unkn02 = np.frombuffer(buf, dtype='S3', count=2, offset=144+4*nz)
-    var_scale,missing,nradar = np.frombuffer(buf, dtype=np.int32, count=3, offset=150+4*nz)
-    mosradar = np.frombuffer(buf, dtype='S4', count=nradar, offset=162+4*nz)
-    var = np.frombuffer(buf, dtype=np.int16, count=-1, offset=162+4*nz+4*nradar)
-    fid.close()
-
-    dBZ = var/var_scale
-    dBZ[dBZ<-990] = np.nan # -999 = No Value, -99 = Clear Sky
-    precip = dBZ.reshape(ny,nx)
-
-    ul_lon = alon/xy_scale # 115.0
-    ul_lat = alat/xy_scale-(ny-1)*(dy/dxy_scale) # 18.0
-    lr_lon = alon/xy_scale+(nx-1)*(dx/dxy_scale) # 126.5
-    lr_lat = alat/xy_scale # 29.0
-
-    lons = np.linspace(ul_lon, lr_lon, nx)
-    lats = np.linspace(ul_lat, lr_lat, ny)
-
-    lons, lats = np.meshgrid(lons, lats)
-
-    pr = pyproj.Proj('EPSG:3826') # TWD97
-
-    x1, y1 = pr(ul_lon, ul_lat)
-    x2, y2 = pr(lr_lon, lr_lat)
+        quality = None
+
+    return precip, quality, metadata
+
+
+def _rainrate_lut(header, dtype, zr_a, zr_b):
+    dtype = np.dtype(dtype)
+    if dtype.kind != "f":
+        raise ValueError("Rain rates need a floating point type, not %s" % dtype)
+    return rainrate_lut(zr_a, zr_b, header.var_scale, dtype=dtype.name)
+
+
+def _compref_metadata(header, raw=False, window=None, zr=None, levels=None,
+                      colmax=False):
+    """
+    Metadata of an imported COMPREF field, following the pysteps conventions.
+
+    With ``raw=True`` the values are described in the scaled integer units of
+    the file: dBZ = value / var_scale, and ``missing`` is the raw value of the
+    pixels without data. With a ``window`` the metadata describe the
+    (rows, cols) sub-grid. With ``zr=(zr_a, zr_b)`` the values are rain
+    rates, with the threshold and zerovalue converted as by
+    `pysteps.utils.conversion.to_rainrate`. The fields of multi-level files,
+    or imported with a selection of ``levels``, are described by the heights
+    of their levels (zht / z_scale), and by ``colmax=True`` for the column
+    maximum of these levels.
+    """
+    geometry = grid_geometry(header)
+    if window is not None:
+        geometry = geometry.window(*window)
 
     metadata = dict(
-        xpixelsize=nx,
-        ypixelsize=ny,
         cartesian_unit="m",
         unit="dBZ",
         transform="dB",
-        zerovalue=-99.0,
+        zerovalue=CLEAR_SKY_DBZ,
         institution="Central Weather Bureau",
-        projection="EPSG:3826", 
+        projection="EPSG:3826",
         yorigin="lower",
         threshold=0,
-        x1=x1,
-        x2=x2,
-        y1=y1,
-        y2=y2,
-        zr_a=223.04,
-        zr_b=1.51,
+        zr_a=ZR_A,
+        zr_b=ZR_B,
+    )
+    metadata.update(_geometry_metadata(geometry))
+    if zr is not None:
+        zr_a, zr_b = zr
+        metadata.update(
+            unit="mm/h",
+            transform=None,
+            zerovalue=0.0,
+            threshold=(1.0 / zr_a) ** (1.0 / zr_b),
+            zr_a=zr_a,
+            zr_b=zr_b,
+        )
+    if header.nz > 1 or levels is not None or colmax:
+        indices, _ = level_indices(header, levels)
+        metadata["heights"] = [header.zht[k] / (header.z_scale or 1) for k in indices]
+        metadata["colmax"] = colmax
+    if raw:
+        metadata.update(
+            zerovalue=CLEAR_SKY_DBZ * header.var_scale,
+            var_scale=header.var_scale,
+            missing=header.missing * header.var_scale,
+        )
+    return metadata
+
+
+def _geometry_metadata(geometry):
+    """Metadata describing the grid of a `GridGeometry`."""
+    return dict(
+        xpixelsize=geometry.nx,
+        ypixelsize=geometry.ny,
+        x1=geometry.x1,
+        x2=geometry.x2,
+        y1=geometry.y1,
+        y2=geometry.y2,
     )
 
-    # IMPORTANT! The importers should always return the following fields:
-    return precip, quality, metadata
 
+def _compref_filename(t, root_path, path_fmt, fn_pattern, fn_ext):
+    return os.path.join(
+        root_path, t.strftime(path_fmt), t.strftime(fn_pattern) + "." + fn_ext
+    )
 
-def download_cwb_opendata(
-        path="./radar/cwb_opendata",
-        remove_exist=True,
-        authorization="CWB-XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
-        limit=None,
-        offset=0,
-        timeFrom=(datetime.now()-timedelta(seconds=3600*2)).strftime("%Y-%m-%d %H:%M:%S"),
-        timeTo=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), **kwargs):
-    """
-    A detailed description of the importer. A minimal documentation is
-    strictly needed since the pysteps importers interface expect docstrings.
 
-    For example, a documentation may look like this:
+def find_cwb_compref(
+        start,
+        end,
+        root_path="./radar/cwb_opendata",
+        path_fmt="%Y/%m/%d",
+        fn_pattern="COMPREF.OpenData.%Y%m%d.%H%M",
+        fn_ext="gz",
+        timestep=10):
+    """
+    List the COMPREF files of an archive between two dates.
 
-    Import a precipitation field from the Awesome Bureau of Composites stored in
-    Grib format.
+    The default arguments follow the layout written by `download_cwb_opendata`.
 
     Parameters
     ----------
-    path : str
-        path of the file to save.
-
-    remove_old : bool
-        True, False. Remove exist data (default = True)
-
-    authorization : str
-        * required 氣象開放資料平台會員授權碼
+    start, end : datetime
+        First and last time of the period, both included.
+    root_path : str
+        Root directory of the archive.
+    path_fmt : str
+        strftime format of the sub-directories of each file.
+    fn_pattern : str
+        strftime format of the file names, without extension.
+    fn_ext : str
+        Extension of the file names.
+    timestep : int
+        Time step between the files, in minutes.
 
-    limit : int
-        限制最多回傳的資料, 預設為None
+    Returns
+    -------
+    out : tuple
+        Two lists (filenames, timestamps), as returned by
+        `pysteps.io.archive.find_by_date`. Missing files are set to None.
+    """
+    filenames = []
+    timestamps = []
+    t = start
+    while t <= end:
+        fn = _compref_filename(t, root_path, path_fmt, fn_pattern, fn_ext)
+        filenames.append(fn if os.path.isfile(fn) else None)
+        timestamps.append(t)
+        t += timedelta(minutes=timestep)
 
-    offset : int
-        指定從第幾筆後開始回傳, 預設為第 0 筆開始回傳
+    return filenames, timestamps
 
-    timeFrom : str
-        時間區段, 篩選需要之時間區段，時間從「timeFrom」開始篩選，直到內容之最後時間，並可與參數「timeTo」 合併使用，格式為「yyyy-MM-dd hh:mm:ss」
 
-    timeTo : str
-        時間區段, 篩選需要之時間區段，時間從內容之最初時間開始篩選，直到「timeTo」，並可與參數「timeFrom」 合併使用，格式為「yyyy-MM-ddThh:mm:ss」
+def read_timeseries_cwb_compref(inputfns, gzipped=False, roi=None, dtype="double",
+                                num_workers=None, rainrate=False, zr_a=ZR_A, zr_b=ZR_B,
+                                levels=None, colmax=False):
+    """
+    Read a time series of COMPREF files into a single (t, ny, nx) array.
 
-    {extra_kwargs_doc}
+    The output array is allocated once and each frame is decoded directly into
+    its time step. Frames are decoded concurrently by a pool of threads: gzip
+    decompression and the numpy operations release the GIL, so the decoding
+    scales with the number of cores.
 
-    ####################################################################################
-    # The {extra_kwargs_doc} above is needed to add default keywords added to this     #
-    # importer by the pysteps.decorator.postprocess_import decorator.                  #
-    # IMPORTANT: Remove these box in the final version of this function                #
-    ####################################################################################
+    Parameters
+    ----------
+    inputfns : list of str or tuple
+        List of file names, or the (filenames, timestamps) tuple returned by
+        `find_cwb_compref` or `pysteps.io.archive.find_by_date`. Missing files
+        (None) are filled with NaN, or with the raw missing value for integer
+        data types.
+    gzipped : bool
+        Whether the files are gzip compressed.
+    roi : tuple, optional
+        Region of interest, see `importer_cwb_compref_cwb`. It is located with
+        the grid of the first available frame.
+    dtype : str
+        Data type of the output array. See `read_cwb_compref`.
+    num_workers : int, optional
+        Number of decoding threads. Defaults to the number of CPUs.
+    rainrate : bool
+        Return rain rates in mm/h, see `importer_cwb_compref_cwb`. The lookup
+        table is built once for the whole series.
+    zr_a, zr_b : float
+        Coefficients of the Z-R relationship.
+    levels : int, slice or sequence of int, optional
+        Levels of multi-level files, see `importer_cwb_compref_cwb`.
+    colmax : bool
+        Read the column maximum of the levels, see `importer_cwb_compref_cwb`.
 
     Returns
     -------
+    precip : array
+        Reflectivity fields in dBZ (or rain rates in mm/h), with dimensions
+        (t, ny, nx), or (t, nlevels, ny, nx) for multi-level files.
+    quality : None
+    metadata : dict
+        Metadata of the first available frame, with the additional key
+        "timestamps".
+    """
+    if isinstance(inputfns, tuple):
+        filenames, timestamps = inputfns
+        timestamps = list(timestamps)
+    else:
+        filenames = inputfns
+        timestamps = [None] * len(filenames)
+
+    available = [i for i, fn in enumerate(filenames) if fn is not None]
+    if not available:
+        raise IOError("no input files found")
+
+    header = read_compref_header(filenames[available[0]], gzipped=gzipped)
+    window = roi_window(header, roi) if roi is not None else None
+    shape = _payload_shape(header, window, levels, colmax)
+    precip = np.empty((len(filenames),) + shape, dtype=dtype)
+    raw = precip.dtype.kind in "iu"
+    lut = _rainrate_lut(header, precip.dtype, zr_a, zr_b) if rainrate else None
+
+    def _decode(i):
+        if filenames[i] is None:
+            precip[i] = header.missing * header.var_scale if raw else np.nan
+            return i, None
+        return i, decode_compref(
+            filenames[i], gzipped=gzipped, out=precip[i], window=window, lut=lut,
+            levels=levels, colmax=colmax,
+        )[1]
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(filenames)))
+
+    if num_workers == 1:
+        results = [_decode(i) for i in range(len(filenames))]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
 
-    None
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_decode, range(len(filenames))))
 
-    """
-    if limit is None:
-        limit=''
-    if remove_exist:
-        import shutil
-        os.makedirs(path, exist_ok=True)
-        shutil.rmtree(path)        
-
-    timeFrom2 = datetime.strptime(timeFrom, '%Y-%m-%d %H:%M:%S').strftime("%Y-%m-%dT%H%%3A%M%%3A%S")
-    timeTo2 = datetime.strptime(timeTo, '%Y-%m-%d %H:%M:%S').strftime("%Y-%m-%dT%H%%3A%M%%3A%S")
-    urlc = 'https://opendata.cwb.gov.tw/historyapi/v1/getMetadata/O-A0059-001' + '?Authorization=' + authorization + '&limit=' + str(limit) + '&offset=' + str(offset) + '&format=' + 'XML' + '&timeFrom=' + timeFrom2 + '&timeTo='  +timeTo2
-    
-    RawDataList = xmltodict.parse(request.urlopen(urlc).read().decode("utf-8"))
-    
-    TList = RawDataList['cwbopendata']['dataset']['resources']['resource']['data']['time']
-    
-    for i in np.arange(0,np.size(TList,0),1):
-        tLnum  = datetime.strptime(TList[i]['dataTime'], '%Y-%m-%d %H:%M:%S').timestamp()
-        tLyy = datetime.utcfromtimestamp(tLnum).strftime('%Y')
-        tLmm = datetime.utcfromtimestamp(tLnum).strftime('%m')
-        tLdd = datetime.utcfromtimestamp(tLnum).strftime('%d')
-        tLhh = datetime.utcfromtimestamp(tLnum).strftime('%H')
-        tLmn = datetime.utcfromtimestamp(tLnum).strftime('%M')
-        tLpath = path+'/'+tLyy+'/'+tLmm+'/'+tLdd+'/COMPREF.OpenData.'+tLyy+tLmm+tLdd+'.'+tLhh+tLmn+'.gz'
-        
-        os.makedirs(path, exist_ok=True)
-        if not os.path.isfile(tLpath):
-            print("Making file:  "+tLpath)
-            url = TList[i]['url']
-
-            RawData = xmltodict.parse(request.urlopen(url).read().decode("utf-8"))
-
-            parameterSet = RawData['cwbopendata']['dataset']['datasetInfo']['parameterSet']['parameter']
-
-            mosradar = parameterSet[0]['radarName'].split('、')
-            
-            nradar = np.size(mosradar)
-
-            for i in np.arange(0,nradar,1):
-                if mosradar[i].find('五分山') !=-1:
-                    mosradar[i]='RCWF'
-                elif mosradar[i].find('花蓮') !=-1:
-                    mosradar[i]='RCHL'
-                elif mosradar[i].find('七股') !=-1:
-                    mosradar[i]='RCCG'
-                elif mosradar[i].find('墾丁') !=-1:
-                    mosradar[i]='RCKT'
-                elif mosradar[i].find('樹林') !=-1:
-                    mosradar[i]='RCSL'
-                elif mosradar[i].find('南屯') !=-1:
-                    mosradar[i]='RCNT'
-                elif mosradar[i].find('林園') !=-1:
-                    mosradar[i]='RCLY'
-                elif mosradar[i].find('馬公') !=-1:
-                    mosradar[i]='RCMK'
-                elif mosradar[i].find('清泉崗') !=-1:
-                    mosradar[i]='RCCK'
-                elif mosradar[i].find('石垣') !=-1:
-                    mosradar[i]='ISHI'
-                elif mosradar[i].find('綠島') !=-1:
-                    mosradar[i]='RCGI'
-                
-            lon0 =  np.fromstring(parameterSet[1]['parameterValue'],
-                                  dtype=np.float16,
-                                  count=-1,
-                                  sep=',')[0]
-
-            lat0 =  np.fromstring(parameterSet[1]['parameterValue'],
-                                  dtype=np.float16,
-                                  count=-1,
-                                  sep=',')[1]
-
-            res = float(parameterSet[2]['parameterValue'])
-
-            t0 = parameterSet[3]['parameterValue']
-            t0num   = datetime.strptime(t0, '%Y-%m-%dT%H:%M:%S%z').timestamp()
-            utct0 = datetime.utcfromtimestamp(t0num).strftime('%Y-%m-%d %H:%M:%S')
-
-            nx = np.fromstring(parameterSet[4]['parameterValue'],
-                              dtype=np.int16,
-                              count=-1,
-                              sep='*')[0]
-
-            ny = np.fromstring(parameterSet[4]['parameterValue'],
-                              dtype=np.int16,
-                              count=-1,
-                              sep='*')[1]
-
-            unit = parameterSet[5]['parameterValue']
-
-            dbz = np.fromstring(RawData['cwbopendata']['dataset']['contents']['content'],
-                                dtype=np.float32,
-                                count=-1,
-                                sep=',').astype(np.int16)
-
-            dbz = dbz.reshape(ny,nx)
-
-            yyyy = utct0[0:4]
-            mm = utct0[5:7]
-            dd = utct0[8:10]
-            hh = utct0[11:13]
-            mn = utct0[14:16]
-            ss = utct0[17:19]
-            nz = 1
-            proj = 'LL'
-            map_scale = 1000
-            projlat0 = 30*map_scale
-            projlat1 = 60*map_scale
-            projlon = 120.75*map_scale
-            xy_scale = 1000
-            alon = lon0*xy_scale
-            alat = (lat0+res*(ny-1))*xy_scale
-            dxy_scale = 100000
-            dx = res*dxy_scale
-            dy = res*dxy_scale
-            zht = 0
-            z_scale = 1
-            i_bb_mode = -12922
-            unkn01 = np.zeros(9)
-            varname1 = ['Q','P','E','O']
-            varname2 = [1,2,3,4]
-            varunit = unit
-            unkn02 = 'TRA'
-            var_scale = 10
-            missing = -999
-            nradar = nradar
-            mosradar = mosradar
-
-            os.makedirs(path+'/'+tLyy+'/'+tLmm+'/'+tLdd, exist_ok=True)
-         
-            #write BUFFER
-            
-            buffer = np.array([yyyy,mm,dd,hh,mn,ss,nx,ny,nz], dtype='i4').tobytes()
-            buffer += np.array(proj, dtype='a4').tobytes()
-            buffer += np.array([map_scale,projlat0,projlat1,projlon,alon,alat,xy_scale,dx,dy,
-                      dxy_scale,zht,z_scale,i_bb_mode], dtype='i4').tobytes()
-            buffer += np.array(unkn01, dtype='i4').tobytes()
-            buffer += np.array(varname1, dtype='a1').tobytes()
-            buffer += np.array(varname2, dtype='i4').tobytes()
-            buffer += np.array(varunit, dtype='a3').tobytes()
-            buffer += np.array(unkn02, dtype='a3').tobytes()
-            buffer += np.array([var_scale,missing,nradar], dtype='i4').tobytes()
-            buffer += np.array(mosradar, dtype='a4').tobytes()
-
-            dbz1d = dbz.flatten()
-            buffer += np.array(dbz1d*var_scale, dtype='i2').tobytes()
-            gz_fid = gzip.open(tLpath, 'wb')
-            gz_fid.write(buffer)
-            gz_fid.close()
-    return None
+    for i, frame_header in results:
+        if frame_header is not None:
+            timestamps[i] = frame_header.time
+
+    metadata = _compref_metadata(
+        header, raw=raw, window=window, zr=(zr_a, zr_b) if rainrate else None,
+        levels=levels, colmax=colmax,
+    )
+    metadata["timestamps"] = np.array(timestamps)
+
+    return precip, None, metadata
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timers and byte counters of the importer and of the downloads.
+
+The decoding of a COMPREF file goes through several stages (reading the
+header, decompressing the payload, scaling and masking the values, computing
+the grid geometry, resampling, ...), and downloading a frame through a HTTP
+request, a conversion and a compression. This module records the time spent
+and the bytes processed by each stage, to locate the bottleneck of a
+deployment.
+
+The instrumentation is off by default. It is turned on by a collector: either
+`collect`, which sums the records of each stage,
+
+>>> from pysteps_importer_cwb import instrument
+>>> with instrument.collect() as stats:
+...     importer(filename)
+>>> print(stats)
+
+or a callback receiving every record, e.g. to feed a monitoring system:
+
+>>> instrument.add_callback(lambda stage, seconds, nbytes: ...)
+
+Stages of the import:
+
+==========  ================================================================
+header      reading and parsing the header (bytes: header size)
+gunzip      decompressing the payload of gzipped files (bytes: decompressed)
+scale       scaling the raw values to dBZ
+mask        setting the pixels without value to NaN
+lut         converting the raw values with the rain rate lookup table
+colmax      column maximum of the levels
+metadata    grid geometry (pyproj) and metadata
+regrid      resampling to the TWD97 grid
+cache       reading a field from the cache (`pysteps_importer_cwb.cache`)
+==========  ================================================================
+
+The payload of uncompressed files is memory-mapped: it is read by the
+following stages (scale, mask, lut or colmax).
+
+Stages of the downloads (`pysteps_importer_cwb.opendata`):
+
+==========  ================================================================
+http        HTTP request, from the request to the end of the response
+            (bytes: response body)
+http_error  failed HTTP request, retried or not
+convert     conversion of an OpenData frame to a COMPREF file
+compress    gzip compression (bytes: compressed size)
+write       writing the file (bytes: file size)
+==========  ================================================================
+
+Records are emitted by the thread running the stage, so the callbacks must
+be thread-safe. When nothing collects, the instrumented code only checks
+whether `timer` returned None.
+"""
+
+# Import the needed libraries
+import contextlib
+import threading
+from time import perf_counter
+
+# Collectors of the records, called as collector(stage, seconds, nbytes). The
+# tuple is replaced, never modified, so that it can be read without a lock.
+_collectors = ()
+_lock = threading.Lock()
+
+
+def add_callback(callback):
+    """
+    Start sending the records to a callback.
+
+    Parameters
+    ----------
+    callback : callable
+        Called as ``callback(stage, seconds, nbytes)`` for every record, by
+        the thread running the stage.
+    """
+    global _collectors
+    with _lock:
+        _collectors = _collectors + (callback,)
+
+
+def remove_callback(callback):
+    """
+    Stop sending the records to a callback added by `add_callback`.
+
+    Parameters
+    ----------
+    callback : callable
+    """
+    global _collectors
+    with _lock:
+        collectors = list(_collectors)
+        collectors.remove(callback)
+        _collectors = tuple(collectors)
+
+
+class Timer(object):
+    """
+    Timer of consecutive stages.
+
+    Each `lap` records the time since the previous lap (or since the creation
+    of the timer) under the name of a stage.
+    """
+
+    __slots__ = ("_collectors", "_last")
+
+    def __init__(self, collectors):
+        self._collectors = collectors
+        self._last = perf_counter()
+
+    def lap(self, stage, nbytes=0):
+        """Record the time since the previous lap under ``stage``."""
+        now = perf_counter()
+        for collector in self._collectors:
+            collector(stage, now - self._last, nbytes)
+        self._last = perf_counter()
+
+    def skip(self):
+        """Restart the timer without recording, e.g. after a timed sub-call."""
+        self._last = perf_counter()
+
+
+def timer():
+    """
+    Timer of the stages of an instrumented function.
+
+    Returns
+    -------
+    timer : Timer or None
+        None when nothing collects the records, so that the instrumented code
+        costs a single test::
+
+            timer = instrument.timer()
+            ...
+            if timer is not None:
+                timer.lap("gunzip", nbytes)
+    """
+    collectors = _collectors
+    if collectors:
+        return Timer(collectors)
+    return None
+
+
+class StageStats(object):
+    """
+    Accumulated records of a stage.
+
+    Attributes
+    ----------
+    count : int
+        Number of records.
+    seconds : float
+        Total time.
+    nbytes : int
+        Total number of bytes.
+    """
+
+    __slots__ = ("count", "seconds", "nbytes")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.nbytes = 0
+
+    @property
+    def throughput(self):
+        """Bytes per second, or None without bytes or time."""
+        if not self.nbytes or not self.seconds:
+            return None
+        return self.nbytes / self.seconds
+
+    def as_dict(self):
+        return dict(count=self.count, seconds=self.seconds, nbytes=self.nbytes)
+
+    def __repr__(self):
+        return "StageStats(count=%d, seconds=%.6f, nbytes=%d)" % (
+            self.count, self.seconds, self.nbytes
+        )
+
+
+class Stats(object):
+    """
+    Collector summing the records of each stage.
+
+    Stats are mappings of the names of the stages to `StageStats`, in the
+    order of their first record. Their string form is a table of the stages.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, seconds, nbytes=0):
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = StageStats()
+            stats.count += 1
+            stats.seconds += seconds
+            stats.nbytes += nbytes
+
+    def __getitem__(self, stage):
+        return self._stages[stage]
+
+    def __contains__(self, stage):
+        return stage in self._stages
+
+    def __iter__(self):
+        return iter(list(self._stages))
+
+    def __len__(self):
+        return len(self._stages)
+
+    def items(self):
+        return list(self._stages.items())
+
+    def clear(self):
+        """Forget all the records."""
+        with self._lock:
+            self._stages.clear()
+
+    def as_dict(self):
+        """Records as a dict of dicts, e.g. to serialize them as JSON."""
+        return {stage: stats.as_dict() for stage, stats in self.items()}
+
+    def __str__(self):
+        lines = ["%-10s %8s %12s %12s %10s" % (
+            "stage", "count", "seconds", "MB", "MB/s"
+        )]
+        for stage, stats in self.items():
+            throughput = stats.throughput
+            lines.append(
+                "%-10s %8d %12.6f %12.3f %10s" % (
+                    stage, stats.count, stats.seconds, stats.nbytes / 1e6,
+                    "" if throughput is None else "%.1f" % (throughput / 1e6),
+                )
+            )
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def collect(stats=None):
+    """
+    Collect the records of the stages run within the context.
+
+    The records of all the threads are collected, including those of other
+    threads running concurrently.
+
+    Parameters
+    ----------
+    stats : Stats, optional
+        Collector accumulating the records, e.g. to sum several contexts.
+
+    Yields
+    ------
+    stats : Stats
+    """
+    if stats is None:
+        stats = Stats()
+    add_callback(stats)
+    try:
+        yield stats
+    finally:
+        remove_callback(stats)
@@ -0,0 +1,706 @@
+# -*- coding: utf-8 -*-
+"""
+Download of the CWB OpenData reflectivity composites (O-A0059-001).
+
+The frames listed by the history API are fetched concurrently by a bounded pool
+of threads. Each thread keeps its own persistent HTTP connection per host, the
+requests are retried with an exponential backoff, and every frame is written to
+a temporary file that is atomically renamed, so an interrupted or concurrent
+run never leaves a partial ``.gz`` file behind.
+"""
+
+# Import the needed libraries
+import http.client
+import io
+import json
+import os
+import threading
+import time
+import warnings
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+import numpy as np
+
+from pysteps_importer_cwb import instrument
+from pysteps_importer_cwb.compref import CompRefHeader, compress_compref, encode_compref
+from pysteps_importer_cwb.utils import write_atomic
+
+OPENDATA_URL = "https://opendata.cwb.gov.tw/historyapi/v1/getMetadata/O-A0059-001"
+
+# Station codes of the radars listed (in Chinese) in the OpenData frames.
+RADAR_CODES = [
+    ("五分山", "RCWF"),
+    ("花蓮", "RCHL"),
+    ("七股", "RCCG"),
+    ("墾丁", "RCKT"),
+    ("樹林", "RCSL"),
+    ("南屯", "RCNT"),
+    ("林園", "RCLY"),
+    ("馬公", "RCMK"),
+    ("清泉崗", "RCCK"),
+    ("石垣", "ISHI"),
+    ("綠島", "RCGI"),
+]
+
+
+class HTTPClient(object):
+    """
+    Minimal HTTP(S) client with persistent connections and retries.
+
+    Each thread using the client gets its own connection per (scheme, host),
+    which is kept alive and reused by the following requests of the thread.
+
+    Parameters
+    ----------
+    timeout : float
+        Timeout in seconds of the connection and of each socket operation.
+    retries : int
+        Number of retries after a failed request.
+    backoff : float
+        Delay in seconds before the first retry, doubled at every retry.
+    """
+
+    def __init__(self, timeout=30.0, retries=3, backoff=0.5):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault("connections", {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+            with self._lock:
+                self._opened.append(conn)
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self._local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def get(self, url):
+        """
+        Fetch a URL.
+
+        Connection errors, timeouts and 429/5xx responses are retried, other
+        HTTP errors are raised immediately. The time and the size of the
+        responses are recorded as the "http" stage of
+        `pysteps_importer_cwb.instrument`, and the failed attempts as the
+        "http_error" stage.
+
+        Parameters
+        ----------
+        url : str
+
+        Returns
+        -------
+        body : bytes
+        """
+        parts = urlsplit(url)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            timer = instrument.timer()
+            try:
+                conn = self._connection(parts.scheme, parts.netloc)
+                conn.request("GET", target)
+                response = conn.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self._drop_connection(parts.scheme, parts.netloc)
+            except (OSError, http.client.HTTPException) as err:
+                if timer is not None:
+                    timer.lap("http_error")
+                self._drop_connection(parts.scheme, parts.netloc)
+                error = IOError("GET %s failed: %s" % (url, err))
+            else:
+                if timer is not None:
+                    timer.lap("http" if response.status == 200 else "http_error",
+                              len(body))
+                if response.status == 200:
+                    return body
+                error = IOError("GET %s returned HTTP %d" % (url, response.status))
+                if response.status != 429 and response.status < 500:
+                    raise error
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        raise error
+
+    def close(self):
+        """Close the connections of all the threads, once they are done."""
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for conn in opened:
+            conn.close()
+        self._local = threading.local()
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_opendata_metadata(xml):
+    """
+    List the frames of an OpenData metadata document.
+
+    Parameters
+    ----------
+    xml : bytes or file-like
+        Metadata document returned by the history API.
+
+    Returns
+    -------
+    frames : list of dict
+        One dict per frame, with the keys "dataTime" and "url".
+    """
+    if isinstance(xml, (bytes, bytearray)):
+        xml = io.BytesIO(xml)
+    frames = []
+    for _, elem in ElementTree.iterparse(xml, events=("end",)):
+        if _local_name(elem.tag) == "time":
+            frames.append({_local_name(c.tag): (c.text or "").strip() for c in elem})
+            elem.clear()
+    return frames
+
+
+def parse_opendata_frame(xml, var_scale=10):
+    """
+    Parse an OpenData frame with a streaming parser.
+
+    Only the ``parameter`` elements and the ``content`` text are kept, the
+    elements are discarded as soon as they are parsed.
+
+    Parameters
+    ----------
+    xml : bytes or file-like
+        Frame document.
+    var_scale : int
+        Scale of the returned integer values.
+
+    Returns
+    -------
+    parameters : list of dict
+        Children (tag: text) of each ``parameter`` element, in order.
+    values : 1D array, int16
+        Content values multiplied by ``var_scale`` and rounded.
+    """
+    if isinstance(xml, (bytes, bytearray)):
+        xml = io.BytesIO(xml)
+    parameters = []
+    values = None
+    for _, elem in ElementTree.iterparse(xml, events=("end",)):
+        name = _local_name(elem.tag)
+        if name == "parameter":
+            parameters.append(
+                {_local_name(c.tag): (c.text or "").strip() for c in elem}
+            )
+            elem.clear()
+        elif name == "content":
+            values = decode_csv_int16(elem.text or "", scale=var_scale)
+            elem.clear()
+    if values is None:
+        raise ValueError("The OpenData frame has no content")
+    return parameters, values
+
+
+# Largest scaled value of the decoded content.
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def decode_csv_int16(text, scale=10, chunk_size=1 << 20):
+    """
+    Decode comma-separated numbers into scaled int16 values.
+
+    The text is decoded by numpy's C parser one chunk at a time, and each chunk
+    is scaled and rounded directly into the int16 output, so that no full-size
+    floating point array is created. Scaled values out of the int16 range,
+    including NaN and infinities, are rejected rather than wrapped around.
+
+    Parameters
+    ----------
+    text : str
+        Comma-separated numbers, whitespace is ignored.
+    scale : int
+        Scale applied to the numbers before rounding to integers.
+    chunk_size : int
+        Approximate number of characters decoded at once.
+
+    Returns
+    -------
+    values : 1D array, int16
+
+    Raises
+    ------
+    ValueError
+        If a number is malformed or out of the int16 range once scaled.
+    """
+    text = text.strip()
+    if not text:
+        return np.empty(0, dtype=np.int16)
+
+    values = np.empty(text.count(",") + 1, dtype=np.int16)
+    nvalues = 0
+    start = 0
+    with warnings.catch_warnings():
+        # Malformed numbers stop the parser with a DeprecationWarning (numpy < 2)
+        # or a ValueError.
+        warnings.simplefilter("error", DeprecationWarning)
+        while start < len(text):
+            stop = text.find(",", start + chunk_size)
+            if stop == -1:
+                stop = len(text)
+            try:
+                chunk = np.fromstring(text[start:stop], dtype=np.float64, sep=",")
+            except (DeprecationWarning, ValueError):
+                raise ValueError("Malformed number in %r" % text[start:stop][:80])
+            np.multiply(chunk, scale, out=chunk)
+            np.rint(chunk, out=chunk)
+            if not (np.abs(chunk) <= INT16_MAX).all():
+                raise ValueError(
+                    "Number out of the int16 range in %r" % text[start:stop][:80]
+                )
+            values[nvalues : nvalues + len(chunk)] = chunk
+            nvalues += len(chunk)
+            start = stop + 1
+    if nvalues != len(values):
+        raise ValueError("%d values decoded, %d expected" % (nvalues, len(values)))
+    return values
+
+
+def _frame_path(path, data_time):
+    """Archive file name of a frame, in UTC, from its local (UTC+8) dataTime."""
+    tLnum = datetime.strptime(data_time, "%Y-%m-%d %H:%M:%S").timestamp()
+    utc = datetime.utcfromtimestamp(tLnum)
+    return os.path.join(
+        path,
+        utc.strftime("%Y"),
+        utc.strftime("%m"),
+        utc.strftime("%d"),
+        "COMPREF.OpenData." + utc.strftime("%Y%m%d.%H%M") + ".gz",
+    )
+
+
+def _radar_codes(radar_names):
+    mosradar = radar_names.split("、")
+    for i, name in enumerate(mosradar):
+        for chinese_name, code in RADAR_CODES:
+            if name.find(chinese_name) != -1:
+                mosradar[i] = code
+                break
+    return mosradar
+
+
+def _frame_to_compref(xml):
+    """Convert an OpenData frame (XML) to the bytes of a COMPREF file."""
+    var_scale = 10
+    parameterSet, dbz = parse_opendata_frame(xml, var_scale=var_scale)
+
+    mosradar = _radar_codes(parameterSet[0]["radarName"])
+
+    lon0, lat0 = [float(v) for v in parameterSet[1]["parameterValue"].split(",")[:2]]
+
+    res = float(parameterSet[2]["parameterValue"])
+
+    t0 = parameterSet[3]["parameterValue"]
+    t0num = datetime.strptime(t0, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+
+    nx, ny = [int(v) for v in parameterSet[4]["parameterValue"].split("*")[:2]]
+    if dbz.size != nx * ny:
+        raise ValueError("%d values for a %d*%d grid" % (dbz.size, nx, ny))
+
+    unit = parameterSet[5]["parameterValue"]
+
+    map_scale = 1000
+    xy_scale = 1000
+    dxy_scale = 100000
+    header = CompRefHeader(
+        time=datetime.utcfromtimestamp(t0num),
+        nx=nx,
+        ny=ny,
+        nz=1,
+        proj="LL",
+        map_scale=map_scale,
+        projlat0=30 * map_scale,
+        projlat1=60 * map_scale,
+        projlon=round(120.75 * map_scale),
+        alon=round(lon0 * xy_scale),
+        alat=round((lat0 + res * (ny - 1)) * xy_scale),
+        xy_scale=xy_scale,
+        dx=round(res * dxy_scale),
+        dy=round(res * dxy_scale),
+        dxy_scale=dxy_scale,
+        zht=(0,),
+        z_scale=1,
+        i_bb_mode=-12922,
+        unkn01=(0,) * 9,
+        varname1="QPEO",
+        varname2=(1, 2, 3, 4),
+        varunit=unit,
+        unkn02="TRA",
+        var_scale=var_scale,
+        missing=-999,
+        nradar=len(mosradar),
+        mosradar=tuple(mosradar),
+        data_offset=None,
+    )
+    return encode_compref(header, dbz)
+
+
+def _download_frames(client, frames, num_workers, compresslevel=6):
+    """
+    Download (url, filename) frames concurrently.
+
+    Returns one (filename, size, crc32) tuple per frame, with size and crc32 of
+    the written gzip file, or None for the frames that failed.
+    """
+
+    def _download(frame):
+        url, tLpath = frame
+        print("Making file:  " + tLpath)
+        try:
+            xml = client.get(url)
+            timer = instrument.timer()
+            raw = _frame_to_compref(xml)
+            if timer is not None:
+                timer.lap("convert", len(raw))
+            data = compress_compref(raw, compresslevel=compresslevel)
+            if timer is not None:
+                timer.lap("compress", len(data))
+            write_atomic(tLpath, data)
+            if timer is not None:
+                timer.lap("write", len(data))
+        except Exception as err:
+            print("Failed file:  %s (%s)" % (tLpath, err))
+            return None
+        return tLpath, len(data), zlib.crc32(data)
+
+    if num_workers > 1 and len(frames) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(_download, frames))
+    return [_download(frame) for frame in frames]
+
+
+def _metadata_url(authorization, limit, offset, timeFrom, timeTo, base_url):
+    timeFrom2 = datetime.strptime(timeFrom, "%Y-%m-%d %H:%M:%S").strftime(
+        "%Y-%m-%dT%H%%3A%M%%3A%S"
+    )
+    timeTo2 = datetime.strptime(timeTo, "%Y-%m-%d %H:%M:%S").strftime(
+        "%Y-%m-%dT%H%%3A%M%%3A%S"
+    )
+    return (
+        base_url
+        + "?Authorization=" + authorization
+        + "&limit=" + str(limit)
+        + "&offset=" + str(offset)
+        + "&format=" + "XML"
+        + "&timeFrom=" + timeFrom2
+        + "&timeTo=" + timeTo2
+    )
+
+
+def download_cwb_opendata(
+        path="./radar/cwb_opendata",
+        remove_exist=True,
+        authorization="CWB-XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+        limit=None,
+        offset=0,
+        timeFrom=(datetime.now()-timedelta(seconds=3600*2)).strftime("%Y-%m-%d %H:%M:%S"),
+        timeTo=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        num_workers=4,
+        timeout=30.0,
+        retries=3,
+        base_url=OPENDATA_URL,
+        compresslevel=6,
+        **kwargs):
+    """
+    Download the CWB OpenData reflectivity composites as COMPREF files.
+
+    The files are saved as path/YYYY/MM/DD/COMPREF.OpenData.YYYYMMDD.HHMN.gz,
+    with the times in UTC. Files already present are not downloaded again.
+
+    Parameters
+    ----------
+    path : str
+        path of the file to save.
+
+    remove_exist : bool
+        True, False. Remove exist data (default = True)
+
+    authorization : str
+        * required 氣象開放資料平台會員授權碼
+
+    limit : int
+        限制最多回傳的資料, 預設為None
+
+    offset : int
+        指定從第幾筆後開始回傳, 預設為第 0 筆開始回傳
+
+    timeFrom : str
+        時間區段, 篩選需要之時間區段，時間從「timeFrom」開始篩選，直到內容之最後時間，並可與參數「timeTo」 合併使用，格式為「yyyy-MM-dd hh:mm:ss」
+
+    timeTo : str
+        時間區段, 篩選需要之時間區段，時間從內容之最初時間開始篩選，直到「timeTo」，並可與參數「timeFrom」 合併使用，格式為「yyyy-MM-ddThh:mm:ss」
+
+    num_workers : int
+        Maximum number of frames downloaded concurrently.
+
+    timeout : float
+        Timeout in seconds of each HTTP connection or read.
+
+    retries : int
+        Number of retries, with exponential backoff, of a failed request.
+
+    base_url : str
+        URL of the metadata API.
+
+    compresslevel : int
+        gzip compression level of the files, from 1 (fastest) to 9 (smallest).
+
+    Returns
+    -------
+    filenames : list of str
+        Files written by this call. Frames that could not be downloaded are
+        reported and skipped; they are retried by the next call.
+    """
+    if limit is None:
+        limit = ''
+    if remove_exist:
+        import shutil
+        os.makedirs(path, exist_ok=True)
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+
+    client = HTTPClient(timeout=timeout, retries=retries)
+    urlc = _metadata_url(authorization, limit, offset, timeFrom, timeTo, base_url)
+
+    TList = parse_opendata_metadata(client.get(urlc))
+
+    frames = []
+    for item in TList:
+        tLpath = _frame_path(path, item['dataTime'])
+        if not os.path.isfile(tLpath):
+            frames.append((item['url'], tLpath))
+
+    written = _download_frames(client, frames, num_workers, compresslevel)
+    client.close()
+
+    return [result[0] for result in written if result is not None]
+
+
+SYNC_STATE_FILE = ".sync_state.json"
+
+
+def _load_sync_state(state_file):
+    try:
+        with open(state_file) as fid:
+            return json.load(fid)
+    except FileNotFoundError:
+        return {"last_dataTime": None, "files": {}, "failures": {}}
+
+
+def _save_sync_state(state_file, state):
+    write_atomic(state_file, json.dumps(state, indent=1, sort_keys=True).encode())
+
+
+def _prune_sync_state(state, lookback):
+    """Forget the frames older than ``lookback`` seconds before the last one."""
+    if state["last_dataTime"] is None:
+        return
+    fmt = "%Y-%m-%d %H:%M:%S"
+    last = datetime.strptime(state["last_dataTime"], fmt)
+    oldest = (last - timedelta(seconds=lookback)).strftime(fmt)
+    state["files"] = {
+        relpath: record
+        for relpath, record in state["files"].items()
+        if record["dataTime"] >= oldest
+    }
+    state["failures"] = {
+        data_time: count
+        for data_time, count in state["failures"].items()
+        if data_time >= oldest
+    }
+
+
+def _file_record(filename, data_time):
+    """State record (dataTime, size and CRC32) of a file of the archive."""
+    with open(filename, "rb") as fid:
+        data = fid.read()
+    return dict(dataTime=data_time, size=len(data), crc32=zlib.crc32(data))
+
+
+def sync_cwb_opendata(
+        path="./radar/cwb_opendata",
+        authorization="CWB-XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX",
+        timeFrom=None,
+        lookback=7200,
+        poll_interval=None,
+        max_polls=None,
+        state_file=None,
+        num_workers=4,
+        timeout=30.0,
+        retries=3,
+        base_url=OPENDATA_URL,
+        compresslevel=6,
+        max_failures=3):
+    """
+    Incrementally synchronize a local archive with the CWB OpenData composites.
+
+    A small state file records the last synchronized dataTime and the size and
+    CRC32 of the files of the ``lookback`` seconds before it. Each
+    synchronization only requests the frames after the last synchronized one,
+    plus the recorded frames whose file is missing or no longer matches its
+    recorded size and CRC32. The frames whose file already exists (e.g.
+    written by `download_cwb_opendata`) are recorded without being downloaded
+    again. Older files are no longer checked, but nothing is ever removed from
+    the archive.
+
+    A frame that fails holds the last synchronized dataTime back, so that it
+    is requested again by the next synchronization, until it failed
+    ``max_failures`` times: it is then skipped.
+
+    Parameters
+    ----------
+    path : str
+        Root of the archive, with the layout of `download_cwb_opendata`.
+    authorization : str
+        * required 氣象開放資料平台會員授權碼
+    timeFrom : str, optional
+        Start of the first synchronization (UTC+8, "%Y-%m-%d %H:%M:%S"), used
+        when the state file does not exist yet.
+    lookback : float
+        Seconds before now where the first synchronization starts if
+        ``timeFrom`` is not given, and seconds before the last synchronized
+        frame whose files are recorded and checked.
+    poll_interval : float, optional
+        If given, keep synchronizing every ``poll_interval`` seconds, so that
+        new frames are picked up as soon as they are published.
+    max_polls : int, optional
+        Maximum number of synchronizations of the poll loop (unlimited by
+        default).
+    state_file : str, optional
+        State file, by default path/.sync_state.json.
+    num_workers, timeout, retries, base_url, compresslevel
+        See `download_cwb_opendata`.
+    max_failures : int
+        Number of synchronizations where a frame failed before it is skipped.
+
+    Returns
+    -------
+    filenames : list of str
+        Files written, over all the synchronizations.
+    """
+    fmt = "%Y-%m-%d %H:%M:%S"
+    if state_file is None:
+        state_file = os.path.join(path, SYNC_STATE_FILE)
+    os.makedirs(path, exist_ok=True)
+    client = HTTPClient(timeout=timeout, retries=retries)
+
+    written = []
+    npolls = 0
+    state = _load_sync_state(state_file)
+    state.setdefault("failures", {})
+    try:
+        while True:
+            _prune_sync_state(state, lookback)
+            files = state["files"]
+            failures = state["failures"]
+
+            # Start after the last synchronized frame, or at the first damaged one.
+            if state["last_dataTime"] is not None:
+                last = datetime.strptime(state["last_dataTime"], fmt)
+                start = last + timedelta(seconds=1)
+            elif timeFrom is not None:
+                start = datetime.strptime(timeFrom, fmt)
+            else:
+                start = datetime.now() - timedelta(seconds=lookback)
+            damaged = set()
+            for relpath, record in list(files.items()):
+                filename = os.path.join(path, relpath)
+                if (
+                    not os.path.isfile(filename)
+                    or os.path.getsize(filename) != record["size"]
+                    or _file_record(filename, record["dataTime"]) != record
+                ):
+                    del files[relpath]
+                    damaged.add(relpath)
+                    start = min(start, datetime.strptime(record["dataTime"], fmt))
+
+            urlc = _metadata_url(
+                authorization,
+                "",
+                0,
+                start.strftime(fmt),
+                datetime.now().strftime(fmt),
+                base_url,
+            )
+            TList = sorted(
+                parse_opendata_metadata(client.get(urlc)),
+                key=lambda item: item["dataTime"],
+            )
+
+            frames = []
+            for item in TList:
+                tLpath = _frame_path(path, item["dataTime"])
+                relpath = os.path.relpath(tLpath, path)
+                if relpath in files:
+                    continue
+                if relpath not in damaged and os.path.isfile(tLpath):
+                    files[relpath] = _file_record(tLpath, item["dataTime"])
+                    continue
+                frames.append((item["url"], tLpath))
+            results = _download_frames(client, frames, num_workers, compresslevel)
+            results = dict(zip([fn for _, fn in frames], results))
+
+            # The last synchronized frame does not move past a failed frame, so
+            # that the next synchronization requests it again, unless the frame
+            # failed too many times.
+            failed = False
+            for item in TList:
+                tLpath = _frame_path(path, item["dataTime"])
+                if results.get(tLpath, ()) is None:
+                    count = failures.get(item["dataTime"], 0) + 1
+                    failures[item["dataTime"]] = count
+                    if count < max_failures:
+                        failed = True
+                    else:
+                        print("Skipped file: %s (failed %d times)" % (tLpath, count))
+                    continue
+                failures.pop(item["dataTime"], None)
+                if tLpath in results:
+                    _, size, crc32 = results[tLpath]
+                    files[os.path.relpath(tLpath, path)] = dict(
+                        dataTime=item["dataTime"], size=size, crc32=crc32
+                    )
+                    written.append(tLpath)
+                if not failed and (
+                    state["last_dataTime"] is None
+                    or item["dataTime"] > state["last_dataTime"]
+                ):
+                    state["last_dataTime"] = item["dataTime"]
+            _prune_sync_state(state, lookback)
+            _save_sync_state(state_file, state)
+
+            npolls += 1
+            if poll_interval is None or (max_polls is not None and npolls >= max_polls):
+                break
+            time.sleep(poll_interval)
+    finally:
+        client.close()
+
+    return written
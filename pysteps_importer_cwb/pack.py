@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Packed archives of COMPREF frames.
+
+Storing every 10-minute frame in its own gzip file means 144 files per day, and
+millions of files over a multi-year archive. A pack holds any number of frames
+(typically one day) in a single file with an index of the frames, so that any
+frame is read with a single positioned read.
+
+Consecutive frames are very similar: most of the pixels are clear sky or out
+of coverage in both. The frames can therefore be stored as the difference
+("delta") or the bitwise XOR ("xor") of their payload with the previous frame,
+which compresses much better than the frame itself. A key frame, stored as is,
+starts every ``keyframe_interval`` frames and bounds the number of frames to
+decode to read any frame.
+
+Layout of a pack file::
+
+    b"CWBPACK1"
+    frame 0, frame 1, ...   zlib compressed (header + payload) of every frame
+    index                   one _INDEX_DTYPE record per frame, sorted by time
+    trailer                 index offset (<u8), number of frames (<u8),
+                            b"CWBPACK1"
+"""
+
+# Import the needed libraries
+import os
+import threading
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+from pysteps_importer_cwb.compref import (
+    _open,
+    parse_compref_header,
+    read_compref_header,
+)
+from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+from pysteps_importer_cwb.utils import write_atomic
+
+MAGIC = b"CWBPACK1"
+
+ENCODINGS = {None: 0, "delta": 1, "xor": 2}
+
+_INDEX_DTYPE = np.dtype(
+    [
+        ("time", "<i8"),  # seconds since 1970-01-01 (UTC)
+        ("offset", "<u8"),
+        ("size", "<u8"),  # compressed size
+        ("raw_size", "<u8"),  # size of the COMPREF file
+        ("header_size", "<u4"),
+        ("encoding", "u1"),
+        ("keyframe", "<i4"),  # index of the key frame of the frame
+        ("crc32", "<u4"),  # of the COMPREF file
+    ]
+)
+_TRAILER_DTYPE = np.dtype([("offset", "<u8"), ("count", "<u8"), ("magic", "S8")])
+
+
+def _to_seconds(time):
+    return int(time.replace(tzinfo=timezone.utc).timestamp())
+
+
+def _read_raw(filename):
+    """Uncompressed content of a COMPREF file."""
+    with _open(filename, filename.endswith(".gz")) as fid:
+        return fid.read()
+
+
+def _encode(payload, previous, encoding):
+    if encoding == "delta":
+        return np.subtract(payload, previous, dtype="<i2")
+    return np.bitwise_xor(payload, previous)
+
+
+def _decode(payload, previous, encoding):
+    if encoding == ENCODINGS["delta"]:
+        return np.add(payload, previous, dtype="<i2")
+    return np.bitwise_xor(payload, previous)
+
+
+def pack_compref(filenames, packname, encoding="delta", keyframe_interval=36,
+                 compresslevel=6):
+    """
+    Pack COMPREF files in a single file.
+
+    Parameters
+    ----------
+    filenames : list of str
+        COMPREF files, gzipped if their name ends with ".gz". The frames are
+        sorted by the time of their header; None entries are skipped.
+    packname : str
+        Name of the pack file, written atomically.
+    encoding : str or None
+        "delta", "xor" or None: encoding of the frames against the previous
+        frame before compression.
+    keyframe_interval : int
+        Maximum number of consecutive frames between two key frames.
+    compresslevel : int
+        zlib compression level.
+
+    Returns
+    -------
+    packname : str
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown encoding %r" % (encoding,))
+    filenames = [fn for fn in filenames if fn is not None]
+    times = [
+        read_compref_header(fn, gzipped=fn.endswith(".gz")).time for fn in filenames
+    ]
+    order = sorted(range(len(filenames)), key=lambda i: times[i])
+
+    def _write(fid):
+        fid.write(MAGIC)
+        offset = len(MAGIC)
+        index = np.zeros(len(order), dtype=_INDEX_DTYPE)
+        previous = None
+        previous_shape = None
+        keyframe = 0
+        for k, i in enumerate(order):
+            raw = _read_raw(filenames[i])
+            header = parse_compref_header(raw)
+            payload = np.frombuffer(raw, dtype="<i2", offset=header.data_offset)
+            shape = (header.data_offset, payload.shape)
+            is_key = (
+                encoding is None
+                or previous is None
+                or shape != previous_shape
+                or k - keyframe >= keyframe_interval
+            )
+            if is_key:
+                keyframe = k
+                data = raw
+            else:
+                data = raw[: header.data_offset] + _encode(
+                    payload, previous, encoding
+                ).tobytes()
+            compressed = zlib.compress(data, compresslevel)
+            fid.write(compressed)
+            index[k] = (
+                _to_seconds(header.time), offset, len(compressed), len(raw),
+                header.data_offset, 0 if is_key else ENCODINGS[encoding], keyframe,
+                zlib.crc32(raw),
+            )
+            offset += len(compressed)
+            previous = payload
+            previous_shape = shape
+        fid.write(index.tobytes())
+        trailer = np.array([(offset, len(order), MAGIC)], dtype=_TRAILER_DTYPE)
+        fid.write(trailer.tobytes())
+
+    write_atomic(packname, _write)
+    return packname
+
+
+class PackFile(object):
+    """
+    Random access to the frames of a pack.
+
+    The reads are positioned (``os.pread``), so a pack can be shared by
+    several threads. The last decoded payload is kept, so that reading the
+    frames in order decodes every delta frame once.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the pack file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            size = os.fstat(self._fd).st_size
+            nbytes = _TRAILER_DTYPE.itemsize
+            trailer = os.pread(self._fd, nbytes, max(0, size - nbytes))
+            if len(trailer) != nbytes or os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+                raise ValueError("%s is not a COMPREF pack" % filename)
+            trailer = np.frombuffer(trailer, dtype=_TRAILER_DTYPE)[0]
+            if trailer["magic"] != MAGIC:
+                raise ValueError("%s is not a COMPREF pack" % filename)
+            nbytes = int(trailer["count"]) * _INDEX_DTYPE.itemsize
+            self.index = np.frombuffer(
+                os.pread(self._fd, nbytes, int(trailer["offset"])), dtype=_INDEX_DTYPE
+            )
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._lock = threading.Lock()
+        self._last = None  # (position, payload) of the last decoded frame
+
+    def close(self):
+        """Close the pack file."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def times(self):
+        """Times of the frames (UTC), sorted."""
+        return [
+            datetime.fromtimestamp(int(t), timezone.utc).replace(tzinfo=None)
+            for t in self.index["time"]
+        ]
+
+    def position(self, time):
+        """
+        Position of the frame of a given time.
+
+        Parameters
+        ----------
+        time : datetime
+            Time of the frame (UTC).
+
+        Returns
+        -------
+        position : int
+
+        Raises
+        ------
+        KeyError
+            If the pack has no frame at this time.
+        """
+        seconds = _to_seconds(time)
+        k = int(np.searchsorted(self.index["time"], seconds))
+        if k == len(self.index) or self.index["time"][k] != seconds:
+            raise KeyError("No frame at %s in %s" % (time, self.filename))
+        return k
+
+    def _frame_data(self, k):
+        entry = self.index[k]
+        data = os.pread(self._fd, int(entry["size"]), int(entry["offset"]))
+        return zlib.decompress(data), int(entry["header_size"])
+
+    def read_bytes(self, key):
+        """
+        Content of the COMPREF file of a frame.
+
+        Parameters
+        ----------
+        key : int or datetime
+            Position or time of the frame.
+
+        Returns
+        -------
+        raw : bytes
+            Uncompressed COMPREF file, identical to the packed file.
+        """
+        k = key if isinstance(key, (int, np.integer)) else self.position(key)
+        if k < 0:
+            k += len(self.index)
+        entry = self.index[k]
+        first = int(entry["keyframe"])
+        with self._lock:
+            start = first
+            previous = None
+            if self._last is not None and first <= self._last[0] < k:
+                start = self._last[0] + 1
+                previous = self._last[1]
+            for j in range(start, k + 1):
+                data, header_size = self._frame_data(j)
+                payload = np.frombuffer(data, dtype="<i2", offset=header_size)
+                encoding = int(self.index[j]["encoding"])
+                if encoding:
+                    payload = _decode(payload, previous, encoding)
+                previous = payload
+            self._last = (k, previous)
+
+        if entry["encoding"]:
+            data = data[:header_size] + previous.tobytes()
+        if zlib.crc32(data) != entry["crc32"]:
+            raise ValueError("Corrupt frame %d in %s" % (k, self.filename))
+        return data
+
+    def read(self, key, **kwargs):
+        """
+        Import a frame.
+
+        Parameters
+        ----------
+        key : int or datetime
+            Position or time of the frame.
+        **kwargs
+            Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`
+            (roi, dtype, rainrate, regrid, ...).
+
+        Returns
+        -------
+        precipitation : array
+        quality : None
+        metadata : dict
+        """
+        return read_cwb_compref(self.read_bytes(key), **kwargs)
+
+
+def read_packed_cwb_compref(filename, time, **kwargs):
+    """
+    Import a single frame of a pack.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the pack file.
+    time : datetime or int
+        Time (UTC) or position of the frame.
+    **kwargs
+        Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`.
+
+    Returns
+    -------
+    precipitation : array
+    quality : None
+    metadata : dict
+    """
+    with PackFile(filename) as pack:
+        return pack.read(time, **kwargs)
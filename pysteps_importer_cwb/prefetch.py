@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Background prefetching of COMPREF frames.
+
+An operational nowcast loop alternates between importing the latest frames and
+computing the nowcast. The iterators of this module decode the next frames in
+background threads while the consumer works on the current one, so that the
+import latency is hidden behind the computation. The decoded frames wait in a
+bounded queue: when the consumer is slower than the decoding, the background
+threads stop until it catches up, and the memory stays bounded.
+
+In real time, the frames can also be waited for: the iterator polls for each
+expected file until it arrives or a timeout expires.
+"""
+
+# Import the needed libraries
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+
+from pysteps_importer_cwb.importer_cwb_compref import (
+    _compref_filename,
+    read_cwb_compref,
+)
+
+Frame = namedtuple("Frame", ["time", "filename", "precip", "quality", "metadata"])
+Frame.__doc__ = """\
+A frame returned by the prefetching iterators.
+
+Attributes
+----------
+time : datetime or None
+    Time of the frame.
+filename : str or None
+    Name of the file.
+precip, quality, metadata
+    Output of the importer, or None if the file is missing.
+"""
+
+# End of the frames.
+_DONE = object()
+
+
+class FramePrefetcher(object):
+    """
+    Iterator decoding frames ahead of the consumer.
+
+    Parameters
+    ----------
+    items : iterable
+        (time, filename) pairs, in the order of the iteration. The iterable can
+        be infinite, e.g. the expected files of a real-time archive.
+    depth : int
+        Maximum number of decoded frames waiting for the consumer.
+    num_workers : int
+        Number of decoding threads.
+    wait : float or None
+        Time in seconds to wait for each file that does not exist yet, or None
+        to wait indefinitely. Missing files give frames with ``precip=None``.
+    poll_interval : float
+        Time in seconds between two checks of a file being waited for.
+    importer : callable, optional
+        Function ``importer(filename, **kwargs)`` returning (precip, quality,
+        metadata), by default `read_cwb_compref`. E.g. `importer_cwb_compref_cwb`
+        for the pysteps postprocessing.
+    **kwargs
+        Options of the importer.
+
+    Notes
+    -----
+    The files are expected to appear complete, as written by
+    `download_cwb_opendata` (renamed into place).
+    """
+
+    def __init__(self, items, depth=2, num_workers=1, wait=0.0, poll_interval=5.0,
+                 importer=None, **kwargs):
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.importer = read_cwb_compref if importer is None else importer
+        self.kwargs = kwargs
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._done = False
+        self._executor = ThreadPoolExecutor(max_workers=max(1, num_workers))
+        self._thread = threading.Thread(
+            target=self._produce, args=(iter(items),), daemon=True
+        )
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        future = self._queue.get()
+        if future is _DONE:
+            self._done = True
+            raise StopIteration
+        try:
+            return future.result()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop the background decoding and release the queued frames."""
+        self._stop.set()
+        self._done = True
+        while self._thread.is_alive():
+            self._drain()
+            self._thread.join(0.05)
+        self._drain()
+        self._executor.shutdown(wait=True)
+
+    def _drain(self):
+        while True:
+            try:
+                future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future is not _DONE:
+                future.cancel()
+
+    def _put(self, item):
+        """Queue an item, blocking while the queue is full (backpressure)."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _wait_for(self, filename):
+        deadline = None if self.wait is None else time.monotonic() + self.wait
+        while not os.path.isfile(filename):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if self._stop.is_set() or (remaining is not None and remaining <= 0):
+                return False
+            delay = self.poll_interval
+            if remaining is not None:
+                delay = min(delay, remaining)
+            self._stop.wait(delay)
+        return True
+
+    def _decode(self, t, filename, available):
+        if not available:
+            return Frame(t, filename, None, None, None)
+        precip, quality, metadata = self.importer(filename, **self.kwargs)
+        return Frame(t, filename, precip, quality, metadata)
+
+    def _produce(self, items):
+        try:
+            for t, filename in items:
+                available = filename is not None and self._wait_for(filename)
+                if self._stop.is_set():
+                    return
+                future = self._executor.submit(self._decode, t, filename, available)
+                if not self._put(future):
+                    future.cancel()
+                    return
+        except BaseException as err:
+            # Raised to the consumer in place of the next frame.
+            future = Future()
+            future.set_exception(err)
+            self._put(future)
+        self._put(_DONE)
+
+
+def prefetch_cwb_compref(inputfns, depth=2, num_workers=1, wait=0.0,
+                         poll_interval=5.0, importer=None, **kwargs):
+    """
+    Iterate over COMPREF files, decoding the next files in the background.
+
+    Parameters
+    ----------
+    inputfns : list of str or tuple
+        List of file names, or the (filenames, timestamps) tuple returned by
+        `find_cwb_compref` or `pysteps.io.archive.find_by_date`. Missing files
+        (None) give frames with ``precip=None``.
+    depth, num_workers, wait, poll_interval, importer, **kwargs
+        See `FramePrefetcher`.
+
+    Returns
+    -------
+    frames : FramePrefetcher
+        Iterator of `Frame`, to be closed (or used as a context manager) when
+        the iteration is stopped early.
+
+    Examples
+    --------
+    >>> fns = find_cwb_compref(start, end)
+    >>> with prefetch_cwb_compref(fns, gzipped=True) as frames:
+    ...     for frame in frames:
+    ...         nowcast(frame.precip, frame.metadata)
+    """
+    if isinstance(inputfns, tuple):
+        items = zip(inputfns[1], inputfns[0])
+    else:
+        items = ((None, fn) for fn in inputfns)
+    return FramePrefetcher(
+        items, depth=depth, num_workers=num_workers, wait=wait,
+        poll_interval=poll_interval, importer=importer, **kwargs
+    )
+
+
+def iter_cwb_compref(
+        start,
+        end=None,
+        root_path="./radar/cwb_opendata",
+        path_fmt="%Y/%m/%d",
+        fn_pattern="COMPREF.OpenData.%Y%m%d.%H%M",
+        fn_ext="gz",
+        timestep=10,
+        depth=2,
+        num_workers=1,
+        wait=0.0,
+        poll_interval=5.0,
+        importer=None,
+        **kwargs):
+    """
+    Iterate over the frames of an archive, decoding the next ones in the background.
+
+    The files are located with the layout of `find_cwb_compref`. In real time,
+    set ``end=None`` and a ``wait`` covering the publication delay of the
+    frames: the iterator then follows the archive as the files arrive.
+
+    Parameters
+    ----------
+    start : datetime
+        Time of the first frame.
+    end : datetime, optional
+        Time of the last frame, included. Without end the iteration does not
+        stop.
+    root_path, path_fmt, fn_pattern, fn_ext, timestep
+        Layout of the archive, see `find_cwb_compref`.
+    depth, num_workers, wait, poll_interval, importer, **kwargs
+        See `FramePrefetcher`. ``gzipped`` defaults to ``fn_ext == "gz"``.
+
+    Returns
+    -------
+    frames : FramePrefetcher
+        Iterator of `Frame`.
+    """
+    kwargs.setdefault("gzipped", fn_ext == "gz")
+
+    def items():
+        t = start
+        while end is None or t <= end:
+            yield t, _compref_filename(t, root_path, path_fmt, fn_pattern, fn_ext)
+            t += timedelta(minutes=timestep)
+
+    return FramePrefetcher(
+        items(), depth=depth, num_workers=num_workers, wait=wait,
+        poll_interval=poll_interval, importer=importer, **kwargs
+    )
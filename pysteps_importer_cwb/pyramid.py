@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution pyramids of the COMPREF fields.
+
+Coarse nowcasts of the whole domain do not need the full resolution of the
+mosaics. This module averages the fields over blocks of 2x2, 4x4, 8x8, ...
+pixels. All the levels of a pyramid are computed from a single pass over the
+full resolution field: each level is reduced from the block sums of the
+previous one.
+
+The averages ignore the pixels without value, and the reflectivities are
+averaged in linear units (Z = 10 ** (dBZ / 10)) rather than in dBZ, as in
+`pysteps.utils.dimension.aggregate_fields_space`. The metadata describe the
+coarse grids.
+
+The pyramids can be cached next to their source files, in a ".pyramid"
+sub-directory: consumers of the coarse fields then only read the small cached
+arrays, without decoding the full resolution field.
+"""
+
+# Import the needed libraries
+import json
+import os
+
+import numpy as np
+
+from pysteps_importer_cwb.cache import source_key
+from pysteps_importer_cwb.compref import read_compref_header
+from pysteps_importer_cwb.geometry import grid_geometry, roi_window
+from pysteps_importer_cwb.importer_cwb_compref import (
+    _geometry_metadata,
+    read_cwb_compref,
+)
+from pysteps_importer_cwb.utils import json_default, write_atomic
+
+# Default coarsening factors.
+FACTORS = (2, 4, 8)
+
+# Name of the sub-directory of the cached pyramids, next to the source files.
+PYRAMID_DIR = ".pyramid"
+
+# Version of the layout of the cached pyramids, part of their keys.
+_PYRAMID_VERSION = 2
+
+
+def _check_factors(factors):
+    factors = sorted(set(int(f) for f in factors))
+    if not factors or factors[0] < 2:
+        raise ValueError("The coarsening factors must be integers larger than 1")
+    for small, large in zip(factors, factors[1:]):
+        if large % small:
+            raise ValueError(
+                "Each coarsening factor must be a multiple of the previous one, "
+                "not %s" % (factors,)
+            )
+    return factors
+
+
+def coarsen(precip, factors=FACTORS, transform="dB"):
+    """
+    Average a field over blocks of pixels, for several block sizes.
+
+    The field is extended to the north and east (the last rows and columns)
+    to a multiple of the largest factor with pixels without value.
+
+    Parameters
+    ----------
+    precip : array
+        Floating point field of shape (..., ny, nx), with NaN for the pixels
+        without value. Leading dimensions (e.g. levels) are kept.
+    factors : sequence of int
+        Block sizes. Each factor must be a multiple of the previous one, e.g.
+        (2, 4, 8).
+    transform : str or None
+        "dB" to average the values in linear units, as for the reflectivities
+        in dBZ, or None to average the values directly, as for the rain rates.
+
+    Returns
+    -------
+    fields : dict
+        Coarse field of shape (..., ceil(ny / factor), ceil(nx / factor)) for
+        each factor, in the data type of ``precip``. NaN where no pixel of the
+        block has a value.
+    """
+    precip = np.asarray(precip)
+    if precip.dtype.kind != "f":
+        raise ValueError(
+            "Only floating point fields can be coarsened, not %s" % precip.dtype
+        )
+    if transform not in ("dB", None):
+        raise ValueError("Unknown transform %r" % (transform,))
+    factors = _check_factors(factors)
+    lead = precip.shape[:-2]
+    ny, nx = precip.shape[-2:]
+    size = factors[-1]
+    pad_y = -ny % size
+    pad_x = -nx % size
+
+    # Sums and counts of the valid pixels, on a grid padded with no values.
+    values = np.zeros(lead + (ny + pad_y, nx + pad_x), dtype="double")
+    valid = ~np.isnan(precip)
+    if transform == "dB":
+        with np.errstate(under="ignore"):
+            np.power(10.0, precip / 10.0, out=values[..., :ny, :nx], where=valid)
+    else:
+        np.copyto(values[..., :ny, :nx], precip, where=valid)
+    counts = np.zeros(values.shape, dtype="int32")
+    counts[..., :ny, :nx] = valid
+
+    fields = {}
+    block = 1
+    for factor in factors:
+        r = factor // block
+        shape = lead + (values.shape[-2] // r, r, values.shape[-1] // r, r)
+        values = values.reshape(shape).sum(axis=(-3, -1))
+        counts = counts.reshape(shape).sum(axis=(-3, -1))
+        block = factor
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = values / counts
+            if transform == "dB":
+                mean = 10.0 * np.log10(mean)
+        # The padding is not part of the grid of the coarse field.
+        cy = -(-ny // factor)
+        cx = -(-nx // factor)
+        fields[factor] = mean[..., :cy, :cx].astype(precip.dtype)
+    return fields
+
+
+def coarsen_metadata(metadata, factor, geometry=None):
+    """
+    Metadata of a field coarsened by `coarsen`.
+
+    Parameters
+    ----------
+    metadata : dict
+        Metadata of the full resolution field.
+    factor : int
+        Coarsening factor.
+    geometry : GridGeometry, optional
+        Geometry of the full resolution field, for fields on the grid of the
+        files. Without geometry the field is on a TWD97 grid (see the
+        ``regrid`` option of the importer) whose corners are in the metadata.
+
+    Returns
+    -------
+    metadata : dict
+        Copy of the metadata, describing the coarse grid.
+    """
+    metadata = dict(metadata)
+    if geometry is not None:
+        metadata.update(_geometry_metadata(geometry.coarsen(factor)))
+    else:
+        nx = int(round((metadata["x2"] - metadata["x1"]) / metadata["xpixelsize"]))
+        ny = int(round((metadata["y2"] - metadata["y1"]) / metadata["ypixelsize"]))
+        xpixelsize = metadata["xpixelsize"] * factor
+        ypixelsize = metadata["ypixelsize"] * factor
+        metadata.update(
+            xpixelsize=xpixelsize,
+            ypixelsize=ypixelsize,
+            x2=metadata["x1"] + -(-nx // factor) * xpixelsize,
+            y2=metadata["y1"] + -(-ny // factor) * ypixelsize,
+        )
+    metadata["coarsen"] = factor
+    return metadata
+
+
+def _source_geometry(filename, kwargs):
+    """Geometry of the decoded field on the grid of the file, or None."""
+    if kwargs.get("regrid") is not None:
+        return None
+    header = read_compref_header(filename, gzipped=kwargs.get("gzipped", False))
+    geometry = grid_geometry(header)
+    roi = kwargs.get("roi")
+    if roi is not None:
+        geometry = geometry.window(*roi_window(header, roi))
+    return geometry
+
+
+def build_pyramid(filename, factors=FACTORS, **kwargs):
+    """
+    Decode a COMPREF file and coarsen it for several block sizes.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the COMPREF file.
+    factors : sequence of int
+        Coarsening factors, see `coarsen`.
+    **kwargs
+        Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`,
+        except ``out``. The data type must be a floating point type.
+
+    Returns
+    -------
+    pyramid : dict
+        (precipitation, quality, metadata) of the coarse field for each factor.
+    """
+    precip, quality, metadata = read_cwb_compref(filename, **kwargs)
+    geometry = _source_geometry(filename, kwargs)
+    fields = coarsen(precip, factors, transform=metadata["transform"])
+    return {
+        factor: (field, None, coarsen_metadata(metadata, factor, geometry))
+        for factor, field in fields.items()
+    }
+
+
+def _pyramid_names(filename, factor, kwargs):
+    """
+    Names of the cached field and metadata of a level of a pyramid.
+
+    Every level has its own metadata file, so that the levels built by
+    different calls (e.g. factors out of the chain of the default factors) do
+    not invalidate each other.
+    """
+    key = source_key(filename, kwargs, version=_PYRAMID_VERSION)
+    base = os.path.join(
+        os.path.dirname(os.path.abspath(filename)),
+        PYRAMID_DIR,
+        "%s.%s" % (os.path.basename(filename), key[:16]),
+    )
+    return base + ".x%d.npy" % factor, base + ".x%d.json" % factor
+
+
+def read_coarse_cwb_compref(filename, factor, factors=FACTORS, cache=True, **kwargs):
+    """
+    Read a coarsened COMPREF field, through the pyramid cache.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the COMPREF file.
+    factor : int
+        Coarsening factor.
+    factors : sequence of int
+        Factors of the pyramid built when the cache has no entry for the file
+        and the options. ``factor`` is added to them if needed.
+    cache : bool
+        Whether to use the pyramids cached next to the source file. On a miss
+        all the levels of the pyramid are cached. Source directories where
+        the pyramid cannot be written (e.g. read-only or full) are ignored.
+    **kwargs
+        Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`.
+
+    Returns
+    -------
+    precipitation : array
+        Coarse field. On a cache hit it is a read-only memory map of the
+        cached file.
+    quality : None
+    metadata : dict
+    """
+    # The levels are reduced from each other: the same factors give the same
+    # values, whether they are cached or not.
+    factors = set(factors) | {factor}
+    try:
+        _check_factors(factors)
+    except ValueError:
+        factors = (factor,)
+    if not cache:
+        return build_pyramid(filename, factors, **kwargs)[factor]
+
+    npy_name, json_name = _pyramid_names(filename, factor, kwargs)
+    try:
+        precip = np.load(npy_name, mmap_mode="r")
+        with open(json_name) as fid:
+            metadata = json.load(fid)
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        return precip, None, metadata
+
+    pyramid = build_pyramid(filename, factors, **kwargs)
+    try:
+        for f, (field, _, metadata) in pyramid.items():
+            level_npy, level_json = _pyramid_names(filename, f, kwargs)
+            # The metadata are written first: a complete .npy file marks a
+            # complete level.
+            write_atomic(
+                level_json, json.dumps(metadata, default=json_default).encode()
+            )
+            write_atomic(level_npy, lambda fid, field=field: np.save(fid, field))
+    except OSError:
+        # E.g. a read-only or full file system: the pyramid is not cached.
+        pass
+    return pyramid[factor]
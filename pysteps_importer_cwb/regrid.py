@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Resampling of the COMPREF fields to a uniform TWD97 (EPSG:3826) grid.
+
+The COMPREF mosaics are stored on a regular longitude/latitude grid, whose
+pixels are not uniform in meters. This module resamples them to a Cartesian
+grid with a chosen pixel size. The source pixels of every target pixel
+(nearest neighbor, or the four neighbors and weights of the bilinear
+interpolation) only depend on the two grids, so they are computed once per
+source geometry, with a single inverse projection of the target grid, and
+cached in memory and on disk. Resampling a frame is then a single gather.
+"""
+
+# Import the needed libraries
+import hashlib
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from pysteps_importer_cwb.geometry import PROJECTION, GridGeometry, _get_proj
+from pysteps_importer_cwb.utils import default_cache_dir, write_atomic
+
+# Version of the layout of the cached tables, part of their file names.
+_TABLE_VERSION = 1
+
+METHODS = ("nearest", "bilinear")
+
+
+class ResamplingTable(object):
+    """
+    Resampling of a longitude/latitude grid to a TWD97 grid.
+
+    Attributes
+    ----------
+    method : str
+        "nearest" or "bilinear".
+    pixelsize : float
+        Pixel size of the target grid, in meters.
+    nx, ny : int
+        Size of the target grid. Row 0 is the southernmost row.
+    x1, y1, x2, y2 : float
+        Lower-left and upper-right corners of the target grid, in meters.
+    src_shape : tuple
+        (ny, nx) shape of the source grid.
+    indices : 2D array
+        Flat indices of the source pixels of every target pixel, with shape
+        (1, ny * nx) for the nearest neighbor and (4, ny * nx) for the
+        bilinear interpolation.
+    weights : 2D array or None
+        Bilinear weights, with the shape of ``indices``.
+    outside : 1D array
+        Flat indices of the target pixels outside the source grid.
+    """
+
+    def __init__(self, method, pixelsize, x1, y1, nx, ny, src_shape, indices,
+                 weights, outside):
+        self.method = method
+        self.pixelsize = pixelsize
+        self.nx = nx
+        self.ny = ny
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x1 + nx * pixelsize
+        self.y2 = y1 + ny * pixelsize
+        self.src_shape = tuple(src_shape)
+        self.indices = indices
+        self.weights = weights
+        self.outside = outside
+
+    def resample(self, field, out=None, fill_value=np.nan, missing=None):
+        """
+        Resample fields to the target grid.
+
+        Parameters
+        ----------
+        field : array
+            Field of shape (..., ny, nx) on the source grid, e.g. a single frame
+            or a (t, ny, nx) stack.
+        out : array, optional
+            Array of shape (..., table.ny, table.nx) where the result is
+            written.
+        fill_value : scalar
+            Value of the target pixels outside the source grid.
+        missing : int, optional
+            Value of the pixels without value of integer fields, needed by the
+            bilinear interpolation. The pixels without value of floating point
+            fields are NaN.
+
+        Returns
+        -------
+        out : array
+            Resampled field, in the data type of ``field``. The bilinear
+            interpolation leaves the source pixels without value out of the
+            weights of their neighbors, so that integer and floating point
+            fields have values on the same target pixels. Target pixels without
+            any valid neighbor are NaN, or ``missing`` for integer fields. The
+            bilinear interpolation of integer fields is rounded to the nearest
+            integer.
+        """
+        field = np.asarray(field)
+        if field.shape[-2:] != self.src_shape:
+            raise ValueError(
+                "Field of shape %s does not match the source grid %s"
+                % (field.shape, self.src_shape)
+            )
+        lead = field.shape[:-2]
+        src = field.reshape((-1, self.src_shape[0] * self.src_shape[1]))
+        floating = field.dtype.kind == "f"
+        if self.weights is not None and not floating and missing is None:
+            raise ValueError(
+                "Bilinear resampling of integer fields needs their missing value"
+            )
+        if out is None:
+            out = np.empty(lead + (self.ny, self.nx), dtype=field.dtype)
+        elif out.shape != lead + (self.ny, self.nx):
+            raise ValueError(
+                "Output array has shape %s, expected %s"
+                % (out.shape, lead + (self.ny, self.nx))
+            )
+        if self.weights is not None and floating and out.dtype.kind != "f":
+            raise ValueError(
+                "Bilinear resampling of floating point fields needs a floating "
+                "point output"
+            )
+        dest = out.reshape((-1, self.ny * self.nx))
+
+        for src_k, dest_k in zip(src, dest):
+            if self.weights is None:
+                np.take(src_k, self.indices[0], out=dest_k, mode="clip")
+            else:
+                self._interpolate_valid(
+                    src_k, dest_k, np.nan if floating else missing
+                )
+            dest_k[self.outside] = fill_value
+        return out
+
+    def _interpolate_valid(self, src, dest, missing):
+        """Bilinear interpolation of the pixels of a field different from missing."""
+        total = np.zeros(dest.shape)
+        weights = np.zeros(dest.shape)
+        for k in range(4):
+            values = src[self.indices[k]]
+            if np.isnan(missing):
+                valid = ~np.isnan(values)
+            else:
+                valid = values != missing
+            w = np.where(valid, self.weights[k], 0.0)
+            total += w * np.where(valid, values, 0)
+            weights += w
+        valid = weights > 0
+        np.divide(total, weights, out=total, where=valid)
+        if dest.dtype.kind != "f":
+            np.rint(total, out=total)
+        total[~valid] = missing
+        dest[...] = total
+
+    def update_metadata(self, metadata):
+        """
+        Metadata of the resampled fields.
+
+        Parameters
+        ----------
+        metadata : dict
+            Metadata of the source fields.
+
+        Returns
+        -------
+        metadata : dict
+            Copy of the metadata with the geometry of the target grid.
+        """
+        metadata = dict(metadata)
+        metadata.update(
+            xpixelsize=self.pixelsize,
+            ypixelsize=self.pixelsize,
+            cartesian_unit="m",
+            projection=PROJECTION,
+            yorigin="lower",
+            x1=self.x1,
+            x2=self.x2,
+            y1=self.y1,
+            y2=self.y2,
+        )
+        return metadata
+
+
+def _target_extent(geometry, pixelsize):
+    """Extent in meters of a grid covering the whole source grid."""
+    nx, ny = geometry.nx, geometry.ny
+    lons = geometry.lon_min + geometry.dlon * np.concatenate(
+        [np.arange(nx), np.arange(nx), np.zeros(ny), np.full(ny, nx - 1)]
+    )
+    lats = geometry.lat_min + geometry.dlat * np.concatenate(
+        [np.zeros(nx), np.full(nx, ny - 1), np.arange(ny), np.arange(ny)]
+    )
+    x, y = _get_proj(PROJECTION)(lons, lats)
+    x1 = np.floor(x.min() / pixelsize) * pixelsize
+    y1 = np.floor(y.min() / pixelsize) * pixelsize
+    x2 = np.ceil(x.max() / pixelsize) * pixelsize
+    y2 = np.ceil(y.max() / pixelsize) * pixelsize
+    return x1, x2, y1, y2
+
+
+def _build_table(geometry, pixelsize, method, extent):
+    x1, x2, y1, y2 = extent
+    nx = max(1, int(round((x2 - x1) / pixelsize)))
+    ny = max(1, int(round((y2 - y1) / pixelsize)))
+    x = x1 + (np.arange(nx) + 0.5) * pixelsize
+    y = y1 + (np.arange(ny) + 0.5) * pixelsize
+    x, y = np.meshgrid(x, y)
+    lons, lats = _get_proj(PROJECTION)(x.ravel(), y.ravel(), inverse=True)
+
+    # Fractional indices of the target pixel centers in the source grid.
+    cols = (lons - geometry.lon_min) / geometry.dlon
+    rows = (lats - geometry.lat_min) / geometry.dlat
+    src_nx, src_ny = geometry.nx, geometry.ny
+
+    if method == "nearest":
+        outside = (cols < -0.5) | (cols >= src_nx - 0.5)
+        outside |= (rows < -0.5) | (rows >= src_ny - 0.5)
+        c = np.clip(np.rint(cols), 0, src_nx - 1).astype("int32")
+        r = np.clip(np.rint(rows), 0, src_ny - 1).astype("int32")
+        indices = (r * src_nx + c)[None]
+        weights = None
+    else:
+        outside = (cols < 0) | (cols > src_nx - 1) | (rows < 0) | (rows > src_ny - 1)
+        c0 = np.clip(np.floor(cols), 0, max(0, src_nx - 2)).astype("int32")
+        r0 = np.clip(np.floor(rows), 0, max(0, src_ny - 2)).astype("int32")
+        c1 = np.minimum(c0 + 1, src_nx - 1)
+        r1 = np.minimum(r0 + 1, src_ny - 1)
+        fc = np.clip(cols - c0, 0, 1)
+        fr = np.clip(rows - r0, 0, 1)
+        indices = np.stack(
+            [r0 * src_nx + c0, r0 * src_nx + c1, r1 * src_nx + c0, r1 * src_nx + c1]
+        ).astype("int32")
+        weights = np.stack(
+            [(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc]
+        ).astype("float32")
+
+    return ResamplingTable(
+        method, pixelsize, x1, y1, nx, ny, (src_ny, src_nx), indices, weights,
+        np.flatnonzero(outside).astype("int32"),
+    )
+
+
+def _table_filename(cache_dir, key):
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+    return os.path.join(cache_dir, "regrid-%s.npz" % digest)
+
+
+def _save_table(filename, table):
+    arrays = dict(
+        params=np.array(
+            [table.pixelsize, table.x1, table.y1, table.nx, table.ny]
+            + list(table.src_shape),
+            dtype="double",
+        ),
+        indices=table.indices,
+        outside=table.outside,
+    )
+    if table.weights is not None:
+        arrays["weights"] = table.weights
+    write_atomic(filename, lambda fid: np.savez(fid, **arrays))
+
+
+def _load_table(filename, method):
+    with np.load(filename) as data:
+        pixelsize, x1, y1, nx, ny, src_ny, src_nx = data["params"]
+        weights = data["weights"] if "weights" in data.files else None
+        return ResamplingTable(
+            method, pixelsize, x1, y1, int(nx), int(ny), (int(src_ny), int(src_nx)),
+            data["indices"], weights, data["outside"],
+        )
+
+
+@lru_cache(maxsize=8)
+def _resampling_table(geometry_key, pixelsize, method, extent, cache_dir):
+    geometry = GridGeometry(*geometry_key)
+    if extent is None:
+        extent = _target_extent(geometry, pixelsize)
+
+    key = (_TABLE_VERSION, PROJECTION, geometry_key, pixelsize, method, extent)
+    filename = _table_filename(cache_dir, key) if cache_dir else None
+    if filename is not None and os.path.isfile(filename):
+        try:
+            return _load_table(filename, method)
+        except (OSError, ValueError, KeyError):
+            pass  # Damaged cache file, built again below.
+
+    table = _build_table(geometry, pixelsize, method, extent)
+    if filename is not None:
+        _save_table(filename, table)
+    return table
+
+
+def resampling_table(geometry, pixelsize=1000.0, method="nearest", extent=None,
+                     cache_dir=None):
+    """
+    Table resampling a COMPREF grid to a uniform TWD97 grid.
+
+    Parameters
+    ----------
+    geometry : GridGeometry
+        Geometry of the source grid, e.g. ``grid_geometry(header)``.
+    pixelsize : float
+        Pixel size of the target grid, in meters.
+    method : str
+        "nearest" (nearest neighbor) or "bilinear".
+    extent : tuple, optional
+        (x1, x2, y1, y2) extent of the target grid, in meters. By default the
+        smallest grid aligned on multiples of the pixel size and covering the
+        whole source grid.
+    cache_dir : str or False, optional
+        Directory where the tables are cached, by default
+        `pysteps_importer_cwb.utils.default_cache_dir`. False disables the
+        cache on disk; the tables are always cached in memory.
+
+    Returns
+    -------
+    table : ResamplingTable
+        Table shared by all the callers with the same arguments.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown resampling method %r" % (method,))
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    geometry_key = (
+        geometry.lon_min, geometry.lat_min, geometry.dlon, geometry.dlat,
+        geometry.nx, geometry.ny,
+    )
+    if extent is not None:
+        extent = tuple(float(value) for value in extent)
+    return _resampling_table(
+        geometry_key, float(pixelsize), method, extent, cache_dir or None
+    )
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory store of decoded COMPREF frames.
+
+When the members of an ensemble run in a pool of processes, every worker would
+otherwise decode the same input frames and hold its own copy of them. With a
+`SharedFrameStore`, one process decodes each frame once and publishes it in a
+`multiprocessing.shared_memory` segment, and the workers attach read-only
+numpy views to the segments, so the memory used by the frames does not grow
+with the number of workers.
+
+Each segment holds a small JSON description of the frame (shape, data type and
+metadata) followed by the field itself. The size of the description is written
+last: a segment without it is still being written, and is not published yet.
+The name of a segment is derived from the store prefix, the file (name,
+modification time and size) and the import options, so that a worker only
+needs the store (which is picklable) and the file name to find a frame, and a
+rewritten file is never served from the segment of its previous content.
+
+Examples
+--------
+>>> with SharedFrameStore() as store:
+...     store.publish_many(filenames, gzipped=True)
+...     with multiprocessing.Pool(64) as pool:
+...         pool.map(run_member, [(store, filenames, member) for member in ...])
+
+where each worker reads the frames with ``store.read(filename, gzipped=True)``.
+"""
+
+# Import the needed libraries
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pysteps_importer_cwb.cache import source_key
+from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+from pysteps_importer_cwb.utils import json_default
+
+# The field starts at a multiple of this offset in the segment.
+_ALIGNMENT = 64
+
+# Segments attached by this process, by name.
+_attached = {}
+
+
+def _attach_segment(name, creator_pid):
+    shm = _attached.get(name)
+    if shm is None:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 registers the attached segments to the resource
+            # tracker, which destroys them when it exits. The process that
+            # created the store and the workers it started share a tracker,
+            # other processes unregister the segments from their own tracker.
+            shm = shared_memory.SharedMemory(name=name)
+            parent = multiprocessing.parent_process()
+            pids = (os.getpid(), parent.pid if parent is not None else None)
+            if os.name == "posix" and creator_pid not in pids:
+                from multiprocessing import resource_tracker
+
+                resource_tracker.unregister("/" + shm.name, "shared_memory")
+        _attached[name] = shm
+    return shm
+
+
+def _frame_view(shm, name):
+    """Read-only field and metadata of a segment."""
+    nbytes = int.from_bytes(shm.buf[:8], "little")
+    if nbytes == 0:
+        raise FileNotFoundError("The frame %s is not published yet" % name)
+    info = json.loads(bytes(shm.buf[8 : 8 + nbytes]).decode())
+    buf = shm.buf.toreadonly()
+    precip = np.ndarray(
+        tuple(info["shape"]), dtype=info["dtype"], buffer=buf, offset=info["offset"]
+    )
+    return precip, info["metadata"]
+
+
+class SharedFrameStore(object):
+    """
+    Store of decoded frames in shared memory.
+
+    The process creating the store owns the segments it publishes, and
+    destroys them in `close`. The store can be passed to the workers of a
+    process pool, where it only attaches to the published segments. The pool
+    should be started after the store, by the same process.
+
+    Parameters
+    ----------
+    prefix : str, optional
+        Prefix of the names of the segments, by default unique to the process
+        creating the store.
+    """
+
+    def __init__(self, prefix=None):
+        if prefix is None:
+            prefix = "cwb%d_%s" % (os.getpid(), os.urandom(3).hex())
+        self.prefix = prefix
+        self._creator_pid = os.getpid()
+        self._owned = {}
+        self._publishing = {}
+        self._lock = threading.Lock()
+        if os.name == "posix":
+            # The workers started from now on share the resource tracker of
+            # this process, see `_attach_segment`.
+            from multiprocessing import resource_tracker
+
+            resource_tracker.ensure_running()
+
+    def __getstate__(self):
+        # The workers attach to the segments, they do not own them.
+        return {"prefix": self.prefix, "_creator_pid": self._creator_pid}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owned = {}
+        self._publishing = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def segment_name(self, filename, **kwargs):
+        """
+        Name of the segment of a frame.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the COMPREF file.
+        **kwargs
+            Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`.
+
+        Returns
+        -------
+        name : str
+        """
+        return self.prefix + "_" + source_key(filename, kwargs)[:12]
+
+    def publish(self, filename, **kwargs):
+        """
+        Decode a frame and publish it, unless it is already published.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the COMPREF file.
+        **kwargs
+            Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`,
+            except ``out``. The workers must read the frame with the same
+            options.
+
+        Returns
+        -------
+        name : str
+            Name of the segment.
+        """
+        name = self.segment_name(filename, **kwargs)
+        # Concurrent publications of the same frame wait for the first one.
+        while True:
+            with self._lock:
+                if name in self._owned:
+                    return name
+                done = self._publishing.get(name)
+                if done is None:
+                    done = self._publishing[name] = threading.Event()
+                    break
+            done.wait()
+        try:
+            self._owned[name] = self._create_segment(name, filename, kwargs)
+        finally:
+            with self._lock:
+                del self._publishing[name]
+            done.set()
+        return name
+
+    def _create_segment(self, name, filename, kwargs):
+        precip, _, metadata = read_cwb_compref(filename, **kwargs)
+
+        info = dict(shape=precip.shape, dtype=precip.dtype.str, metadata=metadata)
+        # The offset is part of the description, whose size depends on it.
+        offset = 0
+        while True:
+            encoded = json.dumps(dict(info, offset=offset), default=json_default)
+            encoded = encoded.encode()
+            needed = -(-(8 + len(encoded)) // _ALIGNMENT) * _ALIGNMENT
+            if needed == offset:
+                break
+            offset = needed
+
+        # The new segment is filled with zeros: it is published once the size
+        # of the description is written, after the description and the field.
+        shm = shared_memory.SharedMemory(
+            name=name, create=True, size=offset + max(1, precip.nbytes)
+        )
+        try:
+            shm.buf[8 : 8 + len(encoded)] = encoded
+            np.ndarray(
+                precip.shape, dtype=precip.dtype, buffer=shm.buf, offset=offset
+            )[...] = precip
+            shm.buf[:8] = len(encoded).to_bytes(8, "little")
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        return shm
+
+    def publish_many(self, filenames, num_workers=None, **kwargs):
+        """
+        Publish several frames, decoded concurrently by a pool of threads.
+
+        Parameters
+        ----------
+        filenames : list of str
+            Names of the COMPREF files. None entries (missing files) are
+            skipped.
+        num_workers : int, optional
+            Number of decoding threads, by default the number of CPUs.
+        **kwargs
+            Options of `publish`.
+
+        Returns
+        -------
+        names : list of str
+            Names of the segments, None for the missing files.
+        """
+        def _publish(filename):
+            if filename is None:
+                return None
+            return self.publish(filename, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+            return list(executor.map(_publish, filenames))
+
+    def attach(self, filename, **kwargs):
+        """
+        Attach to a published frame.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the COMPREF file.
+        **kwargs
+            Options the frame was published with.
+
+        Returns
+        -------
+        precipitation : array
+            Read-only view of the field in shared memory.
+        quality : None
+        metadata : dict
+
+        Raises
+        ------
+        FileNotFoundError
+            If the frame is not published, or not completely written yet.
+        """
+        name = self.segment_name(filename, **kwargs)
+        shm = self._owned.get(name) or _attach_segment(name, self._creator_pid)
+        precip, metadata = _frame_view(shm, name)
+        return precip, None, metadata
+
+    def read(self, filename, **kwargs):
+        """
+        Read a frame from the store, or decode it if it is not published.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the COMPREF file.
+        **kwargs
+            Options of `pysteps_importer_cwb.importer_cwb_compref.read_cwb_compref`.
+
+        Returns
+        -------
+        precipitation : array
+            Read-only view of the shared field, or the decoded field.
+        quality : None
+        metadata : dict
+        """
+        try:
+            return self.attach(filename, **kwargs)
+        except FileNotFoundError:
+            return read_cwb_compref(filename, **kwargs)
+
+    def close(self):
+        """
+        Destroy the segments published by this process.
+
+        The memory is released once the last view of each segment is gone.
+        """
+        for shm in self._owned.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass  # Views still alive in this process.
+            shm.unlink()
+        self._owned.clear()
+
+
+def detach_all():
+    """
+    Detach this process from all the attached segments.
+
+    The views returned by `SharedFrameStore.attach` must not be used anymore.
+    """
+    for shm in _attached.values():
+        try:
+            shm.close()
+        except BufferError:
+            pass  # Views still alive, released with the process.
+    _attached.clear()
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic COMPREF files and a local OpenData server, for tests and benchmarks.
+
+The synthetic fields look like the CWB mosaics: the pixels out of the radar
+coverage have no value (-999 dBZ), most of the covered pixels are clear sky
+(-99 dBZ), and the echoes form smooth structures of a few tens of dBZ, with a
+power-law spectrum as the rain fields. They compress and decode like real
+files, which random values would not.
+
+`OpenDataStandIn` is a local HTTP server serving the metadata and the frame
+endpoints of the OpenData history API (O-A0059-001), to exercise
+`pysteps_importer_cwb.opendata` without network access.
+"""
+
+# Import the needed libraries
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from pysteps_importer_cwb.compref import (
+    CLEAR_SKY_DBZ,
+    CompRefHeader,
+    write_compref,
+)
+from pysteps_importer_cwb.importer_cwb_compref import _compref_filename
+
+# Size of the CWB mosaics (nx, ny).
+CWB_GRID = (921, 881)
+
+# Radars of the synthetic mosaics: (code, x, y) with the position as fractions
+# of the width and height of the grid, roughly as on the CWB grid.
+_RADARS = [
+    ("RCWF", 0.59, 0.64),
+    ("RCHL", 0.58, 0.54),
+    ("RCCG", 0.44, 0.47),
+    ("RCKT", 0.51, 0.35),
+]
+
+
+def _powerlaw_noise(rng, shape, beta=3.0):
+    """Standardized random field with a power-law spectrum of exponent -beta."""
+    ny, nx = shape
+    freq = np.hypot(np.fft.fftfreq(ny)[:, None], np.fft.rfftfreq(nx)[None, :])
+    freq[0, 0] = 1.0
+    spectrum = np.fft.rfft2(rng.standard_normal(shape)) * freq ** (-beta / 2)
+    spectrum[0, 0] = 0.0
+    field = np.fft.irfft2(spectrum, s=shape)
+    return field / field.std()
+
+
+def synthetic_dbz(ny=CWB_GRID[1], nx=CWB_GRID[0], nz=1, seed=0, rain_fraction=0.2,
+                  shift=(0, 0)):
+    """
+    Synthetic reflectivity mosaic.
+
+    Parameters
+    ----------
+    ny, nx : int
+        Size of the grid.
+    nz : int
+        Number of levels. The echoes weaken and shrink with the height.
+    seed : int
+        Seed of the random field.
+    rain_fraction : float
+        Fraction of the covered pixels with echoes, at the lowest level.
+    shift : tuple of int
+        (rows, cols) displacement of the echoes, e.g. proportional to the time
+        of the frame to imitate their advection.
+
+    Returns
+    -------
+    dbz : array
+        Reflectivity in dBZ, rounded to 0.1 dBZ, of shape (ny, nx), or
+        (nz, ny, nx) with ``nz > 1``. Clear sky pixels are -99 and pixels out
+        of the coverage are -999.
+    """
+    rng = np.random.default_rng(seed)
+    field = np.roll(_powerlaw_noise(rng, (ny, nx)), shift, axis=(0, 1))
+
+    rows = np.arange(ny)[:, None] / max(ny - 1, 1)
+    cols = np.arange(nx)[None, :] / max(nx - 1, 1)
+    radius = 0.3 * max(ny, nx)
+    covered = np.zeros((ny, nx), dtype=bool)
+    for _, x, y in _RADARS:
+        covered |= np.hypot((cols - x) * (nx - 1), (rows - y) * (ny - 1)) <= radius
+    threshold = np.quantile(field[covered], 1.0 - rain_fraction)
+    echo = 10.0 + 15.0 * (field - threshold)
+
+    dbz = np.empty((nz, ny, nx))
+    for k in range(nz):
+        level = echo - 3.0 * k + rng.normal(0.0, 1.0, size=(ny, nx))
+        level = np.clip(np.round(level, 1), None, 70.0)
+        level[level < 10.0] = CLEAR_SKY_DBZ
+        level[~covered] = -999.0
+        dbz[k] = level
+    return dbz if nz > 1 else dbz[0]
+
+
+def synthetic_header(ny=CWB_GRID[1], nx=CWB_GRID[0], nz=1,
+                     time=datetime(2022, 12, 6, 2, 30), lon0=115.0, lat0=18.0,
+                     res=0.0125, var_scale=10, mosradar=None):
+    """
+    Header of a synthetic COMPREF file on a longitude/latitude grid.
+
+    Parameters
+    ----------
+    ny, nx, nz : int
+        Size of the grid.
+    time : datetime
+        Time of the frame (UTC).
+    lon0, lat0 : float
+        Longitude and latitude of the south-west pixel, in degrees.
+    res : float
+        Pixel size in degrees.
+    var_scale : int
+        Scale of the values (dBZ = raw / var_scale).
+    mosradar : sequence of str, optional
+        Codes of the contributing radars, by default those of the synthetic
+        fields.
+
+    Returns
+    -------
+    header : CompRefHeader
+    """
+    if mosradar is None:
+        mosradar = [code for code, _, _ in _RADARS]
+    return CompRefHeader(
+        time=time,
+        nx=nx,
+        ny=ny,
+        nz=nz,
+        proj="LL",
+        map_scale=1000,
+        projlat0=30000,
+        projlat1=60000,
+        projlon=120750,
+        alon=round(lon0 * 1000),
+        alat=round((lat0 + res * (ny - 1)) * 1000),
+        xy_scale=1000,
+        dx=round(res * 100000),
+        dy=round(res * 100000),
+        dxy_scale=100000,
+        zht=tuple(1000 * (k + 1) for k in range(nz)) if nz > 1 else (0,),
+        z_scale=1,
+        i_bb_mode=-12922,
+        unkn01=(0,) * 9,
+        varname1="QPEO",
+        varname2=(1, 2, 3, 4),
+        varunit="dBZ",
+        unkn02="TRA",
+        var_scale=var_scale,
+        missing=-999,
+        nradar=len(mosradar),
+        mosradar=tuple(mosradar),
+        data_offset=None,
+    )
+
+
+def write_synthetic_compref(filename, ny=CWB_GRID[1], nx=CWB_GRID[0], nz=1,
+                            gzipped=None, time=datetime(2022, 12, 6, 2, 30),
+                            seed=0, shift=(0, 0), rain_fraction=0.2,
+                            compresslevel=6):
+    """
+    Write a synthetic COMPREF file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file.
+    ny, nx, nz : int
+        Size of the grid.
+    gzipped : bool, optional
+        Whether to gzip compress the file, by default if the file name ends
+        with ".gz".
+    time : datetime
+        Time of the frame (UTC).
+    seed, shift, rain_fraction
+        Options of `synthetic_dbz`.
+    compresslevel : int
+        gzip compression level.
+
+    Returns
+    -------
+    filename : str
+    """
+    dbz = synthetic_dbz(ny, nx, nz, seed=seed, rain_fraction=rain_fraction,
+                        shift=shift)
+    header = synthetic_header(ny, nx, nz, time=time)
+    raw = np.round(dbz * header.var_scale).astype("<i2")
+    return write_compref(filename, header, raw, gzipped=gzipped,
+                         compresslevel=compresslevel)
+
+
+def synthetic_archive(root_path, start, count, timestep=10, ny=CWB_GRID[1],
+                      nx=CWB_GRID[0], nz=1, seed=0, path_fmt="%Y/%m/%d",
+                      fn_pattern="COMPREF.OpenData.%Y%m%d.%H%M", fn_ext="gz"):
+    """
+    Write an archive of consecutive synthetic frames.
+
+    The echoes move by one row and two columns per time step. The default
+    layout is that of `pysteps_importer_cwb.opendata.download_cwb_opendata`,
+    as read by `pysteps_importer_cwb.importer_cwb_compref.find_cwb_compref`.
+
+    Parameters
+    ----------
+    root_path : str
+        Root directory of the archive.
+    start : datetime
+        Time of the first frame (UTC).
+    count : int
+        Number of frames.
+    timestep : int
+        Time step between the frames, in minutes.
+    ny, nx, nz, seed
+        Options of `synthetic_dbz`.
+    path_fmt, fn_pattern, fn_ext
+        Layout of the archive, see `find_cwb_compref`.
+
+    Returns
+    -------
+    filenames : list of str
+    timestamps : list of datetime
+    """
+    filenames = []
+    timestamps = []
+    for i in range(count):
+        t = start + timedelta(minutes=i * timestep)
+        filename = _compref_filename(t, root_path, path_fmt, fn_pattern, fn_ext)
+        write_synthetic_compref(
+            filename, ny, nx, nz, gzipped=fn_ext.endswith("gz"), time=t,
+            seed=seed, shift=(i, 2 * i),
+        )
+        filenames.append(filename)
+        timestamps.append(t)
+    return filenames, timestamps
+
+
+def opendata_frame_xml(dbz, time="2022-12-06T10:30:00+08:00", lon0=115.0,
+                       lat0=18.0, res=0.0125,
+                       radar_names="五分山雷達、花蓮雷達、七股雷達"):
+    """
+    XML document of an OpenData (O-A0059-001) frame.
+
+    Parameters
+    ----------
+    dbz : array
+        Reflectivity in dBZ, of shape (ny, nx), with -99 for clear sky and
+        -999 for no value.
+    time : str
+        Time of the frame, in ISO format with its time zone.
+    lon0, lat0 : float
+        Longitude and latitude of the south-west pixel, in degrees.
+    res : float
+        Pixel size in degrees.
+    radar_names : str
+        Names of the contributing radars, in Chinese.
+
+    Returns
+    -------
+    xml : bytes
+    """
+    ny, nx = dbz.shape
+    content = ",".join("%.2f" % v for v in np.asarray(dbz).ravel())
+    parameters = [
+        "<parameterName>雷達站</parameterName><radarName>%s</radarName>" % radar_names,
+        "<parameterName>起始經緯度</parameterName>"
+        "<parameterValue>%s,%s</parameterValue>" % (lon0, lat0),
+        "<parameterName>解析度</parameterName><parameterValue>%s</parameterValue>" % res,
+        "<parameterName>時間</parameterName><parameterValue>%s</parameterValue>" % time,
+        "<parameterName>網格數</parameterName><parameterValue>%d*%d</parameterValue>"
+        % (nx, ny),
+        "<parameterName>單位</parameterName><parameterValue>dBZ</parameterValue>",
+    ]
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<cwbopendata xmlns="urn:cwb:gov:tw:cwbcommon:0.1"><dataset>'
+        "<datasetInfo><parameterSet>%s</parameterSet></datasetInfo>"
+        "<contents><content>%s</content></contents>"
+        "</dataset></cwbopendata>"
+        % ("".join("<parameter>%s</parameter>" % p for p in parameters), content)
+    ).encode("utf-8")
+
+
+class OpenDataStandIn(object):
+    """
+    Local HTTP server imitating the OpenData metadata and frame endpoints.
+
+    The server runs in a background thread until `close`. The frames
+    published with `add_frame` are listed by the metadata endpoint at
+    `base_url`, and served as XML documents.
+
+    Parameters
+    ----------
+    latency : float
+        Delay in seconds before each response, to imitate a remote server.
+
+    Attributes
+    ----------
+    failures : dict
+        Number of 503 responses left for each path, to test the retries.
+    connections : int
+        Number of connections opened by the clients.
+    requests : list of str
+        Paths of the requests received.
+    queries : list of dict
+        Parsed query strings of the metadata requests.
+    """
+
+    metadata_path = "/historyapi/v1/getMetadata/O-A0059-001"
+
+    def __init__(self, latency=0.0):
+        self.frames = {}  # dataTime -> frame XML
+        self.failures = {}
+        self.connections = 0
+        self.requests = []
+        self.queries = []
+        self.latency = latency
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                stand_in.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                stand_in.requests.append(path)
+                if stand_in.latency:
+                    sleep(stand_in.latency)
+                if stand_in.failures.get(path, 0) > 0:
+                    stand_in.failures[path] -= 1
+                    return self._send(503, b"busy")
+                if path == stand_in.metadata_path:
+                    query = parse_qs(urlsplit(self.path).query)
+                    stand_in.queries.append(query)
+                    return self._send(
+                        200,
+                        stand_in.metadata_xml(
+                            query.get("timeFrom", [None])[0],
+                            query.get("timeTo", [None])[0],
+                        ),
+                    )
+                name = path.rsplit("/", 1)[-1]
+                for data_time, xml in list(stand_in.frames.items()):
+                    if stand_in.frame_name(data_time) == name:
+                        return self._send(200, xml)
+                self._send(404, b"not found")
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def frame_name(data_time):
+        return data_time.replace("-", "").replace(" ", "").replace(":", "") + ".xml"
+
+    @property
+    def base_url(self):
+        """URL of the metadata endpoint, the ``base_url`` of the downloads."""
+        return self.url + self.metadata_path
+
+    def add_frame(self, data_time, dbz):
+        """Publish a frame, with dataTime in local time ("%Y-%m-%d %H:%M:%S")."""
+        local = datetime.strptime(data_time, "%Y-%m-%d %H:%M:%S")
+        time = local.replace(tzinfo=timezone(timedelta(hours=8))).isoformat()
+        self.frames[data_time] = opendata_frame_xml(dbz, time=time)
+
+    def metadata_xml(self, time_from=None, time_to=None):
+        # The API takes the bounds as "yyyy-MM-ddThh:mm:ss", in local time.
+        time_from = time_from.replace("T", " ") if time_from else ""
+        time_to = time_to.replace("T", " ") if time_to else "9999"
+        times = "".join(
+            "<time><dataTime>%s</dataTime><url>%s/frames/%s</url></time>"
+            % (data_time, self.url, self.frame_name(data_time))
+            for data_time in sorted(self.frames)
+            if time_from <= data_time <= time_to
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<cwbopendata xmlns="urn:cwb:gov:tw:cwbcommon:0.1"><dataset>'
+            "<resources><resource><data>%s</data></resource></resources>"
+            "</dataset></cwbopendata>" % times
+        ).encode("utf-8")
+
+    def close(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
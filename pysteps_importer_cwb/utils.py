@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the modules of the plugin (files, caches, serialization).
+"""
+
+# Import the needed libraries
+import os
+import tempfile
+
+import numpy as np
+
+
+def default_cache_dir():
+    """
+    Directory of the caches of the plugin.
+
+    It is given by the environment variable PYSTEPS_CWB_CACHE_DIR, and defaults
+    to $XDG_CACHE_HOME/pysteps_importer_cwb (~/.cache/pysteps_importer_cwb).
+
+    Returns
+    -------
+    path : str
+    """
+    path = os.environ.get("PYSTEPS_CWB_CACHE_DIR")
+    if path:
+        return path
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "pysteps_importer_cwb")
+
+
+def json_default(value):
+    """JSON encoding of the numpy scalars, for the ``default`` of `json.dumps`."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def write_atomic(filename, data):
+    """
+    Write a file through a temporary file renamed in place.
+
+    Readers never see a partially written file, and concurrent writers of the
+    same file leave one complete version of it.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file. Its directory is created if needed.
+    data : bytes-like or callable
+        Content of the file, or a function writing it to the open binary file
+        object given as argument (e.g. ``lambda fid: np.save(fid, array)``).
+    """
+    dirname = os.path.dirname(filename) or "."
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(
+        dir=dirname, prefix="." + os.path.basename(filename), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as fid:
+            if callable(data):
+                data(fid)
+            else:
+                fid.write(data)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+Integrity checks of COMPREF files and archives.
+
+A truncated or corrupt file (e.g. left by an interrupted copy) is otherwise
+only found when the importer fails in the middle of a nowcast. The functions
+of this module check every file of an archive without decoding it:
+
+- the header is complete and consistent (grid sizes, number of levels and of
+  radars, date),
+- the payload has exactly the ``nz * ny * nx`` int16 values of the header,
+- gzipped files are complete, with a valid CRC for every member.
+
+Gzipped files are decompressed in a streaming pass that keeps no output, so
+checking a file costs about the time of its decompression, and the files are
+checked by a pool of threads (zlib releases the GIL). The results are recorded
+in a state file, and later runs skip the files that have not changed since
+they were checked.
+
+The checks are also available from the command line::
+
+    python -m pysteps_importer_cwb.validate ./radar/cwb_opendata -j 8
+"""
+
+# Import the needed libraries
+import argparse
+import json
+import os
+import sys
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from pysteps_importer_cwb.compref import (
+    _HEAD_DTYPE,
+    _MID_DTYPE,
+    parse_compref_header,
+)
+from pysteps_importer_cwb.importer_cwb_compref import find_cwb_compref
+from pysteps_importer_cwb.utils import write_atomic
+
+# Size in bytes of the blocks read and decompressed at once.
+CHUNK_SIZE = 1 << 20
+
+# Name of the state file of the archive checks, in the root of the archive.
+VALIDATE_STATE_FILE = ".validate_state.json"
+
+# Bounds of the header fields of a plausible COMPREF file.
+MAX_GRID_SIZE = 20000
+MAX_LEVELS = 200
+MAX_RADARS = 1000
+
+_MAX_HEADER_SIZE = (
+    _HEAD_DTYPE.itemsize + _MID_DTYPE.itemsize + 4 * (MAX_LEVELS + MAX_RADARS)
+)
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+ValidationResult = namedtuple("ValidationResult", ["filename", "time", "error"])
+ValidationResult.__doc__ = """\
+Result of the check of a file.
+
+Attributes
+----------
+filename : str
+    Name of the file.
+time : datetime or None
+    Time of the header, if it could be read.
+error : str or None
+    Description of the first problem found, None for a valid file.
+"""
+
+ValidationReport = namedtuple(
+    "ValidationReport", ["checked", "skipped", "bad", "missing"]
+)
+ValidationReport.__doc__ = """\
+Result of the check of an archive.
+
+Attributes
+----------
+checked : int
+    Number of files checked.
+skipped : int
+    Number of files not checked again, unchanged since a previous check.
+bad : list of ValidationResult
+    Invalid files, including the unchanged ones found invalid previously.
+missing : list of datetime
+    Times of the expected frames without file.
+"""
+
+
+def _header_size(buf):
+    """
+    Size of the header starting a buffer, after checking its fields.
+
+    Returns the number of bytes needed to go further when the buffer is too
+    short to tell.
+    """
+    if len(buf) < _HEAD_DTYPE.itemsize:
+        return _HEAD_DTYPE.itemsize
+    head = np.frombuffer(buf, dtype=_HEAD_DTYPE, count=1)[0]
+    nx, ny, nz = int(head["nx"]), int(head["ny"]), int(head["nz"])
+    if not (0 < nx <= MAX_GRID_SIZE and 0 < ny <= MAX_GRID_SIZE):
+        raise ValueError("Invalid grid size %d x %d" % (nx, ny))
+    if not 0 < nz <= MAX_LEVELS:
+        raise ValueError("Invalid number of levels %d" % nz)
+    mid_offset = _HEAD_DTYPE.itemsize + 4 * nz
+    if len(buf) < mid_offset + _MID_DTYPE.itemsize:
+        return mid_offset + _MID_DTYPE.itemsize
+    mid = np.frombuffer(buf, dtype=_MID_DTYPE, count=1, offset=mid_offset)[0]
+    nradar = int(mid["nradar"])
+    if not 0 <= nradar <= MAX_RADARS:
+        raise ValueError("Invalid number of radars %d" % nradar)
+    if int(mid["var_scale"]) <= 0:
+        raise ValueError("Invalid scale %d" % int(mid["var_scale"]))
+    return mid_offset + _MID_DTYPE.itemsize + 4 * nradar
+
+
+class _HeaderCheck(object):
+    """Accumulate the first bytes of a stream until its header is complete."""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.header = None
+
+    def feed(self, data):
+        if self.header is not None:
+            return
+        self.buf += data[: _MAX_HEADER_SIZE - len(self.buf)]
+        # The size is only known, and not larger than the buffer, once the
+        # buffer holds the counts of levels and radars.
+        size = _header_size(self.buf)
+        if size <= len(self.buf):
+            # parse_compref_header also checks the date.
+            self.header = parse_compref_header(bytes(self.buf[:size]))
+            self.buf = None
+
+    def close(self):
+        if self.header is None:
+            raise ValueError("Truncated COMPREF header")
+        return self.header
+
+
+def _scan_gzip(fid, check, chunk_size=CHUNK_SIZE):
+    """Decompress a (multi-member) gzip stream, returning its size."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    size = 0
+    data = b""
+    while True:
+        if not data:
+            data = fid.read(chunk_size)
+            if not data:
+                break
+        if decompressor.eof:
+            # Next member of a multi-member stream, or trailing bytes.
+            if len(data) < len(_GZIP_MAGIC):
+                more = fid.read(chunk_size)
+                if more:
+                    data += more
+                    continue
+            if not data.startswith(_GZIP_MAGIC):
+                if data.strip(b"\0") or fid.read(chunk_size).strip(b"\0"):
+                    raise ValueError("Trailing garbage after the gzip stream")
+                data = b""
+                continue
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = decompressor.decompress(data, chunk_size)
+        size += len(out)
+        check.feed(out)
+        if decompressor.eof:
+            data = decompressor.unused_data
+        else:
+            data = decompressor.unconsumed_tail
+    if not decompressor.eof:
+        raise ValueError("Truncated gzip stream")
+    return size
+
+
+def validate_compref(filename, gzipped=None, chunk_size=CHUNK_SIZE):
+    """
+    Check the integrity of a COMPREF file, without decoding it.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file.
+    gzipped : bool, optional
+        Whether the file is gzip compressed, by default if its name ends with
+        ".gz".
+    chunk_size : int
+        Size in bytes of the blocks read and decompressed at once.
+
+    Returns
+    -------
+    result : ValidationResult
+        The error is None for a valid file.
+    """
+    if gzipped is None:
+        gzipped = filename.endswith(".gz")
+    check = _HeaderCheck()
+    try:
+        with open(filename, "rb") as fid:
+            if gzipped:
+                size = _scan_gzip(fid, check, chunk_size)
+            else:
+                check.feed(fid.read(_MAX_HEADER_SIZE))
+                size = os.fstat(fid.fileno()).st_size
+        header = check.close()
+        expected = header.data_offset + 2 * header.nz * header.ny * header.nx
+        if size != expected:
+            raise ValueError(
+                "Payload of %d bytes, %d expected for %d x %d x %d values"
+                % (
+                    size - header.data_offset,
+                    expected - header.data_offset,
+                    header.nz,
+                    header.ny,
+                    header.nx,
+                )
+            )
+    except (OSError, ValueError, zlib.error) as err:
+        header = check.header
+        return ValidationResult(
+            filename, None if header is None else header.time, str(err)
+        )
+    return ValidationResult(filename, header.time, None)
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file) as fid:
+            return json.load(fid)
+    except (FileNotFoundError, ValueError):
+        return {"files": {}}
+
+
+def _save_state(state_file, state):
+    write_atomic(state_file, json.dumps(state, indent=1, sort_keys=True).encode())
+
+
+def _archive_files(root_path, fn_pattern, fn_ext):
+    """(time, filename) of the files of an archive matching the pattern."""
+    suffix = "." + fn_ext
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root_path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in filenames:
+            if not name.endswith(suffix):
+                continue
+            try:
+                t = datetime.strptime(name[: -len(suffix)], fn_pattern)
+            except ValueError:
+                continue
+            files.append((t, os.path.join(dirpath, name)))
+    files.sort()
+    return files
+
+
+def validate_archive(
+        root_path="./radar/cwb_opendata",
+        start=None,
+        end=None,
+        path_fmt="%Y/%m/%d",
+        fn_pattern="COMPREF.OpenData.%Y%m%d.%H%M",
+        fn_ext="gz",
+        timestep=10,
+        num_workers=None,
+        state_file=None,
+        force=False):
+    """
+    Check all the files of an archive and list its missing frames.
+
+    Parameters
+    ----------
+    root_path : str
+        Root directory of the archive.
+    start, end : datetime, optional
+        Period to check, both included. The files are then located with the
+        layout of `find_cwb_compref`. By default all the files under
+        ``root_path`` whose names match ``fn_pattern`` are checked, and the
+        period is the one of these files.
+    path_fmt, fn_pattern, fn_ext, timestep
+        Layout of the archive, see `find_cwb_compref`.
+    num_workers : int, optional
+        Number of threads checking the files, by default the number of CPUs.
+    state_file : str or bool, optional
+        JSON file recording the results, by default ".validate_state.json" in
+        ``root_path``. The files with the same size and modification time as
+        when they were last checked are not checked again. False disables the
+        state file.
+    force : bool
+        Check all the files, even if unchanged.
+
+    Returns
+    -------
+    report : ValidationReport
+    """
+    if start is not None and end is not None:
+        filenames, timestamps = find_cwb_compref(
+            start, end, root_path=root_path, path_fmt=path_fmt,
+            fn_pattern=fn_pattern, fn_ext=fn_ext, timestep=timestep,
+        )
+        missing = [t for t, fn in zip(timestamps, filenames) if fn is None]
+        files = [(t, fn) for t, fn in zip(timestamps, filenames) if fn is not None]
+    else:
+        files = _archive_files(root_path, fn_pattern, fn_ext)
+        files = [
+            (t, fn) for t, fn in files
+            if (start is None or t >= start) and (end is None or t <= end)
+        ]
+        present = set(t for t, _ in files)
+        missing = []
+        if files:
+            t = files[0][0]
+            while t <= files[-1][0]:
+                if t not in present:
+                    missing.append(t)
+                t += timedelta(minutes=timestep)
+
+    if state_file is None:
+        state_file = os.path.join(root_path, VALIDATE_STATE_FILE)
+    state = _load_state(state_file) if state_file else {"files": {}}
+    recorded = state["files"]
+
+    bad = []
+    todo = []
+    skipped = 0
+    for _, filename in files:
+        key = os.path.relpath(filename, root_path)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        entry = recorded.get(key)
+        if (
+            not force
+            and entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            skipped += 1
+            if entry["error"] is not None:
+                bad.append(ValidationResult(filename, None, entry["error"]))
+            continue
+        todo.append((key, filename, stat))
+
+    def _check(item):
+        key, filename, stat = item
+        return key, stat, validate_compref(filename, gzipped=fn_ext == "gz")
+
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        for key, stat, result in executor.map(_check, todo):
+            if result.error is not None:
+                bad.append(result)
+            recorded[key] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "error": result.error,
+            }
+
+    if state_file and todo:
+        _save_state(state_file, state)
+    bad.sort(key=lambda result: result.filename)
+    return ValidationReport(len(todo), skipped, bad, missing)
+
+
+def _parse_time(value):
+    for fmt in ("%Y%m%d%H%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid time %r" % value)
+
+
+def main(argv=None):
+    """
+    Command line interface of `validate_archive`.
+
+    The exit status is 1 if invalid files are found, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m pysteps_importer_cwb.validate",
+        description="Check the integrity of the COMPREF files of an archive.",
+    )
+    parser.add_argument("root_path", help="root directory of the archive")
+    parser.add_argument("--start", type=_parse_time, help="first time (UTC)")
+    parser.add_argument("--end", type=_parse_time, help="last time (UTC)")
+    parser.add_argument("--path-fmt", default="%Y/%m/%d")
+    parser.add_argument("--fn-pattern", default="COMPREF.OpenData.%Y%m%d.%H%M")
+    parser.add_argument("--fn-ext", default="gz")
+    parser.add_argument("--timestep", type=int, default=10, help="minutes")
+    parser.add_argument("-j", "--num-workers", type=int, help="number of threads")
+    parser.add_argument("--state-file", help="file recording the results")
+    parser.add_argument(
+        "--no-state", action="store_true", help="do not record the results"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="check the unchanged files again"
+    )
+    args = parser.parse_args(argv)
+
+    report = validate_archive(
+        args.root_path,
+        start=args.start,
+        end=args.end,
+        path_fmt=args.path_fmt,
+        fn_pattern=args.fn_pattern,
+        fn_ext=args.fn_ext,
+        timestep=args.timestep,
+        num_workers=args.num_workers,
+        state_file=False if args.no_state else args.state_file,
+        force=args.force,
+    )
+    for result in report.bad:
+        print("BAD %s: %s" % (result.filename, result.error))
+    for t in report.missing:
+        print("MISSING %s" % t.strftime("%Y-%m-%d %H:%M"))
+    print(
+        "%d checked, %d unchanged, %d bad, %d missing"
+        % (report.checked, report.skipped, len(report.bad), len(report.missing))
+    )
+    return 1 if report.bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -67,7 +67,10 @@ setup(
         'pysteps.plugins.importers': [
             'importer_cwb_compref_cwb=pysteps_importer_cwb.importer_cwb_compref:importer_cwb_compref_cwb',
             # Add additional importers if needed.
-        ]
+        ],
+        'console_scripts': [
+            'pysteps-cwb-validate=pysteps_importer_cwb.validate:main',
+        ],
     },
     version='0.1.0',
     zip_safe=False,
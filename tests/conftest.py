@@ -0,0 +1,63 @@
+"""Shared fixtures for the `pysteps_importer_cwb` tests."""
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from pysteps_importer_cwb.compref import write_compref
+from pysteps_importer_cwb.testing import OpenDataStandIn, synthetic_header
+
+
+def _write_compref(filename, raw, gzipped=True, time=datetime(2022, 12, 6, 2, 30),
+                   mosradar=("RCWF", "RCHL", "RCCG"), **kwargs):
+    """Write raw values to a single level COMPREF file, with the header options
+    of `synthetic_header` (lon0, lat0, res, var_scale)."""
+    ny, nx = np.shape(raw)
+    header = synthetic_header(ny, nx, time=time, mosradar=mosradar, **kwargs)
+    return write_compref(filename, header, raw, gzipped=gzipped)
+
+
+def _synthetic_raw(ny=40, nx=30, seed=0):
+    """Scaled int16 reflectivity with clear sky (-99 dBZ) and no-value (-999 dBZ) pixels."""
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 600, size=(ny, nx)).astype("<i2")
+    raw[:5] = -990
+    raw[:, :3] = -9990
+    return raw
+
+
+@pytest.fixture
+def write_raw_compref():
+    """Factory writing raw fields to COMPREF files, see `_write_compref`."""
+    return _write_compref
+
+
+@pytest.fixture
+def synthetic_raw():
+    """Factory of raw reflectivity fields, see `_synthetic_raw`."""
+    return _synthetic_raw
+
+
+@pytest.fixture
+def compref_raw():
+    return _synthetic_raw()
+
+
+@pytest.fixture
+def compref_file(tmp_path, compref_raw):
+    return _write_compref(str(tmp_path / "COMPREF.20221206.0230.gz"), compref_raw)
+
+
+@pytest.fixture
+def compref_file_raw(tmp_path, compref_raw):
+    return _write_compref(
+        str(tmp_path / "COMPREF.20221206.0230"), compref_raw, gzipped=False
+    )
+
+
+@pytest.fixture
+def opendata_server():
+    server = OpenDataStandIn()
+    yield server
+    server.close()
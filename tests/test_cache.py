@@ -0,0 +1,84 @@
+"""Tests for `pysteps_importer_cwb.cache`."""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def test_frame_cache(tmp_path, compref_file, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.cache import FrameCache
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        importer_cwb_compref_cwb,
+        read_cwb_compref,
+    )
+
+    cache = FrameCache(str(tmp_path / "cache"))
+    expected, _, expected_metadata = read_cwb_compref(compref_file, gzipped=True)
+
+    precip, _, metadata = cache.read(compref_file, gzipped=True)
+    np.testing.assert_array_equal(precip, expected)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    precip, _, metadata = cache.read(compref_file, gzipped=True)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert isinstance(precip, np.memmap) and not precip.flags.writeable
+    np.testing.assert_array_equal(precip, expected)
+    assert metadata == expected_metadata
+
+    # Other options are other entries.
+    precip, _, metadata = cache.read(compref_file, gzipped=True, dtype="int16")
+    assert precip.dtype == np.int16 and metadata["var_scale"] == 10
+    assert cache.misses == 2
+
+    # Through the pysteps importer, with the postprocessing.
+    precip, _, _ = importer_cwb_compref_cwb(
+        compref_file, gzipped=True, cache=cache, fillna=-15.0
+    )
+    assert cache.hits == 2
+    assert (precip == -15.0).sum() == np.isnan(expected).sum()
+
+    # A modified source file is decoded again.
+    time.sleep(0.01)
+    write_raw_compref(compref_file, synthetic_raw(seed=5))
+    precip, _, _ = cache.read(compref_file, gzipped=True)
+    assert cache.misses == 3
+    assert not np.array_equal(precip, expected, equal_nan=True)
+
+
+def test_frame_cache_eviction(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.cache import FrameCache
+
+    filenames = [
+        write_raw_compref(str(tmp_path / ("f%d.gz" % i)), synthetic_raw(seed=i))
+        for i in range(6)
+    ]
+    frame_bytes = 40 * 30 * 8 + 128
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=3 * frame_bytes)
+
+    for fn in filenames[:3]:
+        cache.read(fn, gzipped=True)
+    time.sleep(0.01)
+    cache.read(filenames[0], gzipped=True)  # Most recently used.
+    time.sleep(0.01)
+    cache.read(filenames[3], gzipped=True)
+    assert cache.size() <= 3 * frame_bytes
+    assert len([n for n in os.listdir(cache.cache_dir) if n.endswith(".npy")]) == 3
+
+    hits = cache.hits
+    cache.read(filenames[0], gzipped=True)
+    assert cache.hits == hits + 1
+    cache.read(filenames[1], gzipped=True)  # Evicted.
+    assert cache.hits == hits + 1
+
+    # Concurrent readers and writers of the same entries.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda fn: np.nansum(cache.read(fn, gzipped=True)[0]), filenames * 4
+            )
+        )
+    assert results[:6] == results[6:12]
+    cache.clear()
+    assert cache.size() == 0
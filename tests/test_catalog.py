@@ -0,0 +1,95 @@
+"""Tests for `pysteps_importer_cwb.catalog`."""
+
+import os
+from datetime import datetime, timedelta
+
+
+def _archive(write_raw_compref, synthetic_raw, root, times):
+    filenames = []
+    for t in times:
+        directory = os.path.join(root, t.strftime("%Y/%m/%d"))
+        os.makedirs(directory, exist_ok=True)
+        fn = os.path.join(directory, t.strftime("COMPREF.OpenData.%Y%m%d.%H%M.gz"))
+        write_raw_compref(fn, synthetic_raw(8, 6), time=t)
+        filenames.append(fn)
+    return filenames
+
+
+def test_catalog(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.catalog import Catalog
+
+    root = str(tmp_path / "archive")
+    t0 = datetime(2022, 12, 6, 23, 0)
+    times = [t0 + timedelta(minutes=10 * i) for i in (0, 1, 2, 5, 6, 7)]
+    filenames = _archive(write_raw_compref, synthetic_raw, root, times)
+
+    with Catalog(str(tmp_path / "catalog.sqlite"), root_path=root) as catalog:
+        assert catalog.update() == (6, 0)
+        assert len(catalog) == 6
+        # Nothing changed: no directory is listed again.
+        assert catalog.update() == (0, 0)
+
+        entries = catalog.frames(t0 + timedelta(minutes=10), t0 + timedelta(minutes=50))
+        assert [e.time for e in entries] == times[1:4]
+        assert entries[0].path == filenames[1]
+        assert entries[0].mosradar == ("RCWF", "RCHL", "RCCG")
+        assert (entries[0].nx, entries[0].ny, entries[0].nradar) == (6, 8, 3)
+
+        assert catalog.nearest(t0 + timedelta(minutes=38)).time == times[3]
+        assert catalog.nearest(t0 + timedelta(minutes=31)).time == times[2]
+        assert catalog.nearest(
+            t0 + timedelta(minutes=31), tolerance=timedelta(minutes=5)
+        ) is None
+
+        assert catalog.gaps(t0 - timedelta(minutes=10), t0 + timedelta(minutes=80)) == [
+            (t0 - timedelta(minutes=10), t0 - timedelta(minutes=10)),
+            (t0 + timedelta(minutes=30), t0 + timedelta(minutes=40)),
+            (t0 + timedelta(minutes=80), t0 + timedelta(minutes=80)),
+        ]
+
+        fns, timestamps = catalog.find(t0, t0 + timedelta(minutes=30))
+        assert fns == filenames[:3] + [None]
+        assert timestamps[-1] == t0 + timedelta(minutes=30)
+
+        # New frames on the next day, and a removed one.
+        new = _archive(
+            write_raw_compref, synthetic_raw, root,
+            [t0 + timedelta(minutes=60 + 10 * i) for i in (2, 3)],
+        )
+        os.remove(filenames[0])
+        assert catalog.update() == (2, 1)
+        assert [e.path for e in catalog.frames(t0, t0 + timedelta(days=1))] == (
+            filenames[1:] + new
+        )
+
+    # The catalog persists between sessions.
+    with Catalog(str(tmp_path / "catalog.sqlite"), root_path=root) as catalog:
+        assert len(catalog) == 7
+
+
+def test_catalog_unreadable(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.catalog import Catalog
+
+    root = str(tmp_path / "archive")
+    t0 = datetime(2022, 12, 6, 23, 0)
+    times = [t0 + timedelta(minutes=10 * i) for i in range(3)]
+    filenames = _archive(write_raw_compref, synthetic_raw, root, times)
+    with open(filenames[1], "rb") as f:
+        data = f.read()
+    # An empty and a truncated download.
+    with open(filenames[1], "wb") as f:
+        f.write(data[: len(data) // 4])
+    open(filenames[2], "wb").close()
+
+    with Catalog(str(tmp_path / "catalog.sqlite"), root_path=root) as catalog:
+        assert catalog.update() == (1, 0)
+        assert [e.path for e in catalog.frames(t0, times[-1])] == filenames[:1]
+        assert sorted(catalog.unreadable) == filenames[1:]
+        # The directory is listed again until the files are repaired.
+        assert catalog.update() == (0, 0)
+        assert sorted(catalog.unreadable) == filenames[1:]
+        with open(filenames[1], "wb") as f:
+            f.write(data)
+        assert catalog.update() == (1, 0)
+        assert list(catalog.unreadable) == filenames[2:]
+        assert len(catalog) == 2
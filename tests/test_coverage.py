@@ -0,0 +1,112 @@
+"""Tests of the radar coverage and of the compact int16 fields."""
+
+import numpy as np
+import pytest
+
+
+def test_coverage_field():
+    from pysteps_importer_cwb.coverage import RADAR_SITES, coverage_field
+    from pysteps_importer_cwb.geometry import GridGeometry
+
+    geometry = GridGeometry(118.0, 20.0, 0.05, 0.05, 140, 120)
+    coverage = coverage_field(geometry, ("RCWF", "RCHL", "XXXX"))
+    assert coverage.dtype == np.uint8
+    assert coverage.shape == (120, 140)
+    assert not coverage.flags.writeable
+    # Cached per grid and combination of radars.
+    assert coverage_field(geometry, ["RCWF", "RCHL", "XXXX"]) is coverage
+    assert coverage_field(geometry, ("RCWF",)) is not coverage
+
+    def pixel(code):
+        lon, lat, _ = RADAR_SITES[code]
+        return round((lat - 20.0) / 0.05), round((lon - 118.0) / 0.05)
+
+    assert coverage[pixel("RCWF")] == 2
+    assert coverage[pixel("RCKT")] == 0
+    assert coverage[0, 0] == 0
+    assert coverage.max() == 2
+
+    # The same counts as the distances of all the pixels.
+    lons, lats = geometry.coordinates()
+    from pysteps_importer_cwb.coverage import _distance
+
+    expected = sum(
+        _distance(lons, lats, *RADAR_SITES[code][:2]) <= 100e3
+        for code in ("RCWF", "RCHL")
+    )
+    np.testing.assert_array_equal(
+        coverage_field(geometry, ("RCWF", "RCHL"), max_range=100e3), expected
+    )
+
+
+def test_compact_and_quality(tmp_path, write_raw_compref):
+    from pysteps.io import get_method
+
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        importer_cwb_compref_cwb,
+        read_cwb_compref,
+    )
+
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 600, size=(200, 240)).astype("<i2")
+    raw[:, :3] = -9990
+    filename = write_raw_compref(
+        str(tmp_path / "COMPREF.gz"), raw, lon0=119.0, lat0=21.5, res=0.02
+    )
+
+    precip, quality, metadata = read_cwb_compref(
+        filename, gzipped=True, dtype="int16", quality=True
+    )
+    assert precip.dtype == np.int16
+    np.testing.assert_array_equal(precip, raw)
+    assert metadata["var_scale"] == 10
+    assert metadata["missing"] == -9990
+    assert quality.dtype == np.uint8
+    assert quality.shape == raw.shape
+    assert quality.max() == 3
+    assert quality.min() == 0
+
+    masked, _, _ = read_cwb_compref(filename, gzipped=True, dtype="int16", masked=True)
+    assert isinstance(masked, np.ma.MaskedArray)
+    assert masked.dtype == np.int16
+    np.testing.assert_array_equal(masked.mask, raw == -9990)
+    from pysteps_importer_cwb.cache import FrameCache
+
+    with pytest.raises(ValueError, match="not cached"):
+        FrameCache(str(tmp_path / "cache")).read(filename, gzipped=True, masked=True)
+
+    # The pysteps postprocessing casts to floating point: the importers only
+    # give floating point fields, directly and through the pysteps interface.
+    importer = get_method("importer_cwb_compref_cwb", "importer")
+    for func in (importer_cwb_compref_cwb, importer):
+        with pytest.raises(ValueError, match="precision"):
+            func(filename, gzipped=True, dtype="int16")
+
+    # The quality field follows the grid of the imported field, also through
+    # the pysteps interface.
+    dbz, quality_pysteps, _ = importer(filename, gzipped=True, quality=True)
+    assert dbz.dtype == np.float64
+    assert quality_pysteps.dtype == np.uint8
+    np.testing.assert_array_equal(quality_pysteps, quality)
+
+    roi = (slice(10, 90), slice(20, 130))
+    _, quality_roi, _ = importer_cwb_compref_cwb(
+        filename, gzipped=True, roi=roi, quality=True
+    )
+    np.testing.assert_array_equal(quality_roi, quality[roi])
+    _, quality_roi, _ = read_cwb_compref(
+        filename, gzipped=True, roi=roi, dtype="int16", quality=True
+    )
+    np.testing.assert_array_equal(quality_roi, quality[roi])
+
+    coarse, quality_coarse, _ = importer_cwb_compref_cwb(
+        filename, gzipped=True, coarsen=8, quality=True
+    )
+    assert quality_coarse.shape == coarse.shape == (25, 30)
+    assert quality_coarse[0, 0] == quality[:8, :8].max()
+
+    regridded, quality_regrid, _ = importer_cwb_compref_cwb(
+        filename, gzipped=True, regrid=5000.0, quality=True
+    )
+    assert quality_regrid.shape == regridded.shape
+    assert quality_regrid.dtype == np.uint8
@@ -0,0 +1,93 @@
+"""Tests for `pysteps_importer_cwb.dataset`."""
+
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+
+def _archive(write_raw_compref, synthetic_raw, root, count=6, missing=(2,)):
+    start = datetime(2022, 12, 6, 2, 0)
+    for i in range(count):
+        if i in missing:
+            continue
+        t = start + timedelta(minutes=10 * i)
+        path = os.path.join(root, t.strftime("%Y/%m/%d"))
+        os.makedirs(path, exist_ok=True)
+        write_raw_compref(
+            os.path.join(path, t.strftime("COMPREF.OpenData.%Y%m%d.%H%M.gz")),
+            synthetic_raw(seed=i), time=t,
+        )
+    return start, start + timedelta(minutes=10 * (count - 1))
+
+
+def test_dataset_matches_importer(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.dataset import open_archive_cwb_compref
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        find_cwb_compref,
+        importer_cwb_compref_cwb,
+    )
+
+    start, end = _archive(write_raw_compref, synthetic_raw, str(tmp_path))
+    ds = open_archive_cwb_compref(start, end, root_path=str(tmp_path))
+    assert ds.shape == (6, 40, 30)
+    assert ds.times[1] == start + timedelta(minutes=10)
+
+    filenames, _ = find_cwb_compref(start, end, root_path=str(tmp_path))
+    expected = np.stack([
+        np.full((40, 30), np.nan) if fn is None
+        else importer_cwb_compref_cwb(fn, gzipped=True)[0]
+        for fn in filenames
+    ])
+    np.testing.assert_array_equal(np.asarray(ds), expected)
+    for key, reference in [
+        (-1, expected[-1]),
+        ((slice(1, 4), slice(10, 25), slice(3, 20)), expected[1:4, 10:25, 3:20]),
+        ((slice(None, None, 2), 5, slice(None, None, -3)), expected[::2, 5, ::-3]),
+        ((Ellipsis, [1, 7, 3]), expected[..., [1, 7, 3]]),
+        # Index arrays select the outer product of the axes.
+        (([0, 5], slice(30, 35), [2, 2, 9]), expected[[0, 5], 30:35][..., [2, 2, 9]]),
+        ((np.array([True, False] * 3), slice(5, 5)), expected[::2, 5:5]),
+    ]:
+        np.testing.assert_array_equal(ds[key], reference)
+
+    # Region of interest, decoded rows only.
+    roi = open_archive_cwb_compref(
+        start, end, root_path=str(tmp_path), roi=(slice(10, 30), slice(5, 25)),
+        num_workers=2,
+    )
+    assert roi.shape == (6, 20, 20)
+    np.testing.assert_array_equal(roi[:, 2:8, 1:4], expected[:, 12:18, 6:9])
+    metadata = importer_cwb_compref_cwb(
+        filenames[0], gzipped=True, roi=(slice(10, 30), slice(5, 25))
+    )[2]
+    assert roi.metadata == metadata
+
+
+def test_dataset_reductions(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.dataset import open_cwb_compref
+    from pysteps_importer_cwb.importer_cwb_compref import find_cwb_compref
+
+    start, end = _archive(write_raw_compref, synthetic_raw, str(tmp_path), count=7)
+    inputfns = find_cwb_compref(start, end, root_path=str(tmp_path))
+    ds = open_cwb_compref(inputfns, gzipped=True)
+    frames = np.asarray(ds)
+    valid = (~np.isnan(frames)).sum(axis=0)
+    with np.errstate(invalid="ignore"):
+        mean = np.nansum(frames, axis=0) / valid
+    np.testing.assert_allclose(ds.mean(chunk_size=3), mean)
+    np.testing.assert_array_equal(
+        ds.count_exceeding(20.0, chunk_size=2), (frames > 20.0).sum(axis=0)
+    )
+    np.testing.assert_array_equal(ds.count_valid(), valid)
+
+    raw = open_cwb_compref(inputfns[0], gzipped=True, dtype="int16")
+    assert raw.dtype == np.int16
+    assert raw[2].min() == raw.metadata["missing"]
+    np.testing.assert_array_equal(raw.count_valid(), valid)
+
+    with pytest.raises(IndexError):
+        ds[0, 0, 0, 0]
+    with pytest.raises(IOError):
+        open_cwb_compref([None, None])
@@ -0,0 +1,84 @@
+"""Tests for `pysteps_importer_cwb.instrument`."""
+
+import numpy as np
+
+from pysteps_importer_cwb import instrument
+
+
+def test_off_by_default(compref_file):
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+
+    assert instrument.timer() is None
+    read_cwb_compref(compref_file, gzipped=True)
+
+
+def test_collect_import_stages(compref_file, compref_raw):
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+
+    with instrument.collect() as stats:
+        read_cwb_compref(compref_file, gzipped=True, roi=(slice(10, 30), slice(None)))
+    assert instrument.timer() is None
+
+    assert list(stats)[:4] == ["header", "gunzip", "scale", "mask"]
+    assert stats["header"].count == 2
+    # Decompression stops after the window: the rows before it are skipped.
+    assert stats["gunzip"].nbytes == 30 * compref_raw.shape[1] * 2
+    assert stats["scale"].count == stats["mask"].count
+    assert "metadata" in stats and "regrid" not in stats
+    assert all(s.seconds >= 0 for _, s in stats.items())
+
+    with instrument.collect() as stats:
+        read_cwb_compref(compref_file, gzipped=True, rainrate=True, regrid=2000.0)
+    assert {"header", "lut", "gunzip", "metadata", "regrid"} <= set(stats)
+    assert "scale" not in stats
+    assert stats["gunzip"].nbytes == compref_raw.nbytes
+    assert stats["regrid"].nbytes > 0
+    assert "regrid" in str(stats)
+    assert stats.as_dict()["lut"]["count"] == 2
+
+
+def test_callbacks_and_timer():
+    records = []
+
+    def callback(stage, seconds, nbytes):
+        records.append((stage, nbytes))
+
+    instrument.add_callback(callback)
+    try:
+        with instrument.collect() as stats:
+            timer = instrument.timer()
+            timer.lap("a", 10)
+            timer.skip()
+            timer.lap("b", 5)
+            timer.lap("b", 7)
+        instrument.timer().lap("c")
+    finally:
+        instrument.remove_callback(callback)
+
+    assert records == [("a", 10), ("b", 5), ("b", 7), ("c", 0)]
+    assert stats["b"].count == 2 and stats["b"].nbytes == 12
+    assert stats["b"].seconds >= 0
+    assert "c" not in stats
+    assert instrument.timer() is None
+
+
+def test_http_stages(tmp_path, opendata_server):
+    from pysteps_importer_cwb.opendata import download_cwb_opendata
+
+    opendata_server.add_frame("2022-12-06 10:00:00", np.zeros((20, 16)))
+    opendata_server.failures[
+        "/frames/" + opendata_server.frame_name("2022-12-06 10:00:00")
+    ] = 1
+    with instrument.collect() as stats:
+        download_cwb_opendata(
+            path=str(tmp_path),
+            timeFrom="2022-12-06 10:00:00",
+            timeTo="2022-12-06 10:00:00",
+            retries=1,
+            base_url=opendata_server.base_url,
+        )
+    # The metadata and the frame, after a failed attempt.
+    assert stats["http"].count == 2
+    assert stats["http_error"].count == 1
+    assert stats["http"].nbytes > 0
+    assert stats["compress"].nbytes == stats["write"].nbytes > 0
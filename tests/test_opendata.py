@@ -0,0 +1,266 @@
+"""Tests for `pysteps_importer_cwb.opendata`."""
+
+import os
+
+import numpy as np
+import pytest
+
+
+def _dbz(seed):
+    rng = np.random.default_rng(seed)
+    dbz = rng.integers(0, 60, size=(20, 16)).astype(float)
+    dbz[:3] = -99.0
+    dbz[:, :2] = -999.0
+    return dbz
+
+
+def test_download_cwb_opendata(tmp_path, opendata_server):
+    from pysteps_importer_cwb.compref import decode_compref, read_compref_header
+    from pysteps_importer_cwb.opendata import _frame_path, download_cwb_opendata
+
+    times = ["2022-12-06 10:%02d:00" % m for m in (0, 10, 20, 30)]
+    for i, data_time in enumerate(times):
+        opendata_server.add_frame(data_time, _dbz(i))
+    # The first request of a frame fails and must be retried.
+    opendata_server.failures["/frames/" + opendata_server.frame_name(times[1])] = 1
+
+    path = str(tmp_path / "cwb_opendata")
+    written = download_cwb_opendata(
+        path=path,
+        timeFrom="2022-12-06 10:00:00",
+        timeTo="2022-12-06 10:30:00",
+        num_workers=2,
+        retries=2,
+        base_url=opendata_server.base_url,
+    )
+    expected = [_frame_path(path, t) for t in times]
+    assert sorted(written) == sorted(expected)
+    # Connections are reused: one for the metadata, at most one per worker.
+    assert opendata_server.connections <= 3
+
+    header = read_compref_header(expected[2], gzipped=True)
+    assert header.mosradar == ("RCWF", "RCHL", "RCCG")
+    assert (header.nx, header.ny) == (16, 20)
+    precip, _ = decode_compref(expected[2], gzipped=True)
+    dbz = _dbz(2)
+    np.testing.assert_array_equal(np.isnan(precip), dbz == -999.0)
+    np.testing.assert_array_equal(precip[dbz > -999], dbz[dbz > -999])
+
+    # Existing files are kept and not downloaded again.
+    assert download_cwb_opendata(
+        path=path,
+        remove_exist=False,
+        timeFrom="2022-12-06 10:00:00",
+        timeTo="2022-12-06 10:30:00",
+        base_url=opendata_server.base_url,
+    ) == []
+    leftovers = [
+        fn for _, _, fns in os.walk(path) for fn in fns if fn.endswith(".tmp")
+    ]
+    assert leftovers == []
+
+
+def test_http_client_gives_up(opendata_server):
+    from pysteps_importer_cwb.opendata import HTTPClient
+
+    opendata_server.failures[opendata_server.metadata_path] = 5
+    client = HTTPClient(timeout=5, retries=1, backoff=0.01)
+    with pytest.raises(IOError):
+        client.get(opendata_server.base_url)
+    assert opendata_server.requests.count(opendata_server.metadata_path) == 2
+    with pytest.raises(IOError):
+        client.get(opendata_server.url + "/missing")
+    client.close()
+
+
+def test_decode_csv_int16():
+    from pysteps_importer_cwb.opendata import decode_csv_int16
+
+    text = "-99.00, 12.5,0.04,-999,7.,30.25\n,-0.5,45"
+    expected = [-990, 125, 0, -9990, 70, 302, -5, 450]
+    np.testing.assert_array_equal(decode_csv_int16(text), expected)
+    # Chunks cut after every few values give the same result.
+    np.testing.assert_array_equal(decode_csv_int16(text, chunk_size=4), expected)
+    np.testing.assert_array_equal(decode_csv_int16("1e1,-2.5E0"), [100, -25])
+    with pytest.raises(ValueError):
+        decode_csv_int16("1.5,,2")
+    # Corrupt values are rejected instead of wrapping around.
+    np.testing.assert_array_equal(decode_csv_int16("3276.7,-3276.7"), [32767, -32767])
+    for text in ("1,3276.8", "-5000,1", "1,nan", "inf"):
+        with pytest.raises(ValueError, match="int16 range"):
+            decode_csv_int16(text, chunk_size=2)
+
+
+def test_decode_csv_int16_memory():
+    import tracemalloc
+
+    from pysteps_importer_cwb.opendata import decode_csv_int16
+
+    # The decoding holds the int16 output and one chunk, not a full float array.
+    text = ",".join(["-99.00", "12.50", "-999.00", "43.25"] * 200000)
+    tracemalloc.start()
+    values = decode_csv_int16(text, chunk_size=1 << 16)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert len(values) == 800000
+    assert peak < values.nbytes + 400000
+
+
+def test_parse_opendata_frame():
+    from pysteps_importer_cwb.testing import opendata_frame_xml
+    from pysteps_importer_cwb.opendata import parse_opendata_frame
+
+    dbz = _dbz(0)
+    parameters, values = parse_opendata_frame(opendata_frame_xml(dbz))
+    assert parameters[4]["parameterValue"] == "16*20"
+    assert parameters[0]["radarName"].startswith("五分山")
+    np.testing.assert_array_equal(values, (dbz * 10).ravel())
+
+
+def test_sync_cwb_opendata(tmp_path, opendata_server):
+    import json
+
+    from pysteps_importer_cwb.opendata import _frame_path, sync_cwb_opendata
+
+    path = str(tmp_path / "cwb_opendata")
+    times = ["2022-12-06 10:%02d:00" % m for m in (0, 10, 20, 30, 40)]
+    for i, data_time in enumerate(times[:3]):
+        opendata_server.add_frame(data_time, _dbz(i))
+
+    def sync():
+        return sync_cwb_opendata(
+            path=path, timeFrom="2022-12-06 09:00:00", base_url=opendata_server.base_url
+        )
+
+    assert sorted(sync()) == [_frame_path(path, t) for t in times[:3]]
+    with open(os.path.join(path, ".sync_state.json")) as fid:
+        state = json.load(fid)
+    assert state["last_dataTime"] == times[2]
+    assert len(state["files"]) == 3
+
+    # Only the window after the last synchronized frame is requested.
+    for i, data_time in enumerate(times[3:], 3):
+        opendata_server.add_frame(data_time, _dbz(i))
+    del opendata_server.requests[:]
+    assert sorted(sync()) == [_frame_path(path, t) for t in times[3:]]
+    assert opendata_server.queries[-1]["timeFrom"] == ["2022-12-06T10:20:01"]
+    assert len(opendata_server.requests) == 3
+
+    # Damaged or deleted files are fetched again, also when the damage keeps
+    # the size of the file.
+    with open(_frame_path(path, times[1]), "r+b") as fid:
+        fid.truncate(10)
+    os.remove(_frame_path(path, times[3]))
+    with open(_frame_path(path, times[4]), "r+b") as fid:
+        fid.seek(20)
+        byte = fid.read(1)
+        fid.seek(20)
+        fid.write(bytes([byte[0] ^ 0xFF]))
+    assert sorted(sync()) == [_frame_path(path, t) for t in times[1::2] + times[4:]]
+    assert sync() == []
+
+    # Only the files of the lookback window before the last frame are kept in
+    # the state, and checked.
+    os.remove(_frame_path(path, times[0]))
+    assert sync_cwb_opendata(
+        path=path, lookback=900, base_url=opendata_server.base_url
+    ) == []
+    with open(os.path.join(path, ".sync_state.json")) as fid:
+        state = json.load(fid)
+    assert sorted(record["dataTime"] for record in state["files"].values()) == [
+        times[3], times[4]
+    ]
+
+
+def test_sync_cwb_opendata_failed_frame(tmp_path, opendata_server, monkeypatch):
+    from pysteps_importer_cwb import opendata
+    from pysteps_importer_cwb.opendata import sync_cwb_opendata
+
+    path = str(tmp_path / "cwb_opendata")
+    times = ["2022-12-06 10:%02d:00" % m for m in (0, 10, 20)]
+    for i, data_time in enumerate(times):
+        opendata_server.add_frame(data_time, _dbz(i))
+    opendata_server.failures["/frames/" + opendata_server.frame_name(times[1])] = 10
+
+    sleeps = []
+    monkeypatch.setattr(opendata.time, "sleep", sleeps.append)
+    written = sync_cwb_opendata(
+        path=path,
+        timeFrom="2022-12-06 09:00:00",
+        retries=0,
+        poll_interval=60,
+        max_polls=2,
+        base_url=opendata_server.base_url,
+    )
+    # The failed frame holds the synchronization back and is retried by the
+    # next poll, without downloading the other frames again.
+    assert len(written) == 2
+    assert sleeps == [60]
+    assert opendata_server.queries[-1]["timeFrom"] == ["2022-12-06T10:00:01"]
+    opendata_server.failures.clear()
+    assert len(sync_cwb_opendata(
+        path=path, base_url=opendata_server.base_url
+    )) == 1
+
+
+def test_sync_cwb_opendata_existing_files(tmp_path, opendata_server):
+    import json
+
+    from pysteps_importer_cwb.opendata import download_cwb_opendata, sync_cwb_opendata
+
+    path = str(tmp_path / "cwb_opendata")
+    times = ["2022-12-06 10:%02d:00" % m for m in (0, 10, 20)]
+    for i, data_time in enumerate(times):
+        opendata_server.add_frame(data_time, _dbz(i))
+    assert len(download_cwb_opendata(
+        path=path,
+        timeFrom=times[0],
+        timeTo=times[-1],
+        base_url=opendata_server.base_url,
+    )) == 3
+
+    # The files of the archive are recorded, without downloading them again.
+    del opendata_server.requests[:]
+    assert sync_cwb_opendata(
+        path=path, timeFrom="2022-12-06 09:00:00", base_url=opendata_server.base_url
+    ) == []
+    assert opendata_server.requests == [opendata_server.metadata_path]
+    with open(os.path.join(path, ".sync_state.json")) as fid:
+        state = json.load(fid)
+    assert state["last_dataTime"] == times[-1]
+    assert len(state["files"]) == 3
+
+
+def test_sync_cwb_opendata_failures_cap(tmp_path, opendata_server, monkeypatch):
+    import json
+
+    from pysteps_importer_cwb import opendata
+    from pysteps_importer_cwb.opendata import sync_cwb_opendata
+
+    path = str(tmp_path / "cwb_opendata")
+    times = ["2022-12-06 10:%02d:00" % m for m in (0, 10, 20)]
+    for i, data_time in enumerate(times):
+        opendata_server.add_frame(data_time, _dbz(i))
+    opendata_server.failures["/frames/" + opendata_server.frame_name(times[1])] = 100
+
+    monkeypatch.setattr(opendata.time, "sleep", lambda seconds: None)
+    written = sync_cwb_opendata(
+        path=path,
+        timeFrom="2022-12-06 09:00:00",
+        retries=0,
+        poll_interval=60,
+        max_polls=5,
+        max_failures=3,
+        base_url=opendata_server.base_url,
+    )
+    assert len(written) == 2
+    # The frame is requested by 3 synchronizations, then skipped.
+    frame_path = "/frames/" + opendata_server.frame_name(times[1])
+    assert opendata_server.requests.count(frame_path) == 3
+    assert [query["timeFrom"] for query in opendata_server.queries[2:]] == [
+        ["2022-12-06T10:00:01"], ["2022-12-06T10:20:01"], ["2022-12-06T10:20:01"]
+    ]
+    with open(os.path.join(path, ".sync_state.json")) as fid:
+        state = json.load(fid)
+    assert state["last_dataTime"] == times[-1]
+    assert state["failures"] == {times[1]: 3}
@@ -0,0 +1,105 @@
+"""Tests for `pysteps_importer_cwb.pack`."""
+
+import gzip
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+
+def _frames(write_raw_compref, tmp_path, count=7):
+    """Consecutive frames of a slowly moving rain cell over clear sky."""
+    y, x = np.mgrid[:60, :50]
+    filenames = []
+    for i in range(count):
+        r2 = (y - 20 - 0.5 * i) ** 2 + (x - 15 - 0.5 * i) ** 2
+        raw = np.where(r2 < 150, 450 * np.exp(-r2 / 200.0), -990).astype("<i2")
+        raw[:, :4] = -9990
+        t = datetime(2022, 12, 6, 2, 0) + timedelta(minutes=10 * i)
+        filenames.append(
+            write_raw_compref(
+                str(tmp_path / t.strftime("COMPREF.%Y%m%d.%H%M.gz")), raw,
+                time=t,
+            )
+        )
+    return filenames
+
+
+@pytest.mark.parametrize("encoding", [None, "delta", "xor"])
+def test_pack_round_trip(tmp_path, write_raw_compref, encoding):
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+    from pysteps_importer_cwb.pack import PackFile, pack_compref
+
+    filenames = _frames(write_raw_compref, tmp_path)
+    packname = pack_compref(
+        filenames[::-1], str(tmp_path / "day.pack"), encoding=encoding,
+        keyframe_interval=3,
+    )
+    with PackFile(packname) as pack:
+        assert len(pack) == 7
+        assert pack.times[0] == datetime(2022, 12, 6, 2, 0)
+        # Random access, in any order.
+        for k in (5, 0, 6, 2, 3, 4, 1, -1):
+            with gzip.open(filenames[k], "rb") as fid:
+                assert pack.read_bytes(k) == fid.read()
+        precip, _, metadata = pack.read(
+            datetime(2022, 12, 6, 2, 30), roi=(slice(10, 40), slice(5, 30))
+        )
+        expected, _, expected_metadata = read_cwb_compref(
+            filenames[3], gzipped=True, roi=(slice(10, 40), slice(5, 30))
+        )
+        np.testing.assert_array_equal(precip, expected)
+        assert metadata == expected_metadata
+        with pytest.raises(KeyError):
+            pack.position(datetime(2022, 12, 6, 2, 5))
+
+
+def test_pack_size_and_corruption(tmp_path, write_raw_compref):
+    from pysteps_importer_cwb.pack import (
+        PackFile,
+        pack_compref,
+        read_packed_cwb_compref,
+    )
+
+    # Textured rain field with a few changes from one frame to the next.
+    rng = np.random.default_rng(0)
+    raw = rng.integers(100, 500, (60, 50)).astype("<i2")
+    raw[:, :4] = -9990
+    filenames = []
+    for i in range(12):
+        changed = rng.random(raw.shape) < 0.05
+        raw = np.where(changed & (raw > 0), raw + rng.integers(-20, 20, raw.shape), raw)
+        t = datetime(2022, 12, 6, 2, 0) + timedelta(minutes=10 * i)
+        filenames.append(
+            write_raw_compref(
+                str(tmp_path / t.strftime("COMPREF.%Y%m%d.%H%M.gz")),
+                raw.astype("<i2"), time=t,
+            )
+        )
+    plain = pack_compref(filenames, str(tmp_path / "plain.pack"), encoding=None)
+    delta = pack_compref(filenames, str(tmp_path / "delta.pack"))
+    assert os.path.getsize(delta) < os.path.getsize(plain)
+
+    precip, _, _ = read_packed_cwb_compref(delta, 11, dtype="int16")
+    with gzip.open(filenames[11], "rb") as fid:
+        expected = np.frombuffer(fid.read()[-60 * 50 * 2 :], dtype="<i2")
+    np.testing.assert_array_equal(precip.ravel(), expected)
+
+    # A damaged frame is detected.
+    with PackFile(delta) as pack:
+        offset = int(pack.index[4]["offset"])
+        size = int(pack.index[4]["size"])
+    with open(delta, "r+b") as fid:
+        fid.seek(offset + size // 2)
+        byte = fid.read(1)
+        fid.seek(offset + size // 2)
+        fid.write(bytes([byte[0] ^ 0xFF]))
+    with PackFile(delta) as pack:
+        with pytest.raises(Exception):
+            pack.read_bytes(4)
+
+    with open(str(tmp_path / "other"), "wb") as fid:
+        fid.write(b"x" * 100)
+    with pytest.raises(ValueError):
+        PackFile(str(tmp_path / "other"))
@@ -0,0 +1,102 @@
+"""Tests for `pysteps_importer_cwb.prefetch`."""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+
+def _archive_file(root, t):
+    path = os.path.join(root, t.strftime("%Y/%m/%d"))
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, t.strftime("COMPREF.OpenData.%Y%m%d.%H%M.gz"))
+
+
+def test_prefetch_cwb_compref(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+    from pysteps_importer_cwb.prefetch import prefetch_cwb_compref
+
+    filenames = [
+        write_raw_compref(str(tmp_path / ("f%d.gz" % i)), synthetic_raw(seed=i))
+        for i in range(8)
+    ]
+    decoded = []
+
+    def importer(filename, **kwargs):
+        decoded.append(filename)
+        return read_cwb_compref(filename, **kwargs)
+
+    frames = prefetch_cwb_compref(
+        filenames[:3] + [None] + filenames[3:], depth=2, importer=importer,
+        gzipped=True,
+    )
+    first = next(frames)
+    np.testing.assert_array_equal(
+        first.precip, read_cwb_compref(filenames[0], gzipped=True)[0]
+    )
+    # Backpressure: the decoding stops a few frames ahead of the consumer.
+    time.sleep(0.3)
+    assert 2 <= len(decoded) <= 4
+    rest = list(frames)
+    assert [f.filename for f in rest] == filenames[1:3] + [None] + filenames[3:]
+    assert rest[2].precip is None
+    assert decoded == filenames
+
+
+def test_prefetch_errors_and_close(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.prefetch import prefetch_cwb_compref
+
+    filename = write_raw_compref(str(tmp_path / "f.gz"), synthetic_raw())
+    with open(str(tmp_path / "bad.gz"), "wb") as fid:
+        fid.write(b"not a gzip file")
+
+    frames = prefetch_cwb_compref(
+        [filename, str(tmp_path / "bad.gz"), filename], gzipped=True
+    )
+    assert next(frames).precip is not None
+    with pytest.raises(OSError):
+        next(frames)
+    with pytest.raises(StopIteration):
+        next(frames)
+
+    # Stopping early releases the background threads.
+    with prefetch_cwb_compref([filename] * 50, depth=1, gzipped=True) as frames:
+        next(frames)
+    assert not frames._thread.is_alive()
+
+
+def test_iter_cwb_compref_waits(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.prefetch import iter_cwb_compref
+
+    root = str(tmp_path)
+    t0 = datetime(2022, 12, 6, 2, 0)
+    times = [t0 + timedelta(minutes=10 * i) for i in range(3)]
+    write_raw_compref(_archive_file(root, times[0]), synthetic_raw())
+
+    # The second frame arrives while the iterator waits for it; the third
+    # never does.
+    def arrive():
+        time.sleep(0.2)
+        fn = _archive_file(root, times[1])
+        write_raw_compref(fn + ".tmp", synthetic_raw(seed=1))
+        os.replace(fn + ".tmp", fn)
+
+    thread = threading.Thread(target=arrive)
+    thread.start()
+    with iter_cwb_compref(
+        t0, times[-1], root_path=root, wait=1.0, poll_interval=0.02
+    ) as frames:
+        frames = list(frames)
+    thread.join()
+    assert [f.time for f in frames] == times
+    assert frames[1].precip is not None and frames[1].precip.shape == (40, 30)
+    assert frames[2].precip is None
+
+    # Without end, the iteration follows the archive.
+    with iter_cwb_compref(t0, root_path=root, wait=0.0) as frames:
+        assert [next(frames).precip is not None for _ in range(4)] == [
+            True, True, False, False
+        ]
@@ -0,0 +1,172 @@
+"""Tests for `pysteps_importer_cwb.pyramid`."""
+
+import os
+
+import numpy as np
+import pytest
+
+
+def _block_mean(field, factor, i, j, transform):
+    block = field[i * factor : (i + 1) * factor, j * factor : (j + 1) * factor]
+    block = block[~np.isnan(block)]
+    if block.size == 0:
+        return np.nan
+    if transform == "dB":
+        return 10.0 * np.log10(np.mean(10.0 ** (block / 10.0)))
+    return np.mean(block)
+
+
+@pytest.mark.parametrize("transform", ["dB", None])
+def test_coarsen(compref_raw, transform):
+    from pysteps_importer_cwb.pyramid import coarsen
+
+    field = compref_raw / 10.0
+    field[compref_raw == -9990] = np.nan
+    if transform is None:
+        field = np.where(field > 0, field / 10.0, np.where(np.isnan(field), np.nan, 0))
+    fields = coarsen(field.astype("float32"), transform=transform)
+    assert sorted(fields) == [2, 4, 8]
+    assert fields[2].shape == (20, 15)
+    assert fields[8].shape == (5, 4)  # 30 columns padded to 32
+    assert fields[8].dtype == np.float32
+    for factor, coarse in fields.items():
+        ny, nx = coarse.shape
+        expected = [
+            [_block_mean(field, factor, i, j, transform) for j in range(nx)]
+            for i in range(ny)
+        ]
+        np.testing.assert_allclose(coarse, expected, rtol=1e-5)
+    # The first columns have no value.
+    assert np.isnan(fields[2][:, 0]).all() and not np.isnan(fields[2][:, 2]).any()
+
+    # Leading dimensions are kept, and the levels are independent.
+    stack = coarsen(np.stack([field, field[::-1]]), factors=(4,), transform=transform)
+    np.testing.assert_allclose(stack[4][0], fields[4], rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        coarsen(field, factors=(2, 3))
+    with pytest.raises(ValueError):
+        coarsen(compref_raw)
+
+
+def test_pyramid_metadata(compref_file):
+    from pysteps_importer_cwb.compref import read_compref_header
+    from pysteps_importer_cwb.geometry import GridGeometry, grid_geometry
+    from pysteps_importer_cwb.pyramid import build_pyramid
+
+    pyramid = build_pyramid(compref_file, gzipped=True)
+    geometry = grid_geometry(read_compref_header(compref_file, gzipped=True))
+    metadata = pyramid[4][2]
+    coarse = GridGeometry(
+        geometry.lon_min + 1.5 * geometry.dlon, geometry.lat_min + 1.5 * geometry.dlat,
+        4 * geometry.dlon, 4 * geometry.dlat, 8, 10,
+    )
+    assert metadata["coarsen"] == 4
+    assert (metadata["x1"], metadata["y1"]) == (coarse.x1, coarse.y1)
+    assert (metadata["x2"], metadata["y2"]) == (coarse.x2, coarse.y2)
+    assert metadata["unit"] == "dBZ"
+
+    precip, _, metadata = build_pyramid(
+        compref_file, factors=(2,), gzipped=True, regrid=2000.0, rainrate=True
+    )[2]
+    assert metadata["xpixelsize"] == metadata["ypixelsize"] == 4000.0
+    assert metadata["unit"] == "mm/h"
+    assert (metadata["x2"] - metadata["x1"]) / 4000.0 == precip.shape[1]
+    assert (metadata["y2"] - metadata["y1"]) / 4000.0 == precip.shape[0]
+
+
+def test_pyramid_cache(tmp_path, monkeypatch, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb import pyramid
+    from pysteps_importer_cwb.importer_cwb_compref import importer_cwb_compref_cwb
+
+    filename = write_raw_compref(str(tmp_path / "COMPREF.gz"), synthetic_raw(seed=3))
+    precip, _, metadata = pyramid.read_coarse_cwb_compref(filename, 2, gzipped=True)
+    assert sorted(os.listdir(str(tmp_path / ".pyramid")))[0].startswith("COMPREF.gz.")
+    assert len(os.listdir(str(tmp_path / ".pyramid"))) == 6
+
+    # The coarse fields are read without decoding the source.
+    def fail(*args, **kwargs):
+        raise AssertionError("decoded")
+
+    monkeypatch.setattr(pyramid, "read_cwb_compref", fail)
+    cached = {
+        factor: importer_cwb_compref_cwb(
+            filename, gzipped=True, coarsen=factor, cache=True
+        )
+        for factor in (2, 8)
+    }
+    precip4, _, _ = pyramid.read_coarse_cwb_compref(filename, 4, gzipped=True)
+    assert isinstance(precip4, np.memmap)
+    monkeypatch.undo()
+
+    expected = pyramid.build_pyramid(filename, gzipped=True)
+    np.testing.assert_array_equal(precip, expected[2][0])
+    for factor in (2, 8):
+        np.testing.assert_array_equal(cached[factor][0], expected[factor][0])
+        assert cached[factor][2] == expected[factor][2]
+    np.testing.assert_array_equal(
+        importer_cwb_compref_cwb(filename, gzipped=True, coarsen=4)[0],
+        expected[4][0],
+    )
+
+    # Other options, or a modified source, are new entries.
+    pyramid.read_coarse_cwb_compref(filename, 2, gzipped=True, rainrate=True)
+    assert len(os.listdir(str(tmp_path / ".pyramid"))) == 12
+    write_raw_compref(filename, synthetic_raw(seed=4))
+    os.utime(filename, ns=(1, 1))
+    precip, _, _ = pyramid.read_coarse_cwb_compref(filename, 2, gzipped=True)
+    assert not isinstance(precip, np.memmap)
+
+
+def test_pyramid_cache_fillna_and_errors(tmp_path, monkeypatch, write_raw_compref,
+                                         synthetic_raw):
+    import errno
+
+    from pysteps_importer_cwb import pyramid
+    from pysteps_importer_cwb.importer_cwb_compref import importer_cwb_compref_cwb
+
+    filename = write_raw_compref(str(tmp_path / "COMPREF.gz"), synthetic_raw(seed=5))
+    # The second import fills a copy of the read-only cached field.
+    for _ in range(2):
+        precip, _, _ = importer_cwb_compref_cwb(
+            filename, gzipped=True, coarsen=2, cache=True, fillna=-15.0
+        )
+        assert not np.isnan(precip).any()
+        assert (precip == -15.0).any()
+
+    def disk_full(*args, **kwargs):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(pyramid, "write_atomic", disk_full)
+    precip, _, _ = pyramid.read_coarse_cwb_compref(
+        filename, 2, gzipped=True, rainrate=True
+    )
+    assert precip.shape == (20, 15)
+
+
+def test_pyramid_cache_other_factors(tmp_path, monkeypatch, write_raw_compref,
+                                     synthetic_raw):
+    from pysteps_importer_cwb import pyramid
+
+    filename = write_raw_compref(str(tmp_path / "COMPREF.gz"), synthetic_raw(seed=6))
+    expected = {
+        factor: pyramid.build_pyramid(filename, (factor,), gzipped=True)[factor]
+        for factor in (2, 3)
+    }
+    builds = []
+    build_pyramid = pyramid.build_pyramid
+
+    def counted(filename, factors, **kwargs):
+        builds.append(tuple(sorted(factors)))
+        return build_pyramid(filename, factors, **kwargs)
+
+    monkeypatch.setattr(pyramid, "build_pyramid", counted)
+    # A factor out of the chain of the default factors is cached next to them.
+    for factor in (2, 3, 2, 3, 8):
+        precip, _, metadata = pyramid.read_coarse_cwb_compref(
+            filename, factor, gzipped=True
+        )
+        if factor in expected:
+            np.testing.assert_array_equal(precip, expected[factor][0])
+            assert metadata == expected[factor][2]
+    assert builds == [(2, 4, 8), (3,)]
@@ -2,6 +2,10 @@
 
 """Tests for `pysteps_importer_cwb` package."""
 
+import numpy as np
+import pytest
+
+
 def test_importers_discovery():
     """It is recommended to at least test that the importers provided by the plugin are
     correctly detected by pysteps. For this, the tests should be ran on the installed
@@ -15,10 +19,368 @@ def test_importers_discovery():
         assert importer.replace("import_", "") in interface._importer_methods
 
 
-def test_importers_with_files():
+def test_importers_with_files(tmp_path):
     """Additionally, you can tests that your importers correctly reads the corresponding
     some example data.
     """
+    from pysteps.io import get_method
+
+    from pysteps_importer_cwb.testing import synthetic_dbz, write_synthetic_compref
+
+    filename = write_synthetic_compref(
+        str(tmp_path / "COMPREF.20221206.0230.gz"), ny=88, nx=92
+    )
+    importer = get_method("importer_cwb_compref_cwb", "importer")
+    precip, quality, metadata = importer(filename, gzipped=True)
+
+    dbz = synthetic_dbz(88, 92)
+    assert precip.shape == (88, 92)
+    assert quality is None
+    np.testing.assert_array_equal(np.isnan(precip), dbz == -999.0)
+    np.testing.assert_allclose(precip[dbz > -999], dbz[dbz > -999], atol=1e-6)
+    assert metadata["unit"] == "dBZ" and metadata["transform"] == "dB"
+
+
+def test_lazy_imports(tmp_path, write_raw_compref, synthetic_raw):
+    """The importer and dataset modules are imported without pysteps, pyproj or
+    the download tools, and importing pysteps afterwards still discovers the
+    importer."""
+    import subprocess
+    import sys
+
+    filename = write_raw_compref(str(tmp_path / "COMPREF.gz"), synthetic_raw())
+    code = """
+import sys
+import pysteps_importer_cwb.importer_cwb_compref as module
+import pysteps_importer_cwb.dataset
+heavy = ["pysteps", "pyproj", "xml.etree.ElementTree", "http.client",
+         "pysteps_importer_cwb.opendata", "pysteps_importer_cwb.regrid",
+         "dask", "xarray"]
+assert not [m for m in heavy if m in sys.modules], sys.modules.keys() & heavy
+precip, _, _ = module.importer_cwb_compref_cwb(%r, gzipped=True, dtype="float32")
+assert precip.dtype == "float32"
+from pysteps.io import get_method
+get_method("importer_cwb_compref_cwb", "importer")(%r, gzipped=True)
+assert module.download_cwb_opendata.__module__ == "pysteps_importer_cwb.opendata"
+""" % (filename, filename)
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_read_compref_header(compref_file, compref_raw):
+    from datetime import datetime
+
+    from pysteps_importer_cwb.compref import compref_header_dtype, read_compref_header
+
+    header = read_compref_header(compref_file, gzipped=True)
+    ny, nx = compref_raw.shape
+    assert header.time == datetime(2022, 12, 6, 2, 30, 0)
+    assert (header.nx, header.ny, header.nz) == (nx, ny, 1)
+    assert header.proj == "LL"
+    assert header.var_scale == 10
+    assert header.missing == -999
+    assert header.mosradar == ("RCWF", "RCHL", "RCCG")
+    assert header.data_offset == compref_header_dtype(1, 3).itemsize == 178
+
+
+def test_memmap_compref(compref_file_raw, compref_raw):
+    from pysteps_importer_cwb.compref import memmap_compref
+
+    payload = memmap_compref(compref_file_raw)
+    assert payload.shape == (1,) + compref_raw.shape
+    assert not payload.flags.writeable
+    np.testing.assert_array_equal(payload[0], compref_raw)
+
+
+def test_importer_gzipped_and_raw(compref_file, compref_file_raw, compref_raw):
+    from pysteps_importer_cwb.importer_cwb_compref import importer_cwb_compref_cwb
+
+    precip, quality, metadata = importer_cwb_compref_cwb(compref_file, gzipped=True)
+    expected = compref_raw / 10.0
+    expected[compref_raw == -9990] = np.nan
+    np.testing.assert_array_equal(precip, expected)
+    assert quality is None
+    assert metadata["unit"] == "dBZ"
+
+    precip_raw, _, _ = importer_cwb_compref_cwb(compref_file_raw)
+    np.testing.assert_array_equal(precip_raw, precip)
+
+
+def test_grid_geometry_cache(compref_file):
+    import pyproj
+
+    from pysteps_importer_cwb.compref import read_compref_header
+    from pysteps_importer_cwb.geometry import grid_geometry
+
+    header = read_compref_header(compref_file, gzipped=True)
+    geometry = grid_geometry(header)
+    assert grid_geometry(header._replace(time=None)) is geometry
+
+    assert np.isclose(geometry.lat_min, 18.0, atol=1e-3)
+    x1, y1 = pyproj.Proj("EPSG:3826")(geometry.lon_min, geometry.lat_min)
+    assert np.isclose(geometry.x1, x1) and np.isclose(geometry.y1, y1)
+
+    lons, lats = geometry.coordinates()
+    assert lons.shape == (header.ny, header.nx)
+    assert np.isclose(lats[0, 0], geometry.lat_min) and np.isclose(lons[0, -1], geometry.lon_max)
+    assert geometry.coordinates()[0] is lons
+
+
+def test_read_timeseries(tmp_path, write_raw_compref, synthetic_raw):
+    from datetime import datetime
+
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        find_cwb_compref,
+        importer_cwb_compref_cwb,
+        read_timeseries_cwb_compref,
+    )
+
+    for minute in (0, 10, 30):
+        day_path = tmp_path / "2022" / "12" / "06"
+        day_path.mkdir(parents=True, exist_ok=True)
+        write_raw_compref(
+            str(day_path / ("COMPREF.OpenData.20221206.02%02d.gz" % minute)),
+            synthetic_raw(seed=minute),
+            time=datetime(2022, 12, 6, 2, minute),
+        )
+
+    fns = find_cwb_compref(
+        datetime(2022, 12, 6, 2, 0), datetime(2022, 12, 6, 2, 30), str(tmp_path)
+    )
+    assert fns[0][2] is None
+
+    precip, _, metadata = read_timeseries_cwb_compref(
+        fns, gzipped=True, num_workers=4
+    )
+    assert precip.shape == (4, 40, 30)
+    assert np.isnan(precip[2]).all()
+    assert metadata["timestamps"][3] == datetime(2022, 12, 6, 2, 30)
+    expected, _, _ = importer_cwb_compref_cwb(fns[0][1], gzipped=True)
+    np.testing.assert_array_equal(precip[1], expected)
+
+
+def test_read_cwb_compref_dtypes(compref_file, compref_file_raw, compref_raw):
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+
+    expected = compref_raw / 10.0
+    expected[compref_raw == -9990] = np.nan
+
+    out = np.empty(compref_raw.shape, dtype="float32")
+    for filename, gzipped in ((compref_file, True), (compref_file_raw, False)):
+        precip, _, _ = read_cwb_compref(filename, gzipped=gzipped, out=out)
+        assert precip is out
+        np.testing.assert_allclose(precip, expected, rtol=1e-6)
+
+        precip, _, _ = read_cwb_compref(filename, gzipped=gzipped, dtype="int16")
+        np.testing.assert_array_equal(precip, compref_raw)
+
+    _, _, metadata = read_cwb_compref(compref_file, gzipped=True, dtype="int16")
+    assert metadata["var_scale"] == 10
+    assert metadata["missing"] == -9990
+    assert metadata["zerovalue"] == -990
+
+
+def test_decode_compref_chunks(compref_file, compref_raw):
+    from pysteps_importer_cwb.compref import decode_compref
+
+    full, _ = decode_compref(compref_file, gzipped=True)
+    chunked, _ = decode_compref(compref_file, gzipped=True, chunk_size=7 * 2 * 30)
+    np.testing.assert_array_equal(chunked, full)
+
+
+def test_importer_roi(compref_file, compref_file_raw, compref_raw):
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        importer_cwb_compref_cwb,
+        read_cwb_compref,
+    )
+
+    assert "Other Parameters" in importer_cwb_compref_cwb.__doc__
+
+    full, _, full_meta = importer_cwb_compref_cwb(compref_file, gzipped=True)
+    window = (slice(10, 25), slice(4, 20))
+    for filename, gzipped in ((compref_file, True), (compref_file_raw, False)):
+        precip, _, metadata = importer_cwb_compref_cwb(
+            filename, gzipped=gzipped, roi=window
+        )
+        np.testing.assert_array_equal(precip, full[window])
+        assert metadata["xpixelsize"] == 16 and metadata["ypixelsize"] == 15
+        assert full_meta["x1"] < metadata["x1"] < metadata["x2"] < full_meta["x2"]
+        assert full_meta["y1"] < metadata["y1"] < metadata["y2"] < full_meta["y2"]
+
+    # Bounds given in degrees select the pixel centers inside them.
+    _, _, metadata = read_cwb_compref(compref_file, gzipped=True, roi=window)
+    lon_min = 115.0 + 4 * 0.0125
+    lat_min = 18.0005 + 10 * 0.0125
+    precip, _, bounds_meta = read_cwb_compref(
+        compref_file,
+        gzipped=True,
+        roi=(lon_min - 0.001, lon_min + 15.5 * 0.0125, lat_min - 0.001,
+             lat_min + 14.5 * 0.0125),
+    )
+    np.testing.assert_array_equal(precip, full[window])
+    assert bounds_meta["x1"] == metadata["x1"]
+
+
+def test_importer_rainrate(tmp_path, compref_file, compref_file_raw):
+    from pysteps.utils.conversion import to_rainrate
+
+    from pysteps_importer_cwb.compref import rainrate_lut
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        importer_cwb_compref_cwb,
+        read_timeseries_cwb_compref,
+    )
+
+    dbz, _, dbz_metadata = importer_cwb_compref_cwb(compref_file, gzipped=True)
+    expected, expected_metadata = to_rainrate(dbz, dbz_metadata)
+
+    for filename, gzipped in ((compref_file, True), (compref_file_raw, False)):
+        precip, _, metadata = importer_cwb_compref_cwb(
+            filename, gzipped=gzipped, rainrate=True
+        )
+        np.testing.assert_allclose(precip, expected, rtol=1e-12)
+        for key in ("unit", "transform", "zerovalue", "zr_a", "zr_b"):
+            assert metadata[key] == expected_metadata[key]
+        assert np.isclose(metadata["threshold"], expected_metadata["threshold"])
+
+    # Windows, single precision and series share the same table.
+    precip, _, _ = importer_cwb_compref_cwb(
+        compref_file, gzipped=True, rainrate=True, roi=(slice(5, 9), slice(2, 7)),
+        dtype="float32",
+    )
+    assert precip.dtype == np.float32
+    np.testing.assert_allclose(precip, expected[5:9, 2:7], rtol=1e-6)
+    series, _, _ = read_timeseries_cwb_compref(
+        [compref_file, None], gzipped=True, rainrate=True, zr_a=200.0, zr_b=1.6
+    )
+    np.testing.assert_allclose(
+        series[0], to_rainrate(dbz, dbz_metadata, zr_a=200.0, zr_b=1.6)[0], rtol=1e-12
+    )
+    assert np.isnan(series[1]).all()
+    assert rainrate_lut(200.0, 1.6, 10) is rainrate_lut(200.0, 1.6, 10)
+
+
+def test_encode_compref(tmp_path, compref_file, compref_file_raw, compref_raw):
+    import gzip
+
+    from pysteps_importer_cwb.compref import (
+        compress_compref,
+        decode_compref,
+        encode_compref,
+        read_compref_header,
+        write_compref,
+    )
+
+    header = read_compref_header(compref_file_raw)
+    with open(compref_file_raw, "rb") as fid:
+        original = fid.read()
+    assert bytes(encode_compref(header, compref_raw)) == original
+
+    # Reused buffer.
+    out = bytearray(len(original) + 10)
+    assert encode_compref(header, compref_raw, out=out).obj is out
+    assert bytes(out[: len(original)]) == original
+
+    # Multi-member parallel compression is a valid gzip stream.
+    data = compress_compref(original, num_workers=4, block_size=1000)
+    assert data.count(b"\x1f\x8b\x08") >= len(original) // 1000
+    assert gzip.decompress(data) == original
+
+    filename = write_compref(
+        str(tmp_path / "encoded.gz"), header, compref_raw, compresslevel=1,
+        num_workers=2,
+    )
+    assert read_compref_header(filename, gzipped=True) == header
+    precip, _ = decode_compref(filename, gzipped=True, dtype="int16")
+    np.testing.assert_array_equal(precip, compref_raw)
+    window, _ = decode_compref(
+        filename, gzipped=True, window=(slice(20, 30), slice(5, 9)), dtype="int16"
+    )
+    np.testing.assert_array_equal(window, compref_raw[20:30, 5:9])
+
+
+def _volume_file(tmp_path, compref_file_raw, gzipped):
+    from pysteps_importer_cwb.compref import read_compref_header, write_compref
+
+    rng = np.random.default_rng(1)
+    volume = rng.integers(-100, 600, size=(4, 40, 30)).astype("<i2")
+    volume[:, :5] = -990
+    volume[:, :, :3] = -9990
+    volume[1:, 10:20, 10:20] = -9990  # Only the lowest level has data.
+    volume[:, 30:, 25:] = -9990  # No data in any level.
+    header = read_compref_header(compref_file_raw)._replace(
+        zht=(500, 1000, 2000, 3000)
+    )
+    name = "volume.gz" if gzipped else "volume"
+    return write_compref(str(tmp_path / name), header, volume), volume
+
+
+def _dbz(raw):
+    dbz = raw / 10.0
+    dbz[raw == -9990] = np.nan
+    return dbz
+
+
+def test_multi_level_volume(tmp_path, compref_file_raw):
+    import gzip
+
+    from pysteps_importer_cwb.compref import decode_compref
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        importer_cwb_compref_cwb,
+        read_timeseries_cwb_compref,
+    )
+
+    for gzipped in (True, False):
+        filename, volume = _volume_file(tmp_path, compref_file_raw, gzipped)
+        precip, _, metadata = importer_cwb_compref_cwb(filename, gzipped=gzipped)
+        np.testing.assert_array_equal(precip, _dbz(volume))
+        assert metadata["heights"] == [500, 1000, 2000, 3000]
+
+        precip, _, metadata = importer_cwb_compref_cwb(
+            filename, gzipped=gzipped, levels=1
+        )
+        np.testing.assert_array_equal(precip, _dbz(volume[1]))
+        assert metadata["heights"] == [1000]
+        for levels in ([3, 0, 3], slice(1, 3), [-1]):
+            precip, _ = decode_compref(
+                filename, gzipped=gzipped, levels=levels, dtype="int16",
+                window=(slice(8, 33), slice(2, 29)), chunk_size=7 * 60,
+            )
+            np.testing.assert_array_equal(precip, volume[levels, 8:33, 2:29])
+
+        # Column maximum, with the pixels without data in all the levels.
+        expected = volume.max(axis=0)
+        precip, _, metadata = importer_cwb_compref_cwb(
+            filename, gzipped=gzipped, colmax=True
+        )
+        np.testing.assert_array_equal(precip, _dbz(expected))
+        assert np.isnan(precip[35, 28]) and precip[15, 15] == volume[0, 15, 15] / 10
+        assert metadata["colmax"] and metadata["heights"] == [500, 1000, 2000, 3000]
+        precip, _ = decode_compref(
+            filename, gzipped=gzipped, colmax=True, levels=[1, 2], dtype="int16",
+            chunk_size=7 * 60,
+        )
+        np.testing.assert_array_equal(precip, volume[1:3].max(axis=0))
+        rainrate, _, _ = importer_cwb_compref_cwb(
+            filename, gzipped=gzipped, colmax=True, rainrate=True
+        )
+        single, _, _ = importer_cwb_compref_cwb(
+            filename, gzipped=gzipped, rainrate=True
+        )
+        np.testing.assert_array_equal(rainrate, np.fmax.reduce(single, axis=0))
+
+    # The decompression stops after the selected levels.
+    with open(filename, "rb") as fid:
+        data = fid.read()
+    truncated = str(tmp_path / "truncated.gz")
+    with gzip.open(truncated, "wb") as fid:
+        fid.write(data[: len(data) - 2 * 40 * 30])
+    precip, _ = decode_compref(truncated, gzipped=True, levels=[0, 2], dtype="int16")
+    np.testing.assert_array_equal(precip, volume[[0, 2]])
+
+    series, _, metadata = read_timeseries_cwb_compref(
+        [filename, None, filename], levels=0
+    )
+    assert series.shape == (3, 40, 30)
+    np.testing.assert_array_equal(series[2], _dbz(volume[0]))
 
-    # Write the test here.
-    pass
+    with pytest.raises(IndexError):
+        decode_compref(filename, levels=4)
@@ -0,0 +1,131 @@
+"""Tests for `pysteps_importer_cwb.regrid`."""
+
+import os
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    from pysteps_importer_cwb.regrid import _resampling_table
+
+    path = str(tmp_path / "cache")
+    monkeypatch.setenv("PYSTEPS_CWB_CACHE_DIR", path)
+    _resampling_table.cache_clear()
+    yield path
+    _resampling_table.cache_clear()
+
+
+def test_resampling_table(compref_file, cache_dir):
+    from pysteps_importer_cwb.compref import read_compref_header
+    from pysteps_importer_cwb.geometry import PROJECTION, _get_proj, grid_geometry
+    from pysteps_importer_cwb.regrid import _resampling_table, resampling_table
+
+    geometry = grid_geometry(read_compref_header(compref_file, gzipped=True))
+    table = resampling_table(geometry, pixelsize=2000.0)
+    assert table is resampling_table(geometry, pixelsize=2000)
+    assert table.x2 - table.x1 == table.nx * 2000.0
+
+    # Brute force nearest neighbor of every target pixel.
+    x = table.x1 + (np.arange(table.nx) + 0.5) * 2000.0
+    y = table.y1 + (np.arange(table.ny) + 0.5) * 2000.0
+    lons, lats = _get_proj(PROJECTION)(*np.meshgrid(x, y), inverse=True)
+    cols = np.rint((lons - geometry.lon_min) / geometry.dlon).astype(int)
+    rows = np.rint((lats - geometry.lat_min) / geometry.dlat).astype(int)
+    inside = (cols >= 0) & (cols < geometry.nx) & (rows >= 0) & (rows < geometry.ny)
+    assert inside.mean() > 0.8
+
+    field = np.arange(geometry.ny * geometry.nx, dtype="double").reshape(
+        geometry.ny, geometry.nx
+    )
+    regridded = table.resample(field)
+    np.testing.assert_array_equal(regridded[inside], field[rows[inside], cols[inside]])
+    assert np.isnan(regridded[~inside]).all()
+
+    # Stacks of frames are resampled frame by frame.
+    stack = table.resample(np.stack([field, -field]))
+    np.testing.assert_array_equal(stack[1][inside], -regridded[inside])
+
+    # The table was cached on disk and is reloaded without recomputation.
+    assert len(os.listdir(cache_dir)) == 1
+    _resampling_table.cache_clear()
+    cached = resampling_table(geometry, pixelsize=2000.0)
+    assert cached is not table
+    np.testing.assert_array_equal(cached.resample(field), regridded)
+
+
+def test_resampling_bilinear(compref_file, cache_dir):
+    from pysteps_importer_cwb.compref import read_compref_header
+    from pysteps_importer_cwb.geometry import PROJECTION, _get_proj, grid_geometry
+    from pysteps_importer_cwb.regrid import resampling_table
+
+    geometry = grid_geometry(read_compref_header(compref_file, gzipped=True))
+    table = resampling_table(geometry, pixelsize=2000.0, method="bilinear")
+    lons, lats = geometry.coordinates()
+    # A linear field is interpolated exactly.
+    regridded = table.resample(2 * lons + 3 * lats)
+    x = table.x1 + (np.arange(table.nx) + 0.5) * 2000.0
+    y = table.y1 + (np.arange(table.ny) + 0.5) * 2000.0
+    tlons, tlats = _get_proj(PROJECTION)(*np.meshgrid(x, y), inverse=True)
+    valid = ~np.isnan(regridded)
+    assert valid.mean() > 0.8
+    np.testing.assert_allclose(
+        regridded[valid], (2 * tlons + 3 * tlats)[valid], rtol=1e-6
+    )
+
+
+def test_importer_regrid(compref_file, cache_dir):
+    from pysteps_importer_cwb.importer_cwb_compref import importer_cwb_compref_cwb
+
+    dbz, _, _ = importer_cwb_compref_cwb(compref_file, gzipped=True)
+    precip, _, metadata = importer_cwb_compref_cwb(
+        compref_file, gzipped=True, regrid=2000.0
+    )
+    assert metadata["xpixelsize"] == metadata["ypixelsize"] == 2000.0
+    assert metadata["projection"] == "EPSG:3826"
+    assert precip.shape == (
+        round((metadata["y2"] - metadata["y1"]) / 2000.0),
+        round((metadata["x2"] - metadata["x1"]) / 2000.0),
+    )
+    # Nearest neighbor only picks existing values.
+    values = set(np.unique(dbz[~np.isnan(dbz)]))
+    assert set(np.unique(precip[~np.isnan(precip)])) <= values
+
+
+def test_resampling_bilinear_raw(compref_file, compref_raw, cache_dir):
+    from pysteps_importer_cwb.compref import read_compref_header
+    from pysteps_importer_cwb.geometry import grid_geometry
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+    from pysteps_importer_cwb.regrid import resampling_table
+
+    raw, _, metadata = read_cwb_compref(
+        compref_file, gzipped=True, dtype="int16", regrid=2000.0,
+        regrid_method="bilinear",
+    )
+    dbz, _, _ = read_cwb_compref(
+        compref_file, gzipped=True, regrid=2000.0, regrid_method="bilinear"
+    )
+    assert raw.dtype == np.int16
+    missing = metadata["missing"]
+    valid = ~np.isnan(dbz)
+    np.testing.assert_array_equal(raw[valid], np.rint(dbz[valid] * 10))
+    assert set(np.unique(raw[raw < -990])) == {missing}
+    # Both data types have values on the same pixels.
+    np.testing.assert_array_equal(raw == missing, ~valid)
+
+    # Next to the pixels without value, the weights of the valid neighbors are
+    # normalized.
+    geometry = grid_geometry(read_compref_header(compref_file, gzipped=True))
+    table = resampling_table(geometry, pixelsize=2000.0, method="bilinear")
+    values = compref_raw.ravel()[table.indices]
+    weights = np.where(values != missing, table.weights, 0.0)
+    edge = (values == missing).any(axis=0) & (weights.sum(axis=0) > 0)
+    edge[table.outside] = False
+    assert edge.any()
+    expected = (weights * values).sum(axis=0)[edge] / weights.sum(axis=0)[edge]
+    np.testing.assert_array_equal(raw.ravel()[edge], np.rint(expected))
+    np.testing.assert_allclose(dbz.ravel()[edge], expected / 10, rtol=1e-6)
+
+    with pytest.raises(ValueError, match="missing value"):
+        table.resample(compref_raw)
@@ -0,0 +1,109 @@
+"""Tests for `pysteps_importer_cwb.shm`."""
+
+import multiprocessing
+
+import numpy as np
+import pytest
+
+
+def _worker(args):
+    store, filename = args
+    precip, _, metadata = store.attach(filename, gzipped=True)
+    assert not precip.flags.writeable
+    return float(np.nansum(precip)), metadata["x1"]
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_shared_frame_store(tmp_path, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.importer_cwb_compref import read_cwb_compref
+    from pysteps_importer_cwb.shm import SharedFrameStore
+
+    filenames = [
+        write_raw_compref(str(tmp_path / ("f%d.gz" % i)), synthetic_raw(seed=i))
+        for i in range(3)
+    ]
+    with SharedFrameStore() as store:
+        names = store.publish_many(filenames + [None], gzipped=True)
+        assert names[-1] is None and len(set(names[:3])) == 3
+        assert store.publish(filenames[0], gzipped=True) == names[0]
+
+        precip, _, metadata = store.attach(filenames[1], gzipped=True)
+        expected, _, expected_metadata = read_cwb_compref(filenames[1], gzipped=True)
+        np.testing.assert_array_equal(precip, expected)
+        assert metadata == expected_metadata
+        with pytest.raises(ValueError):
+            precip[0, 0] = 1.0
+
+        context = multiprocessing.get_context("fork")
+        with context.Pool(2) as pool:
+            results = pool.map(_worker, [(store, fn) for fn in filenames])
+        for fn, (total, x1) in zip(filenames, results):
+            expected, _, expected_metadata = read_cwb_compref(fn, gzipped=True)
+            assert total == pytest.approx(np.nansum(expected))
+            assert x1 == expected_metadata["x1"]
+
+        # Frames not published are decoded by the reader itself.
+        with pytest.raises(FileNotFoundError):
+            store.attach(filenames[0], gzipped=True, dtype="int16")
+        precip, _, _ = store.read(filenames[0], gzipped=True, dtype="int16")
+        assert precip.dtype == np.int16
+    del precip
+
+    # The segments are destroyed with the store.
+    with pytest.raises(FileNotFoundError):
+        SharedFrameStore(store.prefix).attach(filenames[2], gzipped=True)
+
+
+def test_shared_frame_store_consistency(tmp_path, write_raw_compref, synthetic_raw,
+                                        monkeypatch):
+    import os
+    import pickle
+    import threading
+    from multiprocessing import shared_memory
+
+    from pysteps_importer_cwb import shm as shm_module
+    from pysteps_importer_cwb.shm import SharedFrameStore
+
+    filename = write_raw_compref(str(tmp_path / "f.gz"), synthetic_raw(seed=1))
+    with SharedFrameStore() as store:
+        # A segment still being written (without the size of its description)
+        # is not published: the reader decodes the file.
+        segment = shared_memory.SharedMemory(
+            name=store.segment_name(filename, gzipped=True), create=True, size=4096
+        )
+        try:
+            worker_store = pickle.loads(pickle.dumps(store))
+            with pytest.raises(FileNotFoundError, match="not published yet"):
+                worker_store.attach(filename, gzipped=True)
+            precip, _, _ = worker_store.read(filename, gzipped=True)
+            assert np.isfinite(precip).any()
+        finally:
+            shm_module.detach_all()
+            segment.close()
+            segment.unlink()
+
+        # Concurrent publications of a frame decode it once.
+        decoded = []
+        read = shm_module.read_cwb_compref
+
+        def slow_read(*args, **kwargs):
+            decoded.append(args[0])
+            threading.Event().wait(0.05)
+            return read(*args, **kwargs)
+
+        monkeypatch.setattr(shm_module, "read_cwb_compref", slow_read)
+        names = store.publish_many([filename] * 4, num_workers=4, gzipped=True)
+        monkeypatch.undo()
+        assert len(set(names)) == 1 and len(decoded) == 1
+
+        # A rewritten file is a new frame.
+        write_raw_compref(filename, synthetic_raw(seed=2))
+        os.utime(filename, ns=(1, 1))
+        with pytest.raises(FileNotFoundError):
+            store.attach(filename, gzipped=True)
+        precip, _, _ = store.read(filename, gzipped=True)
+        expected = synthetic_raw(seed=2) / 10.0
+        expected[expected == -999.0] = np.nan
+        np.testing.assert_array_equal(precip, expected)
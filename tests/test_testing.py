@@ -0,0 +1,92 @@
+"""Tests for `pysteps_importer_cwb.testing` and the benchmarks."""
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+
+
+def test_synthetic_dbz():
+    from pysteps_importer_cwb.testing import synthetic_dbz
+
+    dbz = synthetic_dbz(200, 220, seed=1)
+    assert dbz.shape == (200, 220)
+    novalue = dbz == -999.0
+    clear = dbz == -99.0
+    echo = ~novalue & ~clear
+    assert 0.1 < novalue.mean() < 0.9
+    assert echo.sum() == pytest.approx(0.2 * (~novalue).sum(), rel=0.2)
+    assert dbz[echo].min() >= 10.0 and dbz[echo].max() <= 70.0
+    np.testing.assert_array_equal(np.round(dbz, 1), dbz)
+    np.testing.assert_array_equal(synthetic_dbz(200, 220, seed=1), dbz)
+
+    # The echoes move with the shift, the coverage does not.
+    moved = synthetic_dbz(200, 220, seed=1, shift=(1, 2))
+    np.testing.assert_array_equal(moved == -999.0, novalue)
+    assert not np.array_equal(moved, dbz)
+
+    volume = synthetic_dbz(50, 60, nz=3)
+    assert volume.shape == (3, 50, 60)
+    assert (volume[2] > -99).sum() < (volume[0] > -99).sum()
+
+
+def test_synthetic_archive(tmp_path):
+    from pysteps_importer_cwb.compref import read_compref_header
+    from pysteps_importer_cwb.importer_cwb_compref import (
+        find_cwb_compref,
+        read_timeseries_cwb_compref,
+    )
+    from pysteps_importer_cwb.testing import synthetic_archive
+
+    start = datetime(2022, 12, 6, 0, 0)
+    end = datetime(2022, 12, 6, 0, 20)
+    filenames, timestamps = synthetic_archive(str(tmp_path), start, 3, ny=40, nx=50)
+    assert find_cwb_compref(start, end, root_path=str(tmp_path)) == (
+        filenames, timestamps
+    )
+    header = read_compref_header(filenames[1], gzipped=True)
+    assert header.time == timestamps[1]
+    assert (header.nx, header.ny, header.nz) == (50, 40, 1)
+    precip, _, _ = read_timeseries_cwb_compref(filenames, gzipped=True)
+    assert precip.shape == (3, 40, 50)
+
+
+def test_stand_in_latency():
+    import time
+
+    from pysteps_importer_cwb.opendata import HTTPClient
+    from pysteps_importer_cwb.testing import OpenDataStandIn
+
+    with OpenDataStandIn(latency=0.05) as server:
+        client = HTTPClient()
+        start = time.perf_counter()
+        client.get(server.base_url)
+        assert time.perf_counter() - start >= 0.05
+        client.close()
+
+
+@pytest.mark.parametrize(
+    "script",
+    [
+        ["bench_import.py", "--frames", "2"],
+        ["bench_sync.py", "--frames", "2"],
+    ],
+)
+def test_benchmarks(tmp_path, script):
+    import json
+
+    output = str(tmp_path / "results.json")
+    subprocess.run(
+        [sys.executable, os.path.join(BENCHMARKS, script[0])] + script[1:]
+        + ["--nx", "30", "--ny", "20", "--repeat", "1", "--json", output],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(BENCHMARKS)),
+    )
+    with open(output) as fid:
+        assert json.load(fid)["results"]
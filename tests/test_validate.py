@@ -0,0 +1,124 @@
+"""Tests for `pysteps_importer_cwb.validate`."""
+
+import gzip
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+def _content(filename):
+    with gzip.open(filename, "rb") as fid:
+        return fid.read()
+
+
+def test_validate_compref(tmp_path, compref_file, compref_file_raw):
+    from pysteps_importer_cwb.compref import compress_compref
+    from pysteps_importer_cwb.validate import validate_compref
+
+    def write(name, data):
+        filename = str(tmp_path / name)
+        with open(filename, "wb") as fid:
+            fid.write(data)
+        return filename
+
+    raw = _content(compref_file)
+    with open(compref_file, "rb") as fid:
+        compressed = fid.read()
+
+    valid = [
+        compref_file,
+        compref_file_raw,
+        # Multi-member stream, as written by a parallel compression.
+        write("multi.gz", compress_compref(raw, num_workers=2, block_size=500)),
+        write("padded.gz", compressed + b"\0" * 10),
+    ]
+    for filename in valid:
+        result = validate_compref(filename)
+        assert result.error is None, (filename, result.error)
+        assert result.time == datetime(2022, 12, 6, 2, 30)
+    assert validate_compref(valid[2], chunk_size=100).error is None
+
+    crc = bytearray(compressed)
+    crc[-8] ^= 0xFF
+    header = bytearray(raw)
+    header[24:28] = np.array([0], dtype="<i4").tobytes()  # nx
+    bad = {
+        "truncated.gz": compressed[:-20],
+        "crc.gz": bytes(crc),
+        "short.gz": gzip.compress(raw[:-2]),
+        "long": raw + b"\0\0",
+        "header.gz": gzip.compress(bytes(header)),
+        "garbage.gz": compressed + b"garbage",
+        "empty.gz": b"",
+        "text.gz": b"not a gzip file",
+    }
+    for name, data in bad.items():
+        result = validate_compref(write(name, data))
+        assert result.error is not None, name
+    result = validate_compref(str(tmp_path / "short.gz"))
+    assert "Payload of 2398 bytes, 2400 expected" in result.error
+    assert result.time == datetime(2022, 12, 6, 2, 30)
+    assert validate_compref(str(tmp_path / "nothing.gz")).error is not None
+
+
+def _archive(write_raw_compref, synthetic_raw, root, count=6, missing=(2,)):
+    start = datetime(2022, 12, 6, 2, 0)
+    filenames = []
+    for i in range(count):
+        if i in missing:
+            continue
+        t = start + timedelta(minutes=10 * i)
+        path = os.path.join(root, t.strftime("%Y/%m/%d"))
+        os.makedirs(path, exist_ok=True)
+        filenames.append(
+            write_raw_compref(
+                os.path.join(path, t.strftime("COMPREF.OpenData.%Y%m%d.%H%M.gz")),
+                synthetic_raw(seed=i), time=t,
+            )
+        )
+    return start, filenames
+
+
+def test_validate_archive(tmp_path, capsys, write_raw_compref, synthetic_raw):
+    from pysteps_importer_cwb.validate import main, validate_archive
+
+    root = str(tmp_path)
+    start, filenames = _archive(write_raw_compref, synthetic_raw, root)
+    with open(filenames[3], "r+b") as fid:
+        fid.truncate(os.path.getsize(filenames[3]) - 30)
+    with open(os.path.join(root, "notes.gz"), "wb") as fid:
+        fid.write(b"not a frame")
+
+    report = validate_archive(root, num_workers=2)
+    assert (report.checked, report.skipped) == (5, 0)
+    assert [r.filename for r in report.bad] == [filenames[3]]
+    assert report.missing == [start + timedelta(minutes=20)]
+    assert os.path.isfile(os.path.join(root, ".validate_state.json"))
+
+    # The unchanged files are not checked again, the bad ones stay bad.
+    report = validate_archive(root)
+    assert (report.checked, report.skipped) == (0, 5)
+    assert [r.filename for r in report.bad] == [filenames[3]]
+    t = start + timedelta(minutes=40)
+    write_raw_compref(filenames[3], synthetic_raw(), time=t)
+    report = validate_archive(root)
+    assert (report.checked, report.skipped, report.bad) == (1, 4, [])
+
+    # Explicit period, with missing frames at the ends.
+    report = validate_archive(
+        root, start=start - timedelta(minutes=10), end=start + timedelta(minutes=60),
+        state_file=False,
+    )
+    assert report.checked == 5
+    assert len(report.missing) == 3
+
+    assert main([root, "--force", "--no-state"]) == 0
+    out = capsys.readouterr().out
+    assert "MISSING 2022-12-06 02:20" in out
+    assert "5 checked, 0 unchanged, 0 bad, 1 missing" in out
+    os.unlink(filenames[0])
+    with open(filenames[0], "wb") as fid:
+        fid.write(b"\x1f\x8b")
+    assert main([root, "--start", "202212060200", "--end", "2022-12-06T02:50"]) == 1
+    assert "BAD %s" % filenames[0] in capsys.readouterr().out